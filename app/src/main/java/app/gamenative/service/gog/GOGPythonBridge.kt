@@ -223,6 +223,26 @@ object GOGPythonBridge {
         }
     }
 
+    /**
+     * Cancel a running GOGDL download
+     *
+     * Sets the download's cancellation token, which aborts in-flight chunk requests
+     * and stops the download threads.
+     *
+     * @param gameId Numeric GOG game ID the download was started with
+     * @return true if a running download was found and cancelled
+     */
+    fun cancelDownload(gameId: String): Boolean {
+        if (!Python.isStarted()) return false
+
+        return try {
+            Python.getInstance().getModule("gogdl.dl.cancellation").callAttr("cancel", gameId).toBoolean()
+        } catch (e: Exception) {
+            Timber.w(e, "Failed to cancel GOGDL download for game $gameId")
+            false
+        }
+    }
+
     /**
      * Estimate progress when callback isn't available
      * Shows gradual progress to indicate activity
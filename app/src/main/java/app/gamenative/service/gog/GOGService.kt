@@ -204,6 +204,7 @@ class GOGService : Service() {
             return if (downloadInfo != null) {
                 Timber.i("Cancelling download for game: $gameId")
                 downloadInfo.cancel()
+                GOGPythonBridge.cancelDownload(ContainerUtils.extractGameIdFromContainerId(gameId).toString())
                 instance.activeDownloads.remove(gameId)
                 Timber.d("Download cancelled for game: $gameId")
                 true
@@ -1,9 +1,7 @@
 import logging
 import time
-import requests
 import json
-from multiprocessing import cpu_count
-from gogdl.dl import dl_utils
+from gogdl.dl import dl_utils, connection_pool
 import gogdl.constants as constants
 
 
@@ -11,12 +9,8 @@ class ApiHandler:
     def __init__(self, auth_manager):
         self.auth_manager = auth_manager
         self.logger = logging.getLogger("API")
-        self.session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(pool_maxsize=cpu_count())
-        self.session.mount("https://", adapter)
-        self.session.headers = {
-            'User-Agent': f'gogdl/1.0.0 (Android GameNative)'
-        }
+        # Connections are shared with download workers, headers aren't
+        self.session = connection_pool.create_session()
         self._update_auth_header()
         self.owned = []
 
@@ -44,7 +44,9 @@ def init_parser():
     download_parser.add_argument('--dlc-only', dest='dlc_only', action='store_true', help='Download only DLC')
 
     download_parser.add_argument('--lang', type=str, default='en-US', help='Language for the download')
-    download_parser.add_argument('--max-workers', dest='workers_count', type=int, default=2, help='Number of download workers')
+    download_parser.add_argument('--max-workers', dest='workers_count', type=int, default=2, help='Maximum number of download workers, requests in flight adapt to the connection within it')
+    download_parser.add_argument('--max-writers', dest='writers_count', type=int, default=2, help='Number of disk writer workers')
+    download_parser.add_argument('--chunk-cache-size', dest='chunk_cache_size', type=int, help='Disk space in MiB for chunks shared between files (default 1024)')
     download_parser.add_argument('--support', dest='support_path', type=str, help='Support files path')
     download_parser.add_argument('--password', dest='password', help='Password to access other branches')
     download_parser.add_argument('--force-gen', choices=['1', '2'], dest='force_generation', help='Force specific manifest generation (FOR DEBUGGING)')
@@ -0,0 +1,89 @@
+import logging
+from threading import Event, Lock
+
+
+class CancellationToken:
+    """Cancellation signal shared between the executor and its workers
+
+    Checking it is a single Event lookup, so it's cheap enough to do for every read.
+    Callbacks registered with on_cancel run once, from the thread calling cancel(),
+    and are meant to wake up blocking operations (e.g. close HTTP responses).
+    """
+
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._callbacks = dict()
+        self._next_id = 0
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.getLogger("CANCELLATION").debug(f"Cancel callback failed: {e}")
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout=None) -> bool:
+        """Sleeps up to timeout seconds, returns True if cancelled meanwhile"""
+        return self._event.wait(timeout)
+
+    def on_cancel(self, callback):
+        """Registers callback, returns handle for remove_callback
+
+        If the token is already cancelled, callback is called right away.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                handle = self._next_id
+                self._next_id += 1
+                self._callbacks[handle] = callback
+                return handle
+        callback()
+        return None
+
+    def remove_callback(self, handle):
+        if handle is None:
+            return
+        with self._lock:
+            self._callbacks.pop(handle, None)
+
+
+_tokens = dict()
+_tokens_lock = Lock()
+
+
+def register(game_id) -> CancellationToken:
+    """Creates a fresh token for a download of game_id"""
+    token = CancellationToken()
+    with _tokens_lock:
+        _tokens[str(game_id)] = token
+    return token
+
+
+def unregister(game_id, token: CancellationToken):
+    with _tokens_lock:
+        if _tokens.get(str(game_id)) is token:
+            del _tokens[str(game_id)]
+
+
+def cancel(game_id) -> bool:
+    """Cancels running download of game_id, used by the Android bridge
+
+    Returns False if there is no download running for the game.
+    """
+    with _tokens_lock:
+        token = _tokens.get(str(game_id))
+    if not token:
+        return False
+    token.cancel()
+    return True
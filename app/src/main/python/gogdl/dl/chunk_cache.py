@@ -0,0 +1,203 @@
+import logging
+from collections import Counter
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional
+
+# Bytes of chunks kept in .gogdl-download-cache between their uses
+DISK_BUDGET = 1024 * 1024 * 1024
+# Bytes of chunks kept in RAM between their uses
+MEMORY_BUDGET = 32 * 1024 * 1024
+# Chunks up to this size are kept in RAM while it has room
+MEMORY_CHUNK_SIZE = 1024 * 1024
+
+# Where chunk of a v2 file comes from
+CHUNK_DIRECT = 'direct'    # Downloaded straight into its file
+CHUNK_OFFLOAD = 'offload'  # Downloaded and kept in cache for its next use
+CHUNK_CACHED = 'cached'    # Read from cache
+
+
+@dataclass
+class CacheEntry:
+    md5: str
+    compressed_md5: str
+    size: int
+    in_memory: bool
+
+
+class Release(NamedTuple):
+    """Cache entry that isn't needed anymore, dropped once tasks reading it are done"""
+    md5: str
+    size: int
+    in_memory: bool
+
+
+class ChunkRoute(NamedTuple):
+    source: str
+    # Chunk is offloaded to or read from RAM instead of disk
+    in_memory: bool
+    released: List[Release]
+
+    def disk_usage(self, size):
+        """(added, freed) bytes of cache on disk once chunk of given size is routed"""
+        added = size if self.source == CHUNK_OFFLOAD and not self.in_memory else 0
+        return added, sum(release.size for release in self.released if not release.in_memory)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    peak_disk: int = 0
+    peak_memory: int = 0
+
+
+class ChunkCache:
+    """Decides which chunks used by more than one file are kept between their uses
+
+    Works on the download plan, before any task runs: uses holds how many times each
+    chunk (by compressed md5) is still going to be written. Chunk needed again is kept,
+    in RAM when it's small and RAM budget has room, on disk otherwise. When a budget is
+    full, entries with the fewest remaining uses per byte are evicted, as long as they
+    are worth less than the chunk coming in. Chunk that didn't fit or was evicted is
+    simply downloaded again on its next use.
+    Budgets hold in plan order, entries are dropped only after tasks reading them.
+    Files left in cache by a previous run take disk budget from the start, the ones
+    that don't fit are listed in dropped, to be deleted before anything runs.
+    """
+
+    def __init__(self, uses: Counter, disk_budget: int = DISK_BUDGET, memory_budget: int = MEMORY_BUDGET,
+                 existing: Optional[Dict[str, int]] = None):
+        self.uses = uses
+        self.disk_budget = max(disk_budget, 0)
+        self.memory_budget = max(memory_budget, 0)
+        self.entries: Dict[str, CacheEntry] = dict()
+        self.disk_size = 0
+        self.memory_size = 0
+        self.stats = CacheStats()
+        self.existing = dict()
+        self.dropped = list()
+        for md5, size in (existing or dict()).items():
+            if self.disk_size + size <= self.disk_budget:
+                self.existing[md5] = size
+                self.disk_size += size
+            else:
+                self.dropped.append(md5)
+        self.stats.peak_disk = self.disk_size
+
+    def route(self, chunk) -> ChunkRoute:
+        """Routes a single use of chunk, in the order chunks are written"""
+        self.uses[chunk.compressed_md5] -= 1
+        remaining = self.uses[chunk.compressed_md5]
+        released = list()
+
+        entry = self.entries.get(chunk.md5)
+        if entry is None and chunk.md5 in self.existing:
+            # Left by previous run, it's on disk and charged already
+            entry = CacheEntry(chunk.md5, chunk.compressed_md5, self.existing.pop(chunk.md5), False)
+            self.entries[chunk.md5] = entry
+
+        if entry is not None:
+            self.stats.hits += 1
+            if remaining <= 0:
+                self.remove(entry)
+                released.append(Release(entry.md5, entry.size, entry.in_memory))
+            return ChunkRoute(CHUNK_CACHED, entry.in_memory, released)
+
+        if remaining <= 0:
+            return ChunkRoute(CHUNK_DIRECT, False, released)
+
+        self.stats.misses += 1
+        in_memory = chunk.size <= MEMORY_CHUNK_SIZE
+        victims = self.make_room(chunk.size, remaining, in_memory) if in_memory else None
+        if victims is None:
+            in_memory = False
+            victims = self.make_room(chunk.size, remaining, in_memory)
+        if victims is None:
+            return ChunkRoute(CHUNK_DIRECT, False, released)
+
+        for victim in victims:
+            self.remove(victim)
+            self.stats.evictions += 1
+            released.append(Release(victim.md5, victim.size, victim.in_memory))
+        self.add(chunk, chunk.size, in_memory)
+        return ChunkRoute(CHUNK_OFFLOAD, in_memory, released)
+
+    def make_room(self, size, remaining, in_memory) -> Optional[List[CacheEntry]]:
+        """Entries to evict so chunk fits into budget, None if it shouldn't be cached"""
+        budget = self.memory_budget if in_memory else self.disk_budget
+        used = self.memory_size if in_memory else self.disk_size
+        if size > budget:
+            return None
+        victims = list()
+        if used + size <= budget:
+            return victims
+
+        value = remaining / size
+        candidates = sorted((entry for entry in self.entries.values() if entry.in_memory == in_memory),
+                            key=lambda entry: self.uses[entry.compressed_md5] / entry.size)
+        for entry in candidates:
+            if self.uses[entry.compressed_md5] / entry.size >= value:
+                return None
+            victims.append(entry)
+            used -= entry.size
+            if used + size <= budget:
+                return victims
+        return None
+
+    def add(self, chunk, size, in_memory) -> CacheEntry:
+        entry = CacheEntry(chunk.md5, chunk.compressed_md5, size, in_memory)
+        self.entries[chunk.md5] = entry
+        if in_memory:
+            self.memory_size += size
+            self.stats.peak_memory = max(self.stats.peak_memory, self.memory_size)
+        else:
+            self.disk_size += size
+            self.stats.peak_disk = max(self.stats.peak_disk, self.disk_size)
+        return entry
+
+    def remove(self, entry: CacheEntry):
+        del self.entries[entry.md5]
+        if entry.in_memory:
+            self.memory_size -= entry.size
+        else:
+            self.disk_size -= entry.size
+
+    def take_stale(self) -> List[str]:
+        """Files left by previous run that no chunk in the plan used, called once planning is done"""
+        stale = list(self.existing)
+        self.disk_size -= sum(self.existing.values())
+        self.existing = dict()
+        return stale
+
+    def log_stats(self, logger: logging.Logger):
+        stats = self.stats
+        logger.info(f"Chunk cache {stats.hits} hits, {stats.misses} misses, {stats.evictions} evictions, "
+                    f"peak {stats.peak_disk / 1024 / 1024:.02f} MiB on disk, {stats.peak_memory / 1024 / 1024:.02f} MiB in memory")
+
+
+class MemoryChunks:
+    """Chunks kept in RAM between their uses, shared by writer workers"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.chunks: Dict[str, bytes] = dict()
+        self.size = 0
+
+    def put(self, md5: str, data: bytes):
+        with self.lock:
+            if md5 in self.chunks:
+                return
+            self.chunks[md5] = data
+            self.size += len(data)
+
+    def get(self, md5: str) -> Optional[bytes]:
+        with self.lock:
+            return self.chunks.get(md5)
+
+    def pop(self, md5: str):
+        with self.lock:
+            data = self.chunks.pop(md5, None)
+            if data is not None:
+                self.size -= len(data)
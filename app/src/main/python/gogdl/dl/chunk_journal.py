@@ -0,0 +1,97 @@
+import logging
+import os
+import time
+
+# How often appended entries are forced to disk, in seconds
+FSYNC_INTERVAL = 2.0
+
+
+class ChunkJournal:
+    """Append-only record of chunks already written into files that aren't complete yet
+
+    Complements the resume file, which only lists fully written files, so an interrupted
+    download of a big file continues from the chunks that made it to disk.
+    Each line is checksum:support:index:path, checksum being the file checksum from
+    the manifest, so entries for a file that changed in the meantime are ignored.
+    Entries are fsync'd at most every FSYNC_INTERVAL seconds, losing the last few
+    after a crash only means downloading those chunks again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.logger = logging.getLogger("CHUNK_JOURNAL")
+        self.handle = None
+        self.last_sync = 0.0
+        self.dirty = False
+
+    def load(self) -> dict:
+        """Reads the journal, returns {(support, path lowercase): (checksum, {index})}"""
+        entries = dict()
+        if not os.path.exists(self.path):
+            return entries
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    # Last line may be cut short by a crash
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        checksum, support, index, file_path = line.rstrip('\n').split(':', 3)
+                        index = int(index)
+                    except ValueError:
+                        continue
+                    key = (support, file_path.lower())
+                    known = entries.get(key)
+                    if known is None or known[0] != checksum:
+                        # Newer entries win if the file was restarted with different content
+                        known = (checksum, set())
+                        entries[key] = known
+                    known[1].add(index)
+        except OSError as e:
+            self.logger.warning(f"Unable to read chunk journal {e}")
+        return entries
+
+    def open(self, entries=None):
+        """Rewrites the journal with entries still valid and opens it for appending
+
+        entries is a list of (checksum, support, index, path)
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for checksum, support, index, file_path in entries or []:
+                f.write(f"{checksum}:{support}:{index}:{file_path}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.handle = open(self.path, 'a')
+        self.last_sync = time.monotonic()
+
+    def add(self, checksum: str, support: str, index: int, file_path: str):
+        if not self.handle:
+            return
+        self.handle.write(f"{checksum}:{support}:{index}:{file_path}\n")
+        self.dirty = True
+        if time.monotonic() - self.last_sync >= FSYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        if not self.handle or not self.dirty:
+            return
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.dirty = False
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if not self.handle:
+            return
+        try:
+            self.sync()
+        finally:
+            self.handle.close()
+            self.handle = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
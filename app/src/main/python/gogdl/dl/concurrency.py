@@ -0,0 +1,112 @@
+import logging
+import time
+from typing import Optional
+
+# Rough memory a chunk request in flight takes: read buffer, decompressor state
+# and decompressed output of a single read
+REQUEST_MEMORY = 2 * 1024 * 1024
+# Memory download workers are allowed to use in total
+MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Additive increase / multiplicative decrease parameters
+INCREASE_STEP = 1
+DECREASE_FACTOR = 0.7
+# Time-to-first-byte over this many times the lowest seen one means requests are queueing
+RTT_TOLERANCE = 2.0
+# Growth of time-to-first-byte at which the limit stops growing unless throughput gains
+RTT_PLATEAU = 1.25
+# Throughput change considered noise
+THROUGHPUT_TOLERANCE = 0.05
+# Minimum duration of a measurement window in seconds
+WINDOW = 1.0
+
+
+class ConcurrencyController:
+    """Adapts number of chunk requests in flight to measured throughput and latency (AIMD)
+
+    Each measurement window the limit grows by one request as long as the limit was
+    actually reached and throughput isn't getting worse. It's cut down multiplicatively
+    on failed requests, or when latency grows while throughput doesn't, as that means
+    requests are only queueing up somewhere on the way.
+    Every decision is logged, so the thresholds can be tuned from real downloads.
+    """
+
+    def __init__(self, initial: int, maximum: int, minimum: int = 1, window: float = WINDOW):
+        self.logger = logging.getLogger("CONCURRENCY")
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.window = window
+
+        self.min_rtt: Optional[float] = None
+        self.last_throughput: Optional[float] = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_started = time.monotonic()
+        self.window_bytes = 0
+        self.window_requests = 0
+        self.window_rtt = 0.0
+        self.window_failures = 0
+        self.window_peak = 0
+
+    def on_success(self, size: int, rtt: Optional[float], in_flight: int) -> bool:
+        """Records finished request, returns True if the limit changed"""
+        self.window_bytes += size or 0
+        self.window_requests += 1
+        self.window_rtt += rtt or 0.0
+        self.window_peak = max(self.window_peak, in_flight)
+        return self._maybe_adjust()
+
+    def on_failure(self) -> bool:
+        self.window_failures += 1
+        return self._maybe_adjust()
+
+    def _maybe_adjust(self) -> bool:
+        elapsed = time.monotonic() - self.window_started
+        # Window needs to span at least one round of requests to say anything
+        if elapsed < self.window or self.window_requests + self.window_failures < self.limit:
+            return False
+
+        throughput = self.window_bytes / elapsed
+        rtt = self.window_rtt / self.window_requests if self.window_requests else None
+        if rtt is not None and (self.min_rtt is None or rtt < self.min_rtt):
+            self.min_rtt = rtt
+
+        old = self.limit
+        improving = self.last_throughput is None or throughput >= self.last_throughput * (1 - THROUGHPUT_TOLERANCE)
+        gaining = self.last_throughput is None or throughput > self.last_throughput * (1 + THROUGHPUT_TOLERANCE)
+        queueing = rtt is not None and self.min_rtt and rtt > self.min_rtt * RTT_TOLERANCE
+        plateau = rtt is not None and self.min_rtt and rtt > self.min_rtt * RTT_PLATEAU
+
+        if self.window_failures:
+            reason = f"{self.window_failures} failed requests"
+            self.limit = max(int(self.limit * DECREASE_FACTOR), self.minimum)
+        elif queueing and not gaining:
+            reason = "latency grows without throughput gain"
+            self.limit = max(int(self.limit * DECREASE_FACTOR), self.minimum)
+        elif plateau and not gaining:
+            reason = "throughput plateaued"
+        elif improving and self.window_peak >= self.limit:
+            reason = "limit reached, throughput holding up"
+            self.limit = min(self.limit + INCREASE_STEP, self.maximum)
+        else:
+            reason = "holding"
+
+        message = (f"{old} -> {self.limit} requests: {reason}, "
+                   f"{throughput / 1024 / 1024:.02f} MiB/s, "
+                   f"rtt {rtt * 1000 if rtt is not None else 0:.0f} ms (min {(self.min_rtt or 0) * 1000:.0f} ms), "
+                   f"peak in flight {self.window_peak}")
+        if self.limit != old:
+            self.logger.info(message)
+        else:
+            self.logger.debug(message)
+
+        self.last_throughput = throughput
+        self._reset_window()
+        return self.limit != old
+
+
+def memory_limit(budget: int = MEMORY_BUDGET) -> int:
+    """Requests in flight that fit into memory budget"""
+    return max(budget // REQUEST_MEMORY, 1)
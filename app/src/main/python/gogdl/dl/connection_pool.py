@@ -0,0 +1,122 @@
+import logging
+from dataclasses import dataclass
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Number of hosts to keep pools for (API, CDN endpoints, redist)
+POOL_HOSTS = 10
+# Connections kept open per host, requests block while all are in use
+POOL_PER_HOST = 16
+# Seconds a request waits for a free connection before failing,
+# requests itself would wait forever
+POOL_TIMEOUT = 60
+
+USER_AGENT = 'gogdl/1.0.0 (Android GameNative)'
+
+
+@dataclass
+class HostStats:
+    host: str
+    requests: int = 0
+    connections: int = 0
+
+    @property
+    def reused(self):
+        """Requests that didn't have to open a new connection (TCP + TLS handshake)"""
+        return max(self.requests - self.connections, 0)
+
+
+class BoundedWaitMixin:
+    """Connection pool that gives up waiting for a free connection after POOL_TIMEOUT"""
+
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(timeout=POOL_TIMEOUT if timeout is None else timeout)
+
+
+class BoundedWaitHTTPConnectionPool(BoundedWaitMixin, HTTPConnectionPool):
+    pass
+
+
+class BoundedWaitHTTPSConnectionPool(BoundedWaitMixin, HTTPSConnectionPool):
+    pass
+
+
+class SharedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter meant to be mounted on every session of the process
+
+    Sessions keep their own headers (e.g. API session has Authorization, CDN ones don't)
+    while connections to a host are pooled and reused across all of them.
+    Connections per host are bounded by per_host, with pool_block requests wait
+    for a free connection instead of opening throwaway ones, up to POOL_TIMEOUT.
+    """
+
+    def __init__(self, hosts=POOL_HOSTS, per_host=POOL_PER_HOST):
+        self._stats_lock = Lock()
+        # Counters of pools already evicted or closed
+        self._disposed = dict()
+        super().__init__(pool_connections=hosts, pool_maxsize=per_host, pool_block=True)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': BoundedWaitHTTPConnectionPool,
+                                                   'https': BoundedWaitHTTPSConnectionPool}
+        self.poolmanager.pools.dispose_func = self._dispose_pool
+
+    def _dispose_pool(self, pool):
+        with self._stats_lock:
+            stats = self._disposed.setdefault(pool.host, HostStats(pool.host))
+            stats.requests += pool.num_requests
+            stats.connections += pool.num_connections
+        pool.close()
+
+    def close(self):
+        # Sessions close their adapters, pools stay open for other sessions
+        pass
+
+    def shutdown(self):
+        super().close()
+
+    def stats(self):
+        """Per host request and connection counters since adapter creation"""
+        with self._stats_lock:
+            result = {host: HostStats(host, s.requests, s.connections) for host, s in self._disposed.items()}
+
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats = result.setdefault(pool.host, HostStats(pool.host))
+            stats.requests += pool.num_requests
+            stats.connections += pool.num_connections
+        return result
+
+    def log_stats(self, logger=None):
+        logger = logger or logging.getLogger("CONNECTIONS")
+        for stats in self.stats().values():
+            logger.debug(f"{stats.host}: {stats.requests} requests over {stats.connections} connections, {stats.reused} reused")
+
+
+_shared_adapter = None
+_shared_adapter_lock = Lock()
+
+
+def get_shared_adapter() -> SharedHTTPAdapter:
+    global _shared_adapter
+    with _shared_adapter_lock:
+        if _shared_adapter is None:
+            _shared_adapter = SharedHTTPAdapter()
+        return _shared_adapter
+
+
+def create_session(adapter: HTTPAdapter = None) -> requests.Session:
+    """Session routed through the shared connection pool"""
+    adapter = adapter or get_shared_adapter()
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
@@ -2,15 +2,18 @@ import json
 import zlib
 import os
 import gogdl.constants as constants
+from gogdl.dl import manifest_cache
 from gogdl.dl.objects import v1, v2
 import shutil
 import time
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from sys import exit, platform
 import logging
 
 PATH_SEPARATOR = os.sep
 TIMEOUT = 10
+# Metadata requests in flight at once, below connection pool size per host
+METADATA_WORKERS = 8
 
 
 def get_json(api_handler, url):
@@ -25,22 +28,59 @@ def get_json(api_handler, url):
     return x.json()
 
 
-def get_zlib_encoded(api_handler, url):
+def map_concurrently(function, items, workers=METADATA_WORKERS):
+    """Calls function for each item on a pool of threads, results keep the order of items"""
+    items = list(items)
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items)), thread_name_prefix='metadata') as pool:
+        return list(pool.map(function, items))
+
+
+def decode_zlib_json(content):
+    try:
+        return json.loads(zlib.decompress(content, 15))
+    except zlib.error:
+        return json.loads(content)
+
+
+def fetch_zlib_encoded(api_handler, url):
+    """Returns (decoded JSON, headers, raw response body), Nones if request failed"""
     retries = 5
     while retries > 0:
         try:
             x = api_handler.session.get(url, timeout=TIMEOUT)
             if not x.ok:
-                return None, None
-            try:
-                decompressed = json.loads(zlib.decompress(x.content, 15))
-            except zlib.error:
-                return x.json(), x.headers
-            return decompressed, x.headers
+                return None, None, None
+            return decode_zlib_json(x.content), x.headers, x.content
         except Exception:
             time.sleep(2)
             retries-=1
-    return None, None
+    return None, None, None
+
+
+def get_zlib_encoded(api_handler, url):
+    data, headers, _ = fetch_zlib_encoded(api_handler, url)
+    return data, headers
+
+
+def get_cached_manifest(api_handler, url, kind, manifest_id):
+    """get_zlib_encoded for content addressed manifests, read through the local manifest cache
+
+    Returns decoded JSON only, there are no headers for cached entries
+    """
+    cache = manifest_cache.get_shared_cache()
+    content = cache.get(kind, manifest_id)
+    if content is not None:
+        try:
+            return decode_zlib_json(content)
+        except ValueError:
+            cache.remove(kind, manifest_id)
+
+    data, _, content = fetch_zlib_encoded(api_handler, url)
+    if data is not None:
+        cache.put(kind, manifest_id, content)
+    return data
 
 
 def prepare_location(path, logger=None):
@@ -67,7 +107,7 @@ def get_secure_link(api_handler, path, gameId, generation=2, logger=None, root=N
         url += f"&root={root}"
 
     try:
-        r = requests.get(url, headers=api_handler.session.headers, timeout=TIMEOUT)
+        r = api_handler.session.get(url, timeout=TIMEOUT)
     except BaseException as exception:
         if logger:
             logger.info(exception)
@@ -138,6 +178,11 @@ def check_free_space(size: int, path: str):
     return size < available_space
 
 
+def support_key(flags):
+    """Tells apart files placed in support directory, in resume and verification keys"""
+    return "support" if "support" in flags else ""
+
+
 def get_range_header(offset, size):
     from_value = offset
     to_value = (int(offset) + int(size)) - 1
@@ -0,0 +1,225 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from typing import Optional
+
+from gogdl.dl.objects import v2
+
+# Stored next to manifest in MANIFESTS_DIR, <game_id> + STATE_SUFFIX
+STATE_SUFFIX = '.state'
+MAGIC = b'GOGDLST\x00'
+VERSION = 1
+
+# magic, version, crc32 of everything after header, md5 of manifest JSON it belongs to,
+# counts of strings, string bytes, files, chunks, links, dirs
+HEADER = struct.Struct('<8sII16s6I')
+# path, product id, flags, first chunk, chunk count, digests present
+FILE_STRUCT = struct.Struct('<6I')
+HAS_MD5 = 1
+HAS_SHA256 = 2
+FLAGS_SEPARATOR = '\n'
+
+
+def meta_digest(manifest_text: str) -> bytes:
+    return hashlib.md5(manifest_text.encode()).digest()
+
+
+def u32_view(buffer, offset, count):
+    """Little endian u32 array at offset, without copying where host byte order allows"""
+    view = memoryview(buffer)[offset:offset + count * 4]
+    if sys.byteorder == 'little':
+        return view.cast('I')
+    values = array('I')
+    values.frombytes(view)
+    values.byteswap()
+    return values
+
+
+class StringTable:
+    def __init__(self):
+        self.index = dict()
+        self.blob = bytearray()
+        self.offsets = array('I', [0])
+
+    def add(self, value: str) -> int:
+        i = self.index.get(value)
+        if i is None:
+            i = len(self.offsets) - 1
+            self.index[value] = i
+            self.blob += value.encode('utf-8')
+            self.offsets.append(len(self.blob))
+        return i
+
+
+def write(path: str, manifest_text: str, files, dirs):
+    """Writes installed files of v2 manifest, links and directories included
+
+    Layout after header, every section padded to 4 bytes:
+    string offsets, string blob, file records, file md5s, file sha256s,
+    chunk md5s, chunk compressed md5s, chunk sizes, chunk compressed sizes,
+    link (path, target) pairs and directory paths.
+    """
+    strings = StringTable()
+    strings.add('')
+    file_records = bytearray()
+    file_md5 = bytearray()
+    file_sha256 = bytearray()
+    chunk_md5 = bytearray()
+    chunk_compressed_md5 = bytearray()
+    chunk_sizes = array('I')
+    chunk_compressed_sizes = array('I')
+    links = array('I')
+    dir_paths = array('I')
+
+    for f in files:
+        if isinstance(f, v2.DepotLink):
+            links.append(strings.add(f.path))
+            links.append(strings.add(f.target))
+            continue
+        digests = 0
+        if f.md5_digest:
+            digests |= HAS_MD5
+        if f.sha256_digest:
+            digests |= HAS_SHA256
+        file_records += FILE_STRUCT.pack(strings.add(f.path), strings.add(f.product_id),
+                                         strings.add(FLAGS_SEPARATOR.join(f.flags)),
+                                         len(chunk_sizes), len(f.chunks), digests)
+        file_md5 += f.md5_digest or bytes(16)
+        file_sha256 += f.sha256_digest or bytes(32)
+        # Columns of ChunkTable are stored as they are
+        chunk_md5 += f.chunks.md5s
+        chunk_compressed_md5 += f.chunks.compressed_md5s
+        chunk_sizes.extend(f.chunks.sizes)
+        chunk_compressed_sizes.extend(f.chunks.compressed_sizes)
+
+    for d in dirs:
+        dir_paths.append(strings.add(d.path))
+
+    if sys.byteorder != 'little':
+        for values in (strings.offsets, chunk_sizes, chunk_compressed_sizes, links, dir_paths):
+            values.byteswap()
+    blob = bytes(strings.blob) + bytes(-len(strings.blob) % 4)
+    body = b''.join((strings.offsets.tobytes(), blob, file_records, file_md5, file_sha256,
+                     chunk_md5, chunk_compressed_md5, chunk_sizes.tobytes(), chunk_compressed_sizes.tobytes(),
+                     links.tobytes(), dir_paths.tobytes()))
+    header = HEADER.pack(MAGIC, VERSION, zlib.crc32(body), meta_digest(manifest_text),
+                         len(strings.offsets) - 1, len(strings.blob), len(file_records) // FILE_STRUCT.size,
+                         len(chunk_sizes), len(links) // 2, len(dir_paths))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(body)
+    os.replace(tmp_path, path)
+
+
+class InstalledState:
+    """Read only view of a state file, tables are sliced from the buffer on access"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        (magic, version, self.crc, self.meta_digest, self.string_count, string_bytes,
+         self.file_count, self.chunk_count, self.link_count, self.dir_count) = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not an installed state file of supported version")
+
+        offset = HEADER.size
+        sections = dict()
+        for name, size in (('string_offsets', (self.string_count + 1) * 4),
+                           ('strings', string_bytes + (-string_bytes % 4)),
+                           ('files', self.file_count * FILE_STRUCT.size),
+                           ('file_md5', self.file_count * 16),
+                           ('file_sha256', self.file_count * 32),
+                           ('chunk_md5', self.chunk_count * 16),
+                           ('chunk_compressed_md5', self.chunk_count * 16),
+                           ('chunk_sizes', self.chunk_count * 4),
+                           ('chunk_compressed_sizes', self.chunk_count * 4),
+                           ('links', self.link_count * 8),
+                           ('dir_paths', self.dir_count * 4)):
+            sections[name] = offset
+            offset += size
+        # Checked before any view of the buffer is taken, so it can still be closed
+        if offset != len(buffer):
+            raise ValueError("Installed state file has unexpected size")
+
+        self.strings_start = sections['strings']
+        self.files_start = sections['files']
+        self.file_md5_start = sections['file_md5']
+        self.file_sha256_start = sections['file_sha256']
+        self.chunk_md5_start = sections['chunk_md5']
+        self.chunk_compressed_md5_start = sections['chunk_compressed_md5']
+        self.string_offsets = u32_view(buffer, sections['string_offsets'], self.string_count + 1)
+        self.chunk_sizes = u32_view(buffer, sections['chunk_sizes'], self.chunk_count)
+        self.chunk_compressed_sizes = u32_view(buffer, sections['chunk_compressed_sizes'], self.chunk_count)
+        self.links = u32_view(buffer, sections['links'], self.link_count * 2)
+        self.dir_paths = u32_view(buffer, sections['dir_paths'], self.dir_count)
+
+    def verify(self) -> bool:
+        with memoryview(self.buffer) as view:
+            return zlib.crc32(view[HEADER.size:]) == self.crc
+
+    def string(self, i: int) -> str:
+        start = self.strings_start + self.string_offsets[i]
+        end = self.strings_start + self.string_offsets[i + 1]
+        return bytes(self.buffer[start:end]).decode('utf-8')
+
+    def get_files(self) -> list:
+        """DepotFiles in the order they were written, followed by DepotLinks"""
+        buffer = self.buffer
+        files = list()
+        chunk_md5 = self.chunk_md5_start
+        compressed_md5 = self.chunk_compressed_md5_start
+        for i in range(self.file_count):
+            path, product, flags, first, count, digests = FILE_STRUCT.unpack_from(buffer, self.files_start + i * FILE_STRUCT.size)
+            chunks = v2.ChunkTable(bytes(buffer[chunk_md5 + first * 16:chunk_md5 + (first + count) * 16]),
+                                   bytes(buffer[compressed_md5 + first * 16:compressed_md5 + (first + count) * 16]),
+                                   array('I', self.chunk_sizes[first:first + count]),
+                                   array('I', self.chunk_compressed_sizes[first:first + count]))
+            md5 = sha256 = None
+            if digests & HAS_MD5:
+                md5 = bytes(buffer[self.file_md5_start + i * 16:self.file_md5_start + i * 16 + 16])
+            if digests & HAS_SHA256:
+                sha256 = bytes(buffer[self.file_sha256_start + i * 32:self.file_sha256_start + i * 32 + 32])
+            flags = self.string(flags)
+            files.append(v2.DepotFile.from_state(self.string(path), flags.split(FLAGS_SEPARATOR) if flags else (),
+                                                 chunks, md5, sha256, self.string(product)))
+        for i in range(self.link_count):
+            files.append(v2.DepotLink({'path': self.string(self.links[i * 2]), 'target': self.string(self.links[i * 2 + 1])}))
+        return files
+
+    def get_dirs(self) -> list:
+        return [v2.DepotDirectory({'path': self.string(i)}) for i in self.dir_paths]
+
+    def release(self):
+        for view in (self.string_offsets, self.chunk_sizes, self.chunk_compressed_sizes, self.links, self.dir_paths):
+            if isinstance(view, memoryview):
+                view.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+def load(path: str, manifest_text: Optional[str] = None) -> Optional[InstalledState]:
+    """Maps state file, None if it's missing, damaged or doesn't belong to manifest_text"""
+    logger = logging.getLogger("INSTALLED_STATE")
+    try:
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        state = InstalledState(buffer)
+    except (ValueError, struct.error) as e:
+        logger.warning(f"Ignoring installed state {path}: {e}")
+        buffer.close()
+        return None
+    if not state.verify() or (manifest_text is not None and state.meta_digest != meta_digest(manifest_text)):
+        logger.warning(f"Ignoring installed state {path}, it doesn't match installed manifest")
+        state.release()
+        return None
+    return state
@@ -43,7 +43,7 @@ class DependenciesManager:
 
     def get_files_for_depot_manifest(self, manifest):
         url = f'{constants.GOG_CDN}/content-system/v2/dependencies/meta/{dl_utils.galaxy_path(manifest)}'
-        manifest = dl_utils.get_zlib_encoded(self.api, url)[0]
+        manifest = dl_utils.get_cached_manifest(self.api, url, 'dependencies', manifest)
 
         return get_depot_list(manifest, 'redist')
 
@@ -156,10 +156,10 @@ class DependenciesDiff(BaseDiff):
                 comparison.new.append(new_file)
             else:
                 if len(new_file.chunks) == 1 and len(old_file.chunks) == 1:
-                    if new_file.chunks[0]["md5"] != old_file.chunks[0]["md5"]:
+                    if new_file.chunks.md5_digest(0) != old_file.chunks.md5_digest(0):
                         comparison.changed.append(new_file)
                 else:
-                    if (new_file.md5 and old_file.md5 and new_file.md5 != old_file.md5) or (new_file.sha256 and old_file.sha256 != new_file.sha256):
+                    if (new_file.md5_digest and old_file.md5_digest and new_file.md5_digest != old_file.md5_digest) or (new_file.sha256_digest and old_file.sha256_digest != new_file.sha256_digest):
                         comparison.changed.append(v2.FileDiff.compare(new_file, old_file))
                     elif len(new_file.chunks) != len(old_file.chunks):
                         comparison.changed.append(v2.FileDiff.compare(new_file, old_file))
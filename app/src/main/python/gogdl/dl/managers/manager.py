@@ -31,12 +31,21 @@ class AndroidManager:
         self.game_id = arguments.id
         self.branch = getattr(arguments, 'branch', None)
 
-        # Use a reasonable number of threads for Android
+        # Upper bound only, executor adapts requests in flight to the connection
         if hasattr(arguments, "workers_count"):
-            self.allowed_threads = min(int(arguments.workers_count), 4)  # Limit threads on mobile
+            self.allowed_threads = max(int(arguments.workers_count), 1)
         else:
             self.allowed_threads = 2  # Conservative default for Android
 
+        if hasattr(arguments, "writers_count"):
+            self.allowed_writers = max(int(arguments.writers_count), 1)
+        else:
+            self.allowed_writers = 2
+
+        # Budget of chunks cached between files, in bytes, executor default if not set
+        chunk_cache_size = getattr(arguments, "chunk_cache_size", None)
+        self.chunk_cache_size = max(int(chunk_cache_size), 0) * 1024 * 1024 if chunk_cache_size is not None else None
+
         self.logger = logging.getLogger("AndroidManager")
 
     def download(self):
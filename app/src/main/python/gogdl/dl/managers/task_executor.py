@@ -1,30 +1,60 @@
+import hashlib
+import itertools
 import logging
 import os
+import shutil
 import signal
-import time
 from sys import exit
 from threading import Thread
 from collections import deque, Counter
-from queue import Queue  # Use threading.Queue instead of multiprocessing.Queue
-from threading import Condition
+from queue import Queue, Empty  # Use threading.Queue instead of multiprocessing.Queue
+from threading import Condition, Event
 import tempfile
 from typing import Union
-from gogdl.dl import dl_utils
+from gogdl.dl import dl_utils, cancellation, connection_pool
+from gogdl.dl.concurrency import ConcurrencyController, memory_limit
+from gogdl.dl.chunk_journal import ChunkJournal
+from gogdl.dl.chunk_cache import ChunkCache, MemoryChunks, CHUNK_CACHED, CHUNK_OFFLOAD, DISK_BUDGET, MEMORY_BUDGET
 
 from gogdl.dl.dl_utils import get_readable_size
-from gogdl.dl.progressbar import ProgressBar
+from gogdl.dl.progressbar import ProgressBar, SpeedCounter
 from gogdl.dl.workers import task_executor
 from gogdl.dl.objects import generic, v2, v1, linux
 
+# Chunk requests in flight when download starts
+INITIAL_CONCURRENCY = 2
+# Temp files kept per allowed request in flight
+TEMP_FILES_PER_REQUEST = 4
+# Upper bound of xdelta patches applied at once
+MAX_PATCH_WORKERS = 4
+# Tasks planned ahead of results collector
+MAX_PLANNED_TASKS = 16384
+
+
 class ExecutingManager:
-    def __init__(self, api_handler, allowed_threads, path, support, diff, secure_links, game_id=None) -> None:
+    def __init__(self, api_handler, allowed_threads, path, support, diff, secure_links, game_id=None, writers_count=1, cancel_token=None,
+                 cache_budget=None, memory_cache_budget=None) -> None:
         self.api_handler = api_handler
-        self.allowed_threads = allowed_threads
+        # Upper bound of download workers, requests in flight adapt within it
+        self.allowed_threads = max(int(allowed_threads), 1)
+        self.concurrency = ConcurrencyController(min(self.allowed_threads, INITIAL_CONCURRENCY),
+                                                 min(self.allowed_threads, memory_limit()))
+        self.writers_count = max(int(writers_count), 1)
         self.path = path
         self.resume_file = os.path.join(path, '.gogdl-resume')
-        self.game_id = game_id  # Store game_id for cancellation checking
+        self.chunk_journal = ChunkJournal(os.path.join(path, '.gogdl-resume-chunks'))
+        # Journal entries verified during setup, carried over when journal is reopened
+        self.journal_keep = list()
+        self.game_id = game_id
+        # Registered per game, so the Android bridge can cancel it with cancellation.cancel(game_id)
+        self.cancel_token = cancel_token or cancellation.register(game_id)
         self.support = support or os.path.join(path, 'gog-support')
         self.cache = os.path.join(path, '.gogdl-download-cache')
+        # Byte budgets of chunks shared between files, kept on disk and in RAM
+        self.cache_budget = DISK_BUDGET if cache_budget is None else cache_budget
+        self.memory_cache_budget = MEMORY_BUDGET if memory_cache_budget is None else memory_cache_budget
+        self.chunk_cache = None
+        self.memory_chunks = MemoryChunks()
         self.diff: generic.BaseDiff = diff
         self.secure_links = secure_links
         self.logger = logging.getLogger("TASK_EXEC")
@@ -32,26 +62,47 @@ class ExecutingManager:
 
         self.download_size = 0
         self.disk_size = 0
+        self.peak_rss = 0
 
         # Use temporary directory instead of shared memory on Android
         self.temp_dir = tempfile.mkdtemp(prefix='gogdl_')
         self.temp_files = deque()
+        self.temp_files_created = 0
+        self.max_temp_files = 0
         self.hash_map = dict()
         self.v2_chunks_to_download = deque()
         self.v1_chunks_to_download = deque()
         self.linux_chunks_to_download = deque()
         self.tasks = deque()
         self.active_tasks = 0
+        # Generator of TaskGroups, consumed by planner thread
+        self.plan = iter(())
+        # Set once planner handed over every task
+        self.planned = False
 
         self.processed_items = 0
         self.items_to_complete = 0
 
         self.download_workers = list()
-        self.writer_worker = None
+        self.writer_workers = list()
         self.threads = list()
 
-        self.temp_cond = Condition()
+        # Each file is pinned to a single writer, so writes to the same file stay ordered
+        # while different files are written concurrently
+        self.file_writers = dict()
+        # Last task touching given path, per writer {path: {writer: sequence}}
+        self.path_writes = dict()
+        self.writer_dispatched = [0] * self.writers_count
+        self.writer_completed = [0] * self.writers_count
+        # Writers reserved for applying patches, set up once patches are known
+        self.patch_writers = range(0)
+
         self.task_cond = Condition()
+        self.writer_cond = Condition()
+        # Guards tasks, planned and counts of planned and processed items
+        self.plan_cond = Condition()
+        # Set once all tasks are processed or the run failed
+        self.finished = Event()
         
         self.running = True
 
@@ -61,25 +112,12 @@ class ExecutingManager:
         # Use threading queues instead of multiprocessing
         self.download_queue = Queue()
         self.download_res_queue = Queue()
-        self.writer_queue = Queue()
+        self.writer_queues = [Queue() for _ in range(self.writers_count)]
         self.writer_res_queue = Queue()
         
-        self.download_speed_updates = Queue()
-        self.writer_speed_updates = Queue()
-
-        # Required space for download to succeed
-        required_disk_size_delta = 0
-
-        # This can be either v1 File or v2 DepotFile
-        for f in self.diff.deleted + self.diff.removed_redist:
-            support_flag = generic.TaskFlag.SUPPORT if 'support' in f.flags else generic.TaskFlag.NONE
-            self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.DELETE_FILE | support_flag))
-            if isinstance(f, v1.File):
-                required_disk_size_delta -= f.size
-            elif isinstance(f, v2.DepotFile):
-                required_disk_size_delta -= sum([ch['size'] for ch in f.chunks])
-
-        current_tmp_size = required_disk_size_delta
+        # Each worker accounts its own throughput, progress bar samples them
+        self.download_counters = [SpeedCounter(f'download-{i}') for i in range(self.concurrency.maximum)]
+        self.writer_counters = [SpeedCounter(f'writer-{i}') for i in range(self.writers_count)]
 
         shared_chunks_counter = Counter()
         completed_files = set()
@@ -87,19 +125,19 @@ class ExecutingManager:
         missing_files = set()
         mismatched_files = set()
 
-        downloaded_v1 = dict()
-        downloaded_linux = dict()
-        cached = set()
-        
-        # Re-use caches
+        # Re-use caches, {md5: size}
+        cached = dict()
         if os.path.exists(self.cache):
             for cache_file in os.listdir(self.cache):
-                cached.add(cache_file)
+                try:
+                    cached[cache_file] = os.path.getsize(os.path.join(self.cache, cache_file))
+                except OSError:
+                    continue
 
         self.biggest_chunk = 0
         # Find biggest chunk to optimize how much memory is 'wasted' per chunk
         # Also create hashmap for those files
-        for f in self.diff.new + self.diff.changed + self.diff.redist:
+        for f in self.diff_files():
             if isinstance(f, v1.File):
                 self.hash_map.update({f.path.lower(): f.hash})
 
@@ -107,32 +145,32 @@ class ExecutingManager:
                 self.hash_map.update({f.path.lower(): f.hash})
 
             elif isinstance(f, v2.DepotFile):
-                first_chunk_checksum = f.chunks[0]['md5'] if len(f.chunks) else None
+                first_chunk_checksum = f.chunks[0].md5 if len(f.chunks) else None
                 checksum = f.md5 or f.sha256 or first_chunk_checksum
                 self.hash_map.update({f.path.lower(): checksum})
                 for i, chunk in enumerate(f.chunks):
-                    shared_chunks_counter[chunk["compressedMd5"]] += 1
-                    if self.biggest_chunk < chunk["size"]:
-                        self.biggest_chunk = chunk["size"]
+                    shared_chunks_counter[chunk.compressed_md5] += 1
+                    if self.biggest_chunk < chunk.size:
+                        self.biggest_chunk = chunk.size
 
             elif isinstance(f, v2.FileDiff):
-                first_chunk_checksum = f.file.chunks[0]['md5'] if len(f.file.chunks) else None
+                first_chunk_checksum = f.file.chunks[0].md5 if len(f.file.chunks) else None
                 checksum = f.file.md5 or f.file.sha256 or first_chunk_checksum
                 self.hash_map.update({f.file.path.lower(): checksum})
                 for i, chunk in enumerate(f.file.chunks):
-                    if chunk.get("old_offset") is None:
-                        shared_chunks_counter[chunk["compressedMd5"]] += 1
-                        if self.biggest_chunk < chunk["size"]:
-                            self.biggest_chunk = chunk["size"]
+                    if i not in f.old_offsets:
+                        shared_chunks_counter[chunk.compressed_md5] += 1
+                        if self.biggest_chunk < chunk.size:
+                            self.biggest_chunk = chunk.size
             
             elif isinstance(f, v2.FilePatchDiff):
-                first_chunk_checksum = f.new_file.chunks[0]['md5'] if len(f.new_file.chunks) else None
+                first_chunk_checksum = f.new_file.chunks[0].md5 if len(f.new_file.chunks) else None
                 checksum = f.new_file.md5 or f.new_file.sha256 or first_chunk_checksum
                 self.hash_map.update({f.new_file.path.lower(): checksum})
                 for chunk in f.chunks:
-                    shared_chunks_counter[chunk["compressedMd5"]] += 1
-                    if self.biggest_chunk < chunk["size"]:
-                        self.biggest_chunk = chunk["size"]
+                    shared_chunks_counter[chunk.compressed_md5] += 1
+                    if self.biggest_chunk < chunk.size:
+                        self.biggest_chunk = chunk.size
 
 
         if not self.biggest_chunk:
@@ -176,33 +214,208 @@ class ExecutingManager:
             except Exception as e:
                 self.logger.error(f"Unable to resume download, continuing as normal {e}")
 
-        # Create temp files for chunks instead of using shared memory
-        for i in range(self.allowed_threads * 4):  # More temp files than threads
-            temp_file = os.path.join(self.temp_dir, f'chunk_{i}.tmp')
-            self.temp_files.append(temp_file)
+        resumed_chunks = dict()
+        try:
+            resumed_chunks = self.load_resumed_chunks(shared_chunks_counter, completed_files, mismatched_files, missing_files)
+        except Exception as e:
+            self.logger.error(f"Unable to resume from chunk journal, continuing as normal {e}")
+            self.journal_keep = list()
+
+        reusable = lambda path: path.lower() not in mismatched_files and path.lower() not in missing_files
+        # Sizes are known before any task exists, tasks themselves are planned while downloading
+        measure_cache = ChunkCache(Counter(shared_chunks_counter), self.cache_budget, self.memory_cache_budget, dict(cached))
+        required_disk_size_delta, patch_peaks = self.measure(measure_cache, completed_files, reusable, resumed_chunks)
+        self.chunk_cache = ChunkCache(shared_chunks_counter, self.cache_budget, self.memory_cache_budget, cached)
+        for md5 in self.chunk_cache.dropped:
+            try:
+                os.remove(os.path.join(self.cache, md5))
+            except OSError as e:
+                self.logger.warning(f"Unable to remove cached chunk {md5} {e}")
+        self.plan = self.plan_tasks(self.chunk_cache, completed_files, reusable, resumed_chunks)
+
+        required_disk_size_delta += self.setup_patch_writers(patch_peaks, required_disk_size_delta)
+
+        # Temp files for chunks instead of shared memory, pool follows concurrency limit
+        # as long as temp directory can hold them next to the download itself
+        _, _, temp_space = shutil.disk_usage(self.temp_dir)
+        if os.path.exists(self.path) and os.stat(self.path).st_dev == os.stat(self.temp_dir).st_dev:
+            temp_space -= max(required_disk_size_delta, 0)
+        self.max_temp_files = max(temp_space // self.biggest_chunk, 1)
+        self.grow_temp_files()
+
+        print(get_readable_size(self.download_size), self.download_size)
+        print(get_readable_size(required_disk_size_delta), required_disk_size_delta)
+                
+        return dl_utils.check_free_space(required_disk_size_delta, self.path)
+
+    def diff_files(self):
+        """Files to be downloaded or updated, in the order they are planned"""
+        return itertools.chain(self.diff.new, self.diff.changed, self.diff.redist)
+
+    def measure(self, chunk_cache, completed_files, reusable, resumed_chunks):
+        """Sums up download and disk size without creating any task
+
+        Walks files the way plan_tasks does, with its own ChunkCache set up the same as
+        the one plan_tasks gets, so both make the same decisions. Returns disk space the
+        download needs at its peak, along with space taken by each patch while it's applied,
+        its .delta and output.
+        """
+        # Required space for download to succeed
+        required_disk_size_delta = 0
+        patch_peaks = []
+
+        # This can be either v1 File or v2 DepotFile
+        for f in itertools.chain(self.diff.deleted, self.diff.removed_redist):
+            if isinstance(f, v1.File):
+                required_disk_size_delta -= f.size
+            elif isinstance(f, v2.DepotFile):
+                required_disk_size_delta -= f.chunks.total_size()
+
+        current_tmp_size = required_disk_size_delta
+        downloaded_v1 = set()
+        downloaded_linux = set()
+
+        for f in self.diff_files():
+            if isinstance(f, v1.File):
+                if f.size == 0:
+                    continue
+                if f.path.lower() in completed_files:
+                    downloaded_v1.add(f.hash)
+                    continue
+                required_disk_size_delta += f.size
+                if f.hash in downloaded_v1:
+                    continue
+                support = dl_utils.support_key(f.flags)
+                resumed = resumed_chunks.get((support, f.path.lower()), ())
+                for i, chunk_offset in enumerate(range(0, f.size, self.biggest_chunk)):
+                    if i not in resumed:
+                        chunk_size = min(self.biggest_chunk, f.size - chunk_offset)
+                        self.download_size += chunk_size
+                        self.disk_size += chunk_size
+                downloaded_v1.add(f.hash)
+
+            elif isinstance(f, linux.LinuxFile):
+                if f.size == 0:
+                    continue
+                linux_key = (f.hash, f.size)
+                if f.path.lower() in completed_files:
+                    downloaded_linux.add(linux_key)
+                    continue
+                required_disk_size_delta += f.size
+                if linux_key in downloaded_linux:
+                    continue
+                self.download_size += f.compressed_size
+                self.disk_size += f.size
+                downloaded_linux.add(linux_key)
+
+            elif isinstance(f, v2.DepotFile):
+                if not len(f.chunks) or f.path.lower() in completed_files:
+                    continue
+                support = dl_utils.support_key(f.flags)
+                resumed = resumed_chunks.get((support, f.path.lower()), ())
+                for i, chunk in enumerate(f.chunks):
+                    if i in resumed:
+                        continue
+                    route = chunk_cache.route(chunk)
+                    added, freed = route.disk_usage(chunk.size)
+                    if route.source != CHUNK_CACHED:
+                        self.download_size += chunk.compressed_size
+                    self.disk_size += chunk.size
+                    current_tmp_size += chunk.size + added - freed
+
+            elif isinstance(f, v2.FileDiff):
+                if f.file.path.lower() in completed_files:
+                    continue
+                can_reuse = reusable(f.file.path)
+                use_tmp = can_reuse and bool(f.old_offsets)
+                support = dl_utils.support_key(f.file.flags)
+                target_path = f.file.path + ".tmp" if use_tmp else f.file.path
+                resumed = resumed_chunks.get((support, target_path.lower()), ())
+                file_size = f.file.chunks.total_size()
+                for i, chunk in enumerate(f.file.chunks):
+                    if i in resumed or (i in f.old_offsets and can_reuse):
+                        continue
+                    route = chunk_cache.route(chunk)
+                    added, freed = route.disk_usage(chunk.size)
+                    if route.source != CHUNK_CACHED:
+                        self.download_size += chunk.compressed_size
+                    current_tmp_size += added - freed
+                current_tmp_size += file_size
+                required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
+                if use_tmp:
+                    current_tmp_size -= file_size
+                self.disk_size += file_size
+
+            elif isinstance(f, v2.FilePatchDiff):
+                if f.target.lower() in completed_files:
+                    continue
+                out_file_size = f.new_file.chunks.total_size()
+                old_file_size = f.old_file.chunks.total_size()
+                patch_size = f.chunks.total_size()
+                for chunk in f.chunks:
+                    route = chunk_cache.route(chunk)
+                    added, freed = route.disk_usage(chunk.size)
+                    current_tmp_size += added
+                    required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
+                    if route.source != CHUNK_CACHED:
+                        self.download_size += chunk.compressed_size
+                    current_tmp_size -= freed
+
+                self.disk_size += patch_size
+                # .delta is downloaded, then output written next to it, .delta and old file removed
+                for change in (patch_size, out_file_size, -patch_size, -old_file_size):
+                    current_tmp_size += change
+                    required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
+                self.disk_size += out_file_size
+                patch_peaks.append(patch_size + out_file_size)
+
+            required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
+
+        return required_disk_size_delta, patch_peaks
+
+    def plan_tasks(self, chunk_cache, completed_files, reusable, resumed_chunks):
+        """Yields TaskGroup of each file, in the order they are to be written
+
+        Generator is consumed by planner thread while downloads already run, so only
+        tasks of files not reached yet by writers are held in memory.
+        """
+        downloaded_v1 = dict()
+        downloaded_linux = dict()
+        installer_ranges = self.plan_installer_ranges(completed_files)
+        requested_ranges = set()
+
+        group = generic.TaskGroup()
+        # This can be either v1 File or v2 DepotFile
+        for f in itertools.chain(self.diff.deleted, self.diff.removed_redist):
+            support_flag = generic.TaskFlag.SUPPORT if 'support' in f.flags else generic.TaskFlag.NONE
+            group.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.DELETE_FILE | support_flag))
+        if group.tasks:
+            yield group
 
         # Create tasks for each chunk
-        for f in self.diff.new + self.diff.changed + self.diff.redist:
+        for f in self.diff_files():
+            group = generic.TaskGroup()
+            tasks = group.tasks
             if isinstance(f, v1.File):
                 support_flag = generic.TaskFlag.SUPPORT if 'support' in f.flags else generic.TaskFlag.NONE
                 if f.size == 0:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CREATE_FILE | support_flag))
+                    tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CREATE_FILE | support_flag))
+                    yield group
                     continue
 
                 if f.path.lower() in completed_files:
                     downloaded_v1[f.hash] = f
                     continue
 
-                required_disk_size_delta += f.size
                 # In case of same file we can copy it over
                 if f.hash in downloaded_v1:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.COPY_FILE | support_flag, old_flags=generic.TaskFlag.SUPPORT if 'support' in downloaded_v1[f.hash].flags else generic.TaskFlag.NONE, old_file=downloaded_v1[f.hash].path))
+                    tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.COPY_FILE | support_flag, old_flags=generic.TaskFlag.SUPPORT if 'support' in downloaded_v1[f.hash].flags else generic.TaskFlag.NONE, old_file=downloaded_v1[f.hash].path))
                     if 'executable' in f.flags:
-                        self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE | support_flag))
+                        tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE | support_flag))
+                    yield group
                     continue
-                self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE | support_flag))
-                self.download_size += f.size
-                self.disk_size += f.size
+                tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE | support_flag, size=f.size))
+                resumed = resumed_chunks.get(('support' if support_flag else '', f.path.lower()), ())
                 size_left = f.size
                 chunk_offset = 0
                 i = 0
@@ -211,244 +424,363 @@ class ExecutingManager:
                     chunk_size = min(self.biggest_chunk, size_left)
                     offset = f.offset + chunk_offset
                     
-                    task = generic.V1Task(f.product_id, i, offset, chunk_size, f.hash)
-                    self.tasks.append(task)
-                    self.v1_chunks_to_download.append((f.product_id, task.compressed_md5, offset, chunk_size))
+                    if i not in resumed:
+                        task = generic.V1Task(f.product_id, i, offset, chunk_size, f.hash, file_offset=chunk_offset)
+                        tasks.append(task)
+                        group.v1_downloads.append((f.product_id, task.compressed_md5, offset, chunk_size))
 
                     chunk_offset += chunk_size
                     size_left -= chunk_size
                     i += 1
 
-                self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CLOSE_FILE | support_flag))
+                tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CLOSE_FILE | support_flag))
                 if 'executable' in f.flags:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE | support_flag))
+                    tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE | support_flag))
                 downloaded_v1[f.hash] = f
 
             elif isinstance(f, linux.LinuxFile):
                 if f.size == 0:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CREATE_FILE))
+                    tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CREATE_FILE))
+                    yield group
                     continue
                 
+                # CRC32 alone isn't unique enough across tens of thousands of files
+                linux_key = (f.hash, f.size)
                 if f.path.lower() in completed_files:
-                    downloaded_linux[f.hash] = f
+                    downloaded_linux[linux_key] = f
                     continue
                 
-                required_disk_size_delta += f.size
-                if f.hash in downloaded_linux:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.COPY_FILE, old_flags=generic.TaskFlag.NONE, old_file=downloaded_linux[f.hash].path))
+                if linux_key in downloaded_linux:
+                    tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.COPY_FILE, old_flags=generic.TaskFlag.NONE, old_file=downloaded_linux[linux_key].path))
                     if 'executable' in f.flags:
-                        self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE))
+                        tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE))
+                    yield group
                     continue
                 
-                self.tasks.append(generic.FileTask(f.path+'.tmp', flags=generic.TaskFlag.OPEN_FILE))
-                self.download_size += f.compressed_size
-                self.disk_size += f.size
-                size_left = f.compressed_size
-                chunk_offset = 0
-                i = 0
-                # Split V1 file by chunks, so we can store it in temp files
-                while size_left:
-                    chunk_size = min(self.biggest_chunk, size_left)
-                    offset = f.offset + chunk_offset
-                    
-                    task = generic.V1Task(f.product, i, offset, chunk_size, f.hash)
-                    self.tasks.append(task)
-                    self.linux_chunks_to_download.append((f.product, task.compressed_md5, offset, chunk_size))
-
-                    chunk_offset += chunk_size
-                    size_left -= chunk_size
-                    i += 1
-
-                self.tasks.append(generic.FileTask(f.path + '.tmp', flags=generic.TaskFlag.CLOSE_FILE))
-                if f.compression:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE))
-                    self.tasks.append(generic.ChunkTask(f.product, 0, f.hash+"_dec", f.hash+"_dec", f.compressed_size, f.compressed_size, True, False, 0, old_flags=generic.TaskFlag.ZIP_DEC, old_file=f.path+'.tmp'))
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CLOSE_FILE))
-                    self.tasks.append(generic.FileTask(f.path + '.tmp', flags=generic.TaskFlag.DELETE_FILE))
-                else:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.DELETE_FILE | generic.TaskFlag.RENAME_FILE, old_file=f.path+'.tmp'))
-
+                tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE, size=f.size))
+                # Entry is inflated by download worker straight into destination, deflate
+                # stream can't be split into chunks. Adjacent entries share a single request,
+                # queued along with the first of them that is planned
+                tasks.append(self.installer_entry_task(f))
+                installer_range = installer_ranges[f.path.lower()]
+                if id(installer_range) not in requested_ranges:
+                    requested_ranges.add(id(installer_range))
+                    group.linux_downloads.append(installer_range)
+
+                tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CLOSE_FILE))
                 if 'executable' in f.flags:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE))
-                downloaded_linux[f.hash] = f
+                    tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE))
+                downloaded_linux[linux_key] = f
 
             elif isinstance(f, v2.DepotFile):
                 support_flag = generic.TaskFlag.SUPPORT if 'support' in f.flags else generic.TaskFlag.NONE
                 if not len(f.chunks):
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CREATE_FILE | support_flag))
+                    tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CREATE_FILE | support_flag))
+                    yield group
                     continue
                 if f.path.lower() in completed_files:
                     continue
-                self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE | support_flag))
+                file_dest = self.support if support_flag else self.path
+                file_size = f.chunks.total_size()
+                tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE | support_flag, size=file_size))
+                resumed = resumed_chunks.get(('support' if support_flag else '', f.path.lower()), ())
+                chunk_offset = 0
                 for i, chunk in enumerate(f.chunks):
-                    new_task = generic.ChunkTask(f.product_id, i, chunk["compressedMd5"], chunk["md5"], chunk["size"], chunk["compressedSize"])
-                    is_cached = chunk["md5"] in cached
-                    if shared_chunks_counter[chunk["compressedMd5"]] > 1 and not is_cached:
-                        self.v2_chunks_to_download.append((f.product_id, chunk["compressedMd5"]))
-                        self.download_size += chunk['compressedSize']
-                        new_task.offload_to_cache = True
-                        new_task.cleanup = True
-                        cached.add(chunk["md5"])
-                        current_tmp_size += chunk['size']
-                    elif is_cached:
-                        new_task.old_offset = 0
-                        # This can safely be absolute path, due to
-                        # how os.path.join works in Writer
-                        new_task.old_file = os.path.join(self.cache, chunk["md5"])
-                    else:
-                        self.v2_chunks_to_download.append((f.product_id, chunk["compressedMd5"]))
-                        self.download_size += chunk['compressedSize']
-                    self.disk_size += chunk['size']
-                    current_tmp_size += chunk['size']
-                    shared_chunks_counter[chunk["compressedMd5"]] -= 1
-                    new_task.cleanup = True
-                    self.tasks.append(new_task)
-                    if is_cached and shared_chunks_counter[chunk["compressedMd5"]] == 0:
-                        cached.remove(chunk["md5"])
-                        self.tasks.append(generic.FileTask(os.path.join(self.cache, chunk["md5"]), flags=generic.TaskFlag.DELETE_FILE))
-                        current_tmp_size -= chunk['size']
-                self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CLOSE_FILE | support_flag))
+                    new_task = generic.ChunkTask(f.product_id, i, chunk.compressed_md5, chunk.md5, chunk.size, chunk.compressed_size, offset=chunk_offset)
+                    chunk_offset += chunk.size
+                    if i in resumed:
+                        continue
+                    self.add_chunk_task(group, new_task, chunk_cache.route(chunk), os.path.join(file_dest, f.path))
+                tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CLOSE_FILE | support_flag))
                 if 'executable' in f.flags:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE | support_flag))
+                    tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE | support_flag))
 
             elif isinstance(f, v2.FileDiff):
-                chunk_tasks = []
-                reused = 0
-                file_size = 0
                 support_flag = generic.TaskFlag.SUPPORT if 'support' in f.file.flags else generic.TaskFlag.NONE
                 old_support_flag = generic.TaskFlag.SUPPORT if 'support' in f.old_file_flags else generic.TaskFlag.NONE
                 if f.file.path.lower() in completed_files:
                     continue
+                can_reuse = reusable(f.file.path)
+                # Chunks are written into .tmp file when parts of the old file are reused
+                use_tmp = can_reuse and bool(f.old_offsets)
+                target_path = f.file.path + ".tmp" if use_tmp else f.file.path
+                resumed = resumed_chunks.get(('support' if support_flag else '', target_path.lower()), ())
+                tasks.append(generic.FileTask(target_path, flags=generic.TaskFlag.OPEN_FILE | support_flag, size=f.file.chunks.total_size()))
+                target_path = os.path.join(self.support if support_flag else self.path, target_path)
+                file_size = 0
                 for i, chunk in enumerate(f.file.chunks):
-                    chunk_task = generic.ChunkTask(f.file.product_id, i, chunk["compressedMd5"], chunk["md5"], chunk["size"], chunk["compressedSize"])
-                    file_size += chunk['size']
-                    if chunk.get("old_offset") is not None and f.file.path.lower() not in mismatched_files and f.file.path.lower() not in missing_files:
-                        chunk_task.old_offset = chunk["old_offset"]
+                    chunk_task = generic.ChunkTask(f.file.product_id, i, chunk.compressed_md5, chunk.md5, chunk.size, chunk.compressed_size, offset=file_size)
+                    file_size += chunk.size
+                    if i in resumed:
+                        continue
+                    if i in f.old_offsets and can_reuse:
+                        chunk_task.old_offset = f.old_offsets[i]
                         chunk_task.old_flags = old_support_flag  
                         chunk_task.old_file = f.file.path
-                        reused += 1
 
-                        chunk_tasks.append(chunk_task)
+                        tasks.append(chunk_task)
                     else:
-                        is_cached = chunk["md5"] in cached
-                        if shared_chunks_counter[chunk["compressedMd5"]] > 1 and not is_cached:
-                            self.v2_chunks_to_download.append((f.file.product_id, chunk["compressedMd5"]))
-                            self.download_size += chunk['compressedSize']
-                            chunk_task.offload_to_cache = True
-                            cached.add(chunk["md5"])
-                            current_tmp_size += chunk['size']
-                        elif is_cached:
-                            chunk_task.old_offset = 0
-                            chunk_task.old_file = os.path.join(self.cache, chunk["md5"])
-                        else:
-                            self.v2_chunks_to_download.append((f.file.product_id, chunk["compressedMd5"]))
-                            self.download_size += chunk['compressedSize']
-
-                        shared_chunks_counter[chunk["compressedMd5"]] -= 1
-                        chunk_task.cleanup = True
-                        chunk_tasks.append(chunk_task)
-                        if is_cached and shared_chunks_counter[chunk["compressedMd5"]] == 0:
-                            cached.remove(chunk["md5"])
-                            self.tasks.append(generic.FileTask(os.path.join(self.cache, chunk["md5"]), flags=generic.TaskFlag.DELETE_FILE))
-                            current_tmp_size -= chunk['size']
-                current_tmp_size += file_size
-                required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
-                if reused:
-                    self.tasks.append(generic.FileTask(f.file.path + ".tmp", flags=generic.TaskFlag.OPEN_FILE | support_flag))
-                    self.tasks.extend(chunk_tasks)
-                    self.tasks.append(generic.FileTask(f.file.path + ".tmp", flags=generic.TaskFlag.CLOSE_FILE | support_flag))
-                    self.tasks.append(generic.FileTask(f.file.path, flags=generic.TaskFlag.RENAME_FILE | generic.TaskFlag.DELETE_FILE | support_flag, old_file=f.file.path + ".tmp"))
-                    current_tmp_size -= file_size
+                        self.add_chunk_task(group, chunk_task, chunk_cache.route(chunk), target_path)
+                if use_tmp:
+                    tasks.append(generic.FileTask(f.file.path + ".tmp", flags=generic.TaskFlag.CLOSE_FILE | support_flag))
+                    tasks.append(generic.FileTask(f.file.path, flags=generic.TaskFlag.RENAME_FILE | generic.TaskFlag.DELETE_FILE | support_flag, old_file=f.file.path + ".tmp"))
                 else:
-                    self.tasks.append(generic.FileTask(f.file.path, flags=generic.TaskFlag.OPEN_FILE | support_flag))
-                    self.tasks.extend(chunk_tasks)
-                    self.tasks.append(generic.FileTask(f.file.path, flags=generic.TaskFlag.CLOSE_FILE | support_flag))
+                    tasks.append(generic.FileTask(f.file.path, flags=generic.TaskFlag.CLOSE_FILE | support_flag))
                 if 'executable' in f.file.flags:
-                    self.tasks.append(generic.FileTask(f.file.path, flags=generic.TaskFlag.MAKE_EXE | support_flag))
-                self.disk_size += file_size
+                    tasks.append(generic.FileTask(f.file.path, flags=generic.TaskFlag.MAKE_EXE | support_flag))
 
             elif isinstance(f, v2.FilePatchDiff):
-                chunk_tasks = []
                 patch_size = 0
-                old_file_size = 0
-                out_file_size = 0
                 if f.target.lower() in completed_files:
                     continue
 
-                # Calculate output size  
-                for chunk in f.new_file.chunks:
-                    out_file_size += chunk['size']
-
-                # Calculate old size  
-                for chunk in f.old_file.chunks:
-                    old_file_size += chunk['size']
-
-                # Make chunk tasks
-                for i, chunk in enumerate(f.chunks):
-                    chunk_task = generic.ChunkTask(f'{f.new_file.product_id}_patch', i, chunk['compressedMd5'], chunk['md5'], chunk['size'], chunk['compressedSize'])
-                    chunk_task.cleanup = True
-                    patch_size += chunk['size']
-                    is_cached = chunk["md5"] in cached
-                    if shared_chunks_counter[chunk["compressedMd5"]] > 1 and not is_cached:
-                        self.v2_chunks_to_download.append((f'{f.new_file.product_id}_patch', chunk["compressedMd5"]))
-                        chunk_task.offload_to_cache = True
-                        cached.add(chunk["md5"])
-                        self.download_size += chunk['compressedSize']
-                        current_tmp_size += chunk['size']
-                        required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
-                    elif is_cached:
-                        chunk_task.old_offset = 0
-                        chunk_task.old_file = os.path.join(self.cache, chunk["md5"])
-                    else:
-                        self.v2_chunks_to_download.append((f'{f.new_file.product_id}_patch', chunk["compressedMd5"]))
-                        self.download_size += chunk['compressedSize']
-                    shared_chunks_counter[chunk['compressedMd5']] -= 1
-                    chunk_tasks.append(chunk_task)
-                    if is_cached and shared_chunks_counter[chunk["compressedMd5"]] == 0:
-                        cached.remove(chunk["md5"])
-                        self.tasks.append(generic.FileTask(os.path.join(self.cache, chunk["md5"]), flags=generic.TaskFlag.DELETE_FILE))
-                        current_tmp_size -= chunk['size']
-
-                self.disk_size += patch_size
-                current_tmp_size += patch_size 
-                required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
-
                 # Download patch
-                self.tasks.append(generic.FileTask(f.target + ".delta", flags=generic.TaskFlag.OPEN_FILE))
-                self.tasks.extend(chunk_tasks)
-                self.tasks.append(generic.FileTask(f.target + ".delta", flags=generic.TaskFlag.CLOSE_FILE))
+                tasks.append(generic.FileTask(f.target + ".delta", flags=generic.TaskFlag.OPEN_FILE, size=f.chunks.total_size()))
+                delta_path = os.path.join(self.path, f.target + ".delta")
+                for i, chunk in enumerate(f.chunks):
+                    chunk_task = generic.ChunkTask(f'{f.new_file.product_id}_patch', i, chunk.compressed_md5, chunk.md5, chunk.size, chunk.compressed_size, offset=patch_size)
+                    patch_size += chunk.size
+                    self.add_chunk_task(group, chunk_task, chunk_cache.route(chunk), delta_path)
+                tasks.append(generic.FileTask(f.target + ".delta", flags=generic.TaskFlag.CLOSE_FILE))
 
-                current_tmp_size += out_file_size
-                required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
-                
                 # Apply patch to .tmp file
-                self.tasks.append(generic.FileTask(f.target + ".tmp", flags=generic.TaskFlag.PATCH, patch_file=(f.target + '.delta'), old_file=f.source))
-                current_tmp_size -= patch_size 
-                required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
+                tasks.append(generic.FileTask(f.target + ".tmp", flags=generic.TaskFlag.PATCH, patch_file=(f.target + '.delta'), old_file=f.source))
                 # Remove patch file
-                self.tasks.append(generic.FileTask(f.target + ".delta", flags=generic.TaskFlag.DELETE_FILE))
-                current_tmp_size -= old_file_size
-                required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
+                tasks.append(generic.FileTask(f.target + ".delta", flags=generic.TaskFlag.DELETE_FILE))
                 # Move new file to old one's location
-                self.tasks.append(generic.FileTask(f.target, flags=generic.TaskFlag.RENAME_FILE | generic.TaskFlag.DELETE_FILE, old_file=f.target + ".tmp"))
-                self.disk_size += out_file_size
+                tasks.append(generic.FileTask(f.target, flags=generic.TaskFlag.RENAME_FILE | generic.TaskFlag.DELETE_FILE, old_file=f.target + ".tmp"))
 
-            required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
-            
-            
+            yield group
+
+        group = generic.TaskGroup()
         for f in self.diff.links:
-            self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CREATE_SYMLINK, old_file=f.target))
+            group.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CREATE_SYMLINK, old_file=f.target))
+        # Left in cache by an interrupted download, but not used by any chunk
+        for md5 in chunk_cache.take_stale():
+            group.tasks.append(generic.FileTask(os.path.join(self.cache, md5), flags=generic.TaskFlag.DELETE_FILE))
+        if group.tasks:
+            yield group
+
+    def plan_installer_ranges(self, completed_files):
+        """Groups Linux installer entries to download into ranged requests
+
+        Picks entries the way plan_tasks does and merges the close ones with
+        InstallerHandler.coalesce_ranges. Returns {path: linux download}, entries
+        of the same request share the download.
+        """
+        entries = dict()
+        downloaded = set()
+        for f in self.diff_files():
+            if not isinstance(f, linux.LinuxFile) or f.size == 0:
+                continue
+            linux_key = (f.hash, f.size)
+            if f.path.lower() in completed_files or linux_key in downloaded:
+                downloaded.add(linux_key)
+                continue
+            downloaded.add(linux_key)
+            entries.setdefault(f.product, []).append(f)
+
+        ranges = dict()
+        for product, files in entries.items():
+            groups = linux.InstallerHandler.coalesce_ranges([(f.offset, f.compressed_size) for f in files])
+            for offset, size, members in groups:
+                installer_entries = [task_executor.InstallerEntry(self.installer_entry_task(files[i]).compressed_md5, files[i].offset,
+                                                                  files[i].compressed_size, os.path.join(self.path, files[i].path),
+                                                                  files[i].compression, int(files[i].hash), files[i].size)
+                                     for i in members]
+                download = (product, installer_entries[0].compressed_sum, offset, size, installer_entries)
+                for i in members:
+                    ranges[files[i].path.lower()] = download
+        return ranges
+
+    @staticmethod
+    def installer_entry_task(f):
+        """V1Task writing Linux installer entry, which download worker writes directly"""
+        # Entries of a range are told apart by CRC32 and size, CRC32 alone isn't unique enough
+        return generic.V1Task(f.product, 0, f.offset, f.size, f'{f.hash}_{f.size}', file_offset=0, direct=True)
+
+    def add_chunk_task(self, group, task, route, destination):
+        """Sets where v2 chunk task takes its data from and adds it to group
+
+        Download of the chunk is queued unless it's read from cache. Cache entries
+        released by route are dropped right after the task.
+        """
+        if route.source == CHUNK_OFFLOAD:
+            group.v2_downloads.append((task.product, task.compressed_md5, None))
+            task.offload_to_cache = True
+        elif route.source == CHUNK_CACHED:
+            task.old_offset = 0
+            # This can safely be absolute path, due to
+            # how os.path.join works in Writer
+            task.old_file = os.path.join(self.cache, task.md5)
+        else:
+            task.direct = True
+            group.v2_downloads.append((task.product, task.compressed_md5, (destination, task.offset, task.md5)))
+        task.in_memory = route.in_memory
+        task.cleanup = True
+        group.tasks.append(task)
+        for release in route.released:
+            flags = generic.TaskFlag.RELEASE_MEM if release.in_memory else generic.TaskFlag.DELETE_FILE
+            group.tasks.append(generic.FileTask(os.path.join(self.cache, release.md5), flags=flags))
+
+    def planner(self):
+        """Feeds planned tasks and downloads to the scheduler and results collector
+
+        Stays at most MAX_PLANNED_TASKS ahead of results collector, a file with more
+        tasks than that is still handed over whole.
+        """
+        self.logger.debug("Starting task planner")
+        for group in self.plan:
+            with self.plan_cond:
+                self.plan_cond.wait_for(lambda: len(self.tasks) < MAX_PLANNED_TASKS or not self.running)
+                if not self.running:
+                    break
+                self.tasks.extend(group.tasks)
+                self.items_to_complete += len(group.tasks)
+                self.plan_cond.notify_all()
+
+            if group.v1_downloads or group.linux_downloads or group.v2_downloads:
+                with self.task_cond:
+                    self.v1_chunks_to_download.extend(group.v1_downloads)
+                    self.linux_chunks_to_download.extend(group.linux_downloads)
+                    self.v2_chunks_to_download.extend(group.v2_downloads)
+                    self.task_cond.notify()
+
+        with self.plan_cond:
+            self.planned = True
+            self.plan_cond.notify_all()
+            self.check_finished()
+        self.logger.debug(f"Task planner out, {self.items_to_complete} tasks planned")
+
+    def next_task(self):
+        """Next planned task, waits for planner if it's behind. None once all tasks are taken"""
+        with self.plan_cond:
+            self.plan_cond.wait_for(lambda: self.tasks or self.planned or not self.running)
+            if not self.tasks:
+                return None
+            task = self.tasks.popleft()
+            self.plan_cond.notify_all()
+            return task
+
+    def check_finished(self):
+        """Sets finished once every planned task is written, called with plan_cond held"""
+        if self.planned and self.processed_items >= self.items_to_complete:
+            self.finished.set()
+
+    def setup_patch_writers(self, patch_peaks, required_disk_size):
+        """Adds writers applying patches next to each other, returns extra disk space they need
+
+        Disk space is accounted as if patches were applied one after another. Every patch
+        running at the same time keeps its .delta and output on disk as well, so workers
+        are only added while the biggest of those still fit into free space.
+        """
+        if not patch_peaks:
+            return 0
+        wanted = min(MAX_PATCH_WORKERS, os.cpu_count() or 1, len(patch_peaks))
+        _, _, available_space = shutil.disk_usage(self.path)
+        peaks = sorted(patch_peaks, reverse=True)
+        extra = 0
+        workers = 1
+        while workers < wanted and required_disk_size + extra + peaks[workers - 1] < available_space:
+            extra += peaks[workers - 1]
+            workers += 1
+
+        self.patch_writers = range(len(self.writer_queues), len(self.writer_queues) + workers)
+        for i in self.patch_writers:
+            self.writer_queues.append(Queue())
+            self.writer_counters.append(SpeedCounter(f'patcher-{i}'))
+            self.writer_dispatched.append(0)
+            self.writer_completed.append(0)
+        self.logger.info(f"Applying up to {workers} patches at once")
+        return extra
+
+    def load_resumed_chunks(self, shared_chunks_counter, completed_files, mismatched_files, missing_files):
+        """Finds chunks of unfinished files that are already on disk according to chunk journal
+
+        Returns {(support, target path lowercase): {chunk index}}. V2 chunks are verified
+        against their md5, skipped chunks are taken out of shared_chunks_counter.
+        """
+        entries = self.chunk_journal.load()
+        resumed = dict()
+        self.journal_keep = list()
+        verified = getattr(self.diff, 'verified_chunks', None) or dict()
+        if not entries and not verified:
+            return resumed
+
+        total = 0
+        for f in self.diff_files():
+            if isinstance(f, v1.File):
+                file_path, target, chunks, flags = f.path, f.path, None, f.flags
+            elif isinstance(f, v2.DepotFile):
+                file_path, target, chunks, flags = f.path, f.path, f.chunks, f.flags
+            elif isinstance(f, v2.FileDiff):
+                file_path, target, chunks, flags = f.file.path, f.file.path, f.file.chunks, f.file.flags
+                can_reuse = file_path.lower() not in mismatched_files and file_path.lower() not in missing_files
+                if can_reuse and f.old_offsets:
+                    target += ".tmp"
+            else:
+                continue
 
-        self.items_to_complete = len(self.tasks)
+            if file_path.lower() in completed_files:
+                continue
+            support = dl_utils.support_key(flags)
+            checksum = self.hash_map.get(file_path.lower())
+            entry = entries.get((support, target.lower()))
+            valid = verified.get((support, target.lower()))
+            if valid is not None:
+                # Checked by verifier already
+                valid = set(valid)
+            elif not entry or entry[0] != checksum:
+                continue
+            else:
+                indices = entry[1]
+                abs_path = dl_utils.get_case_insensitive_name(os.path.join(self.support if support else self.path, target))
+                if not os.path.exists(abs_path):
+                    continue
 
-        print(get_readable_size(self.download_size), self.download_size)
-        print(get_readable_size(required_disk_size_delta), required_disk_size_delta)
-                
-        return dl_utils.check_free_space(required_disk_size_delta, self.path)
+                if chunks is None:
+                    # V1 has no checksums of parts
+                    valid = indices
+                else:
+                    valid = self.verify_chunks(abs_path, chunks, indices)
+
+            if chunks is not None:
+                for i in valid:
+                    if isinstance(f, v2.DepotFile) or i not in f.old_offsets:
+                        shared_chunks_counter[chunks[i].compressed_md5] -= 1
+
+            resumed[(support, target.lower())] = valid
+            self.journal_keep.extend((checksum, support, i, target) for i in sorted(valid))
+            total += len(valid)
+
+        if total:
+            self.logger.info(f"Resuming {total} chunks of unfinished files")
+        return resumed
+
+    def verify_chunks(self, path, chunks, indices):
+        valid = set()
+        offsets = list()
+        offset = 0
+        for size in chunks.sizes:
+            offsets.append(offset)
+            offset += size
+
+        with open(path, 'rb') as fh:
+            for i in sorted(indices):
+                if i >= len(chunks):
+                    continue
+                fh.seek(offsets[i])
+                data = fh.read(chunks.sizes[i])
+                if hashlib.md5(data).digest() == chunks.md5_digest(i):
+                    valid.add(i)
+        return valid
 
-        
     def run(self):
         self.logger.debug(f"Using temp directory: {self.temp_dir}")
+        try:
+            self.chunk_journal.open(self.journal_keep)
+        except OSError as e:
+            self.logger.warning(f"Unable to open chunk journal, chunk level resume disabled {e}")
         interrupted = False
         self.fatal_error = False
         
@@ -459,26 +791,32 @@ class ExecutingManager:
             exit(-num)
 
         try:
-            self.threads.append(Thread(target=self.download_manager, args=(self.task_cond, self.temp_cond)))
+            self.threads.append(Thread(target=self.planner))
+            self.threads.append(Thread(target=self.download_manager, args=(self.task_cond,)))
             self.threads.append(Thread(target=self.process_task_results, args=(self.task_cond,)))
-            self.threads.append(Thread(target=self.process_writer_task_results, args=(self.temp_cond,)))
-            self.progress = ProgressBar(self.disk_size, self.download_speed_updates, self.writer_speed_updates, self.game_id)
+            self.threads.append(Thread(target=self.process_writer_task_results, args=(self.task_cond,)))
+            queues = {'download': self.download_queue, 'download_results': self.download_res_queue, 'writer_results': self.writer_res_queue}
+            queues.update({f'writer-{i}': writer_queue for i, writer_queue in enumerate(self.writer_queues)})
+            self.progress = ProgressBar(self.disk_size, self.download_counters, self.writer_counters, self.cancel_token, queues)
 
             # Spawn workers using threads instead of processes
-            self.logger.info(f"Starting {self.allowed_threads} download workers for game {self.game_id}")
-            for i in range(self.allowed_threads):
+            self.logger.info(f"Starting {self.concurrency.maximum} download workers for game {self.game_id}, {self.concurrency.limit} requests in flight initially")
+            for i in range(self.concurrency.maximum):
                 worker = Thread(target=task_executor.download_worker, args=(
                     self.download_queue, self.download_res_queue, 
-                    self.download_speed_updates, self.secure_links, self.temp_dir, self.game_id
+                    self.download_counters[i], self.secure_links, self.temp_dir, self.cancel_token
                 ))
                 worker.start()
                 self.download_workers.append(worker)
         
-            self.writer_worker = Thread(target=task_executor.writer_worker, args=(
-                self.writer_queue, self.writer_res_queue, 
-                self.writer_speed_updates, self.cache, self.temp_dir
-            ))
-            self.writer_worker.start()
+            self.logger.info(f"Starting {len(self.writer_queues)} writer workers for game {self.game_id}, {len(self.patch_writers)} of them for patches")
+            for writer_queue, writer_counter in zip(self.writer_queues, self.writer_counters):
+                writer = Thread(target=task_executor.writer_worker, args=(
+                    writer_queue, self.writer_res_queue, 
+                    writer_counter, self.cache, self.temp_dir, self.memory_chunks
+                ))
+                writer.start()
+                self.writer_workers.append(writer)
 
             [th.start() for th in self.threads]
 
@@ -493,73 +831,101 @@ class ExecutingManager:
             if self.disk_size:
                 self.progress.start()
 
-            while self.processed_items < self.items_to_complete and not interrupted and not self.fatal_error:
-                # Check for Android cancellation signal
-                try:
-                    import builtins
-                    flag_name = f'GOGDL_CANCEL_{self.game_id}'
-                    if hasattr(builtins, flag_name):
-                        flag_value = getattr(builtins, flag_name, False)
-                        if flag_value:
-                            self.logger.info(f"Download cancelled by user for game {self.game_id}")
-                            self.fatal_error = True  # Mark as error to prevent completion
-                            interrupted = True
-                            break
-                except Exception as e:
-                    self.logger.debug(f"Error checking cancellation flag: {e}")
+            # Woken up as soon as the last task is written or the download is cancelled
+            cancel_handle = self.cancel_token.on_cancel(self.finished.set)
+            while not interrupted and not self.finished.wait(timeout=1):
+                pass
+            self.cancel_token.remove_callback(cancel_handle)
+
+            if self.cancel_token.is_cancelled():
+                self.logger.info(f"Download cancelled by user for game {self.game_id}")
+                self.fatal_error = True  # Mark as error to prevent completion
+                interrupted = True
                 
-                time.sleep(1)
             if interrupted:
+                self.interrupt_shutdown()
                 return True
         except KeyboardInterrupt:
             return True
+        finally:
+            cancellation.unregister(self.game_id, self.cancel_token)
         
         self.shutdown()
         return self.fatal_error
 
+    def stop_threads(self):
+        """Wakes up threads blocked on queues and conditions, so they can exit"""
+        for _ in range(len(self.download_workers)):
+            self.download_queue.put(generic.TerminateWorker())
+
+        for writer_queue in self.writer_queues:
+            writer_queue.put(generic.TerminateWorker())
+
+        self.download_res_queue.put(generic.TerminateWorker())
+
+        with self.task_cond:
+            self.task_cond.notify_all()
+
+        with self.plan_cond:
+            self.plan_cond.notify_all()
+
+        with self.writer_cond:
+            self.writer_cond.notify_all()
+
     def interrupt_shutdown(self):
         self.progress.completed = True
         self.running = False
-            
-        with self.task_cond:
-            self.task_cond.notify()
+        self.finished.set()
+        # Aborts chunk downloads in progress
+        self.cancel_token.cancel()
 
-        with self.temp_cond:
-            self.temp_cond.notify()
+        # Drop pending work, so workers pick up terminate instruction right away
+        for work_queue in [self.download_queue, *self.writer_queues]:
+            while True:
+                try:
+                    work_queue.get_nowait()
+                except Empty:
+                    break
+
+        self.stop_threads()
 
         for t in self.threads:
             t.join(timeout=5.0)
             if t.is_alive():
                 self.logger.warning(f'Thread did not terminate! {repr(t)}')
 
-        for worker in self.download_workers:
+        for worker in self.download_workers + self.writer_workers:
             worker.join(timeout=5.0)
+            if worker.is_alive():
+                self.logger.warning(f'Worker did not terminate! {repr(worker)}')
+
+        # Resume file, chunk journal and download cache are kept, so download can be resumed
+        try:
+            self.chunk_journal.close()
+        except OSError as e:
+            self.logger.error(f"Failed to close chunk journal {e}")
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
 
     def shutdown(self):
         self.logger.debug("Stopping progressbar")
         self.progress.completed = True
+        if self.peak_rss:
+            self.logger.info(f"Peak RSS {self.peak_rss / 1024 / 1024:.02f} MiB, biggest chunk {self.biggest_chunk / 1024 / 1024:.02f} MiB")
+        connection_pool.get_shared_adapter().log_stats(self.logger)
+        if self.chunk_cache:
+            self.chunk_cache.log_stats(self.logger)
         
         self.logger.debug("Sending terminate instruction to workers")
-        for _ in range(self.allowed_threads):
-            self.download_queue.put(generic.TerminateWorker())
-        
-        self.writer_queue.put(generic.TerminateWorker())
+        self.running = False
+        self.stop_threads()
 
         for worker in self.download_workers:
             worker.join(timeout=2)
         
-        if self.writer_worker:
-            self.writer_worker.join(timeout=10)
-
-        self.running = False
-        with self.task_cond:
-            self.task_cond.notify()
-
-        with self.temp_cond:
-            self.temp_cond.notify()
+        for writer in self.writer_workers:
+            writer.join(timeout=10)
 
         # Clean up temp directory
-        import shutil
         try:
             shutil.rmtree(self.temp_dir)
         except:
@@ -568,58 +934,61 @@ class ExecutingManager:
         try:
             if os.path.exists(self.resume_file):
                 os.remove(self.resume_file)
+            self.chunk_journal.remove()
         except:
             self.logger.error("Failed to remove resume file")
 
-    def download_manager(self, task_cond: Condition, temp_cond: Condition):
+        # Entries were released by their last use, failed download may still resume from the rest
+        if not self.fatal_error:
+            shutil.rmtree(self.cache, ignore_errors=True)
+
+    def can_schedule_download(self):
+        """Whether scheduler has something to do, evaluated with task_cond held"""
+        if not self.running:
+            return True
+        if self.active_tasks >= self.concurrency.limit:
+            return False
+        if self.v1_chunks_to_download:
+            return bool(self.temp_files)
+        if self.linux_chunks_to_download:
+            # Always written directly into destination
+            return True
+        if self.v2_chunks_to_download:
+            # Chunks written directly into destination don't need a temp file
+            return bool(self.v2_chunks_to_download[0][2] or self.temp_files)
+        return False
+
+    def grow_temp_files(self):
+        """Creates temp files up to what current concurrency limit needs, within disk budget"""
+        wanted = min(self.concurrency.limit * TEMP_FILES_PER_REQUEST, self.max_temp_files)
+        while self.temp_files_created < wanted:
+            self.temp_files.append(os.path.join(self.temp_dir, f'chunk_{self.temp_files_created}.tmp'))
+            self.temp_files_created += 1
+
+    def download_manager(self, task_cond: Condition):
         self.logger.debug("Starting download scheduler")
-        no_temp = False
         while self.running:
-            while self.active_tasks <= self.allowed_threads * 2 and (self.v2_chunks_to_download or self.v1_chunks_to_download):
-
-                try:
-                    temp_file = self.temp_files.popleft()
-                    no_temp = False
-                except IndexError:
-                    no_temp = True
-                    break 
-
-                if self.v1_chunks_to_download:
-                    product_id, chunk_id, offset, chunk_size = self.v1_chunks_to_download.popleft()
-
-                    try:
-                        self.download_queue.put(task_executor.DownloadTask1(product_id, offset, chunk_size, chunk_id, temp_file))
+            with task_cond:
+                task_cond.wait_for(self.can_schedule_download)
+                while self.running and self.can_schedule_download():
+                    if self.v1_chunks_to_download:
+                        product_id, chunk_id, offset, chunk_size = self.v1_chunks_to_download.popleft()
+                        self.download_queue.put(task_executor.DownloadTask1(product_id, offset, chunk_size, chunk_id, self.temp_files.popleft()))
                         self.logger.debug(f"Pushed v1 download to queue {chunk_id} {product_id} {offset} {chunk_size}")
-                        self.active_tasks += 1
-                        continue
-                    except Exception as e:
-                        self.logger.warning(f"Failed to push v1 task to download {e}")
-                        self.v1_chunks_to_download.appendleft((product_id, chunk_id, offset, chunk_size))
-                        self.temp_files.appendleft(temp_file)
-                        break
-
-                elif self.v2_chunks_to_download:
-                    product_id, chunk_hash = self.v2_chunks_to_download.popleft()
-                    try:
-                        self.download_queue.put(task_executor.DownloadTask2(product_id, chunk_hash, temp_file))
+                    elif self.linux_chunks_to_download:
+                        product_id, chunk_id, offset, chunk_size, entries = self.linux_chunks_to_download.popleft()
+                        self.download_queue.put(task_executor.DownloadTask1(product_id, offset, chunk_size, chunk_id, None, entries=entries))
+                        self.logger.debug(f"Pushed installer range download to queue {chunk_id} {product_id} {offset} {chunk_size}, {len(entries)} entries")
+                    else:
+                        product_id, chunk_hash, direct = self.v2_chunks_to_download.popleft()
+                        if direct:
+                            destination, offset, md5 = direct
+                            task = task_executor.DownloadTask2(product_id, chunk_hash, None, destination=destination, offset=offset, md5=md5)
+                        else:
+                            task = task_executor.DownloadTask2(product_id, chunk_hash, self.temp_files.popleft())
+                        self.download_queue.put(task)
                         self.logger.debug(f"Pushed DownloadTask2 for {chunk_hash}")
-                        self.active_tasks += 1
-                    except Exception as e:
-                        self.logger.warning(f"Failed to push task to download {e}")
-                        self.v2_chunks_to_download.appendleft((product_id, chunk_hash))
-                        self.temp_files.appendleft(temp_file)
-                        break
-
-            else:
-                with task_cond:
-                    self.logger.debug("Waiting for more tasks")
-                    task_cond.wait(timeout=1.0)
-                    continue
-
-            if no_temp:
-                with temp_cond:
-                    self.logger.debug(f"Waiting for more temp files")
-                    temp_cond.wait(timeout=1.0)
+                    self.active_tasks += 1
 
         self.logger.debug("Download scheduler out..")
 
@@ -627,13 +996,11 @@ class ExecutingManager:
         self.logger.debug("Download results collector starting")
         ready_chunks = dict()
 
-        try:
-            task = self.tasks.popleft()
-        except IndexError:
-            task = None
+        task = self.next_task()
             
         current_dest = self.path
         current_file = ''
+        current_key = ''
 
         while task and self.running:
             if isinstance(task, generic.FileTask):
@@ -645,19 +1012,26 @@ class ExecutingManager:
                     if task.old_flags & generic.TaskFlag.SUPPORT:
                         old_destination = self.support
 
-                    writer_task = task_executor.WriterTask(task_dest, task.path, task.flags, old_destination=old_destination, old_file=task.old_file, patch_file=task.patch_file)
-                    self.writer_queue.put(writer_task)
+                    writer_task = task_executor.WriterTask(task_dest, task.path, task.flags, size=task.size, old_destination=old_destination, old_file=task.old_file, patch_file=task.patch_file)
+                    depends_on = []
+                    if task.old_file:
+                        depends_on.append(self.get_path_key(old_destination, task.old_file))
+                        depends_on.append(self.get_path_key(task_dest, task.old_file))
+                    if task.patch_file:
+                        depends_on.append(self.get_path_key(task_dest, task.patch_file))
+                    self.push_writer_task(writer_task, self.get_path_key(task_dest, task.path), depends_on,
+                                          patch=bool(task.flags & generic.TaskFlag.PATCH))
                     if task.flags & generic.TaskFlag.OPEN_FILE:
                         current_file = task.path
                         current_dest = task_dest 
+                        current_key = self.get_path_key(task_dest, task.path)
                 except Exception as e:
                     self.tasks.appendleft(task)
                     self.logger.warning(f"Failed to add queue element {e}")
                     continue
 
-                try:
-                    task: Union[generic.ChunkTask, generic.V1Task] = self.tasks.popleft()
-                except IndexError:
+                task: Union[generic.ChunkTask, generic.V1Task] = self.next_task()
+                if task is None:
                     break
                 continue
             
@@ -674,9 +1048,21 @@ class ExecutingManager:
                         flags |= generic.TaskFlag.RELEASE_TEMP
                     if task.offload_to_cache:
                         flags |= generic.TaskFlag.OFFLOAD_TO_CACHE
+                    if task.in_memory:
+                        flags |= generic.TaskFlag.MEMORY_CACHE
+                    if task.direct:
+                        flags |= generic.TaskFlag.DIRECT_WRITE
                     if task.old_flags & generic.TaskFlag.SUPPORT:
                         old_destination = self.support
-                    self.writer_queue.put(task_executor.WriterTask(current_dest, current_file, flags=flags, temp_file=temp_file, old_destination=old_destination, old_file=task.old_file, old_offset=task.old_offset, size=task.size, hash=task.md5))
+                    offset = task.offset if isinstance(task, generic.ChunkTask) else task.file_offset
+                    writer_task = task_executor.WriterTask(current_dest, current_file, flags=flags, temp_file=temp_file, old_destination=old_destination, old_file=task.old_file, old_offset=task.old_offset, size=task.size, offset=offset, hash=task.md5, chunk_index=task.index)
+                    touches = []
+                    if task.old_file:
+                        # Chunks read from cache have to wait for the writer that put them there
+                        touches.append(self.get_path_key(old_destination or current_dest, task.old_file))
+                    if task.offload_to_cache:
+                        touches.append(self.get_path_key(self.cache, task.md5))
+                    self.push_writer_task(writer_task, current_key, touches, touches)
                 except Exception as e:
                     self.logger.error(f"Adding to writer queue failed {e}")
                     break
@@ -684,45 +1070,134 @@ class ExecutingManager:
                 if task.cleanup and not task.old_file:
                     del ready_chunks[task.compressed_md5]
 
-                try:
-                    task = self.tasks.popleft()
-                    if isinstance(task, generic.FileTask):
-                        break
-                except IndexError:
-                    task = None
+                task = self.next_task()
+                if task is None or isinstance(task, generic.FileTask):
                     break
 
             else:
                 try:
-                    res: task_executor.DownloadTaskResult = self.download_res_queue.get(timeout=1)
+                    res: task_executor.DownloadTaskResult = self.download_res_queue.get()
+                    if isinstance(res, generic.TerminateWorker):
+                        break
                     if res.success:
                         self.logger.debug(f"Chunk {res.task.compressed_sum} ready")
-                        ready_chunks[res.task.compressed_sum] = res
+                        if res.cpu_time is not None:
+                            self.logger.debug(f"Chunk {res.task.compressed_sum} took {res.cpu_time:.3f}s CPU, peak RSS {res.peak_rss}")
+                        if res.peak_rss:
+                            self.peak_rss = max(self.peak_rss, res.peak_rss)
+                        if isinstance(res.task, task_executor.DownloadTask1) and res.task.entries:
+                            # Single request served every entry of installer range
+                            for entry in res.task.entries:
+                                ready_chunks[entry.compressed_sum] = res
+                        else:
+                            ready_chunks[res.task.compressed_sum] = res
                         self.progress.update_downloaded_size(res.download_size)
                         self.progress.update_decompressed_size(res.decompressed_size)
-                        self.active_tasks -= 1
+                        with task_cond:
+                            if self.concurrency.on_success(res.download_size, res.ttfb, self.active_tasks):
+                                self.grow_temp_files()
+                            self.active_tasks -= 1
+                            task_cond.notify()
                     else:
                         self.logger.warning(f"Chunk download failed, reason {res.fail_reason}")
+                        with task_cond:
+                            self.concurrency.on_failure()
                         try:
                             self.download_queue.put(res.task)
                         except Exception as e:
                             self.logger.warning("Failed to resubmit download task")
-
-                    with task_cond:
-                        task_cond.notify()
                 except:
                     pass
 
         self.logger.debug("Download results collector exiting...")
 
-    def process_writer_task_results(self, temp_cond: Condition):
+    @staticmethod
+    def get_path_key(destination, path):
+        """Key identifying file on disk, .tmp and .delta files share the key of their target"""
+        if path.endswith('.tmp'):
+            path = path[:-4]
+        elif path.endswith('.delta'):
+            path = path[:-6]
+        return os.path.join(destination, path).lower()
+
+    def push_writer_task(self, writer_task, key, depends_on=(), touches=(), patch=False):
+        """Routes task to the writer owning the file
+
+        Waits until tasks touching the file or any path in depends_on, that were
+        scheduled on other writers, are finished, so that cross file operations
+        (copies, cache reads and deletes, renames) see completed data
+
+        Patches go to the least busy patch writer, which takes over the file, so deleting
+        the .delta and renaming the output stay ordered after the patch. The patch writer
+        waits for the .delta to be complete itself, instead of holding up other files here.
+        """
+        with self.writer_cond:
+            if patch and self.patch_writers:
+                writer = min(self.patch_writers, key=lambda i: self.writer_dispatched[i] - self.writer_completed[i])
+                self.file_writers[key] = writer
+            else:
+                writer = self.file_writers.get(key)
+            if writer is None:
+                writer = min(range(self.writers_count), key=lambda i: self.writer_dispatched[i] - self.writer_completed[i])
+                self.file_writers[key] = writer
+
+            deferred = []
+            for dependency in (key, *depends_on):
+                for dep_writer, sequence in self.path_writes.get(dependency, {}).items():
+                    if dep_writer == writer:
+                        # Same writer processes tasks in order
+                        continue
+                    if patch:
+                        deferred.append((dep_writer, sequence))
+                        continue
+                    self.writer_cond.wait_for(lambda: self.writer_completed[dep_writer] >= sequence or not self.running)
+
+            if deferred:
+                writer_task.wait_for = lambda: self.wait_for_writers(deferred)
+                # Patch is done only after what it waits for, later tasks just wait for the patch
+                self.path_writes[key] = {}
+
+            self.writer_dispatched[writer] += 1
+            sequence = self.writer_dispatched[writer]
+            for path_key in (key, *touches):
+                self.path_writes.setdefault(path_key, {})[writer] = sequence
+
+        writer_task.writer = writer
+        self.writer_queues[writer].put(writer_task)
+
+    def wait_for_writers(self, sequences):
+        """Blocks until writers complete given (writer, sequence) pairs, False if download stopped"""
+        with self.writer_cond:
+            self.writer_cond.wait_for(lambda: not self.running or all(self.writer_completed[writer] >= sequence for writer, sequence in sequences))
+            return self.running
+
+    def journal_chunk(self, task: task_executor.WriterTask):
+        file_path = task.file_path[:-4] if task.file_path.endswith('.tmp') else task.file_path
+        checksum = self.hash_map.get(file_path.lower())
+        if not checksum:
+            return
+        support = "support" if task.destination == self.support else ""
+        try:
+            self.chunk_journal.add(checksum, support, task.chunk_index, task.file_path)
+        except OSError as e:
+            self.logger.warning(f"Failed to journal chunk {e}")
+
+    def process_writer_task_results(self, task_cond: Condition):
         self.logger.debug("Starting writer results collector")
+        terminated = 0
         while self.running:
             try:
-                res: task_executor.WriterTaskResult = self.writer_res_queue.get(timeout=1)
+                res: task_executor.WriterTaskResult = self.writer_res_queue.get()
 
                 if isinstance(res.task, generic.TerminateWorker):
-                    break
+                    terminated += 1
+                    if terminated == len(self.writer_queues):
+                        break
+                    continue
+
+                with self.writer_cond:
+                    self.writer_completed[res.task.writer] += 1
+                    self.writer_cond.notify_all()
                 
                 if res.success and res.task.flags & generic.TaskFlag.CLOSE_FILE and not res.task.file_path.endswith('.delta'):
                     if res.task.file_path.endswith('.tmp'):
@@ -740,18 +1215,24 @@ class ExecutingManager:
                         with open(self.resume_file, 'a') as f:
                             f.write(f"{checksum}:{support}:{res.task.file_path}\n")
 
+                if res.success and res.task.chunk_index is not None:
+                    self.journal_chunk(res.task)
+
                 if not res.success:
                     self.logger.fatal("Task writer failed")
                     self.fatal_error = True
+                    self.finished.set()
                     return
     
                 self.progress.update_bytes_written(res.written)
                 if res.task.flags & generic.TaskFlag.RELEASE_TEMP and res.task.temp_file:
                     self.logger.debug(f"Releasing temp file {res.task.temp_file}")
-                    self.temp_files.appendleft(res.task.temp_file)
-                with temp_cond:
-                    temp_cond.notify()
-                self.processed_items += 1
+                    with task_cond:
+                        self.temp_files.appendleft(res.task.temp_file)
+                        task_cond.notify()
+                with self.plan_cond:
+                    self.processed_items += 1
+                    self.check_finished()
 
             except:
                 continue
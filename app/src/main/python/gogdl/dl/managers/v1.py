@@ -5,16 +5,16 @@ Based on heroic-gogdl v1.py but with Android compatibility
 
 # Handle old games downloading via V1 depot system
 # V1 is there since GOG 1.0 days, it has no compression and relies on downloading chunks from big main.bin file
-import hashlib
 from sys import exit
 import os 
 import logging
 import json
 from typing import Union
 from gogdl import constants
-from gogdl.dl import dl_utils
+from gogdl.dl import cancellation, dl_utils
 from gogdl.dl.managers.dependencies import DependenciesManager
 from gogdl.dl.managers.task_executor import ExecutingManager
+from gogdl.dl.verifier import Verifier
 from gogdl.dl.workers.task_executor import DownloadTask1, DownloadTask2, WriterTask
 from gogdl.dl.objects import v1
 from gogdl.languages import Language
@@ -39,6 +39,8 @@ class Manager:
         self.should_append_folder_name = generic_manager.should_append_folder_name
         self.is_verifying = generic_manager.is_verifying
         self.allowed_threads = generic_manager.allowed_threads
+        self.allowed_writers = generic_manager.allowed_writers
+        self.chunk_cache_size = generic_manager.chunk_cache_size
 
         self.platform = generic_manager.platform
 
@@ -167,11 +169,8 @@ class Manager:
             self.logger.debug("Parsing manifest")
             self.manifest = v1.Manifest(self.platform, self.meta, self.lang, dlcs_user_owns, self.api_handler, self.dlc_only)
 
-        if self.manifest:
-            self.manifest.get_files()
-
-        if old_manifest:
-            old_manifest.get_files()
+        # Files of both manifests are requested at once
+        dl_utils.map_concurrently(lambda manifest: manifest.get_files(), [m for m in (self.manifest, old_manifest) if m])
 
         diff = v1.ManifestDiff.compare(self.manifest, old_manifest)
 
@@ -227,66 +226,38 @@ class Manager:
             self.logger.info("Nothing to do")
             return
 
+        cancel_token = None
         if self.is_verifying:
+            # Shared with executor, so the scan can be cancelled from the Android bridge too
+            cancel_token = cancellation.register(self.game_id)
             new_diff = v1.ManifestDiff()
+            verifier = Verifier(self.path, self.support, cancel_token=cancel_token)
             invalid = 0
-            for file in diff.new:
-                # V1 only files
-                if not file.size:
-                    continue
-
-                if 'support' in file.flags:
-                    file_path = os.path.join(self.support, file.path)
-                else:
-                    file_path = os.path.join(self.path, file.path)
-                file_path = dl_utils.get_case_insensitive_name(file_path)
-
-                if not os.path.exists(file_path):
+            damaged_chunks = 0
+
+            for files, target in ((diff.new, new_diff.new), (diff.redist, new_diff.redist)):
+                damaged = verifier.verify(files)
+                if verifier.cancelled():
+                    self.logger.info("Verification cancelled by user")
+                    cancellation.unregister(self.game_id, cancel_token)
+                    return
+                for damage in damaged.values():
                     invalid += 1
-                    new_diff.new.append(file)
-                    continue
-
-                with open(file_path, 'rb') as fh:
-                    file_sum  = hashlib.md5()
-                    
-                    while chunk := fh.read(8 * 1024 * 1024):
-                        file_sum.update(chunk)
-
-                    if file_sum.hexdigest() != file.hash:
-                        invalid += 1
-                        new_diff.new.append(file)
-                        continue
-
-            for file in diff.redist:
-                if len(file.chunks) == 0:
-                    continue
-                file_path = dl_utils.get_case_insensitive_name(os.path.join(self.path, file.path))
-                if not os.path.exists(file_path):
-                    invalid += 1
-                    new_diff.redist.append(file)
-                    continue
-                valid = True
-                with open(file_path, 'rb') as fh:
-                    for chunk in file.chunks:
-                        chunk_sum  = hashlib.md5()
-                        chunk_data = fh.read(chunk['size'])
-                        chunk_sum.update(chunk_data)
-
-                        if chunk_sum.hexdigest() != chunk['md5']:
-                            valid = False
-                            break
-                if not valid:
-                    invalid += 1
-                    new_diff.redist.append(file)
-                    continue
+                    target.append(damage.file)
+                    if damage.good_chunks:
+                        new_diff.verified_chunks[(damage.support, damage.file.path.lower())] = damage.good_chunks
+                    damaged_chunks += len(getattr(damage.file, 'chunks', ())) - len(damage.good_chunks)
+
             if not invalid:
                 self.logger.info("All files look good")
+                cancellation.unregister(self.game_id, cancel_token)
                 return
 
-            self.logger.info(f"Found {invalid} broken files, repairing...")
+            self.logger.info(f"Found {invalid} broken files ({damaged_chunks} chunks), repairing...")
             diff = new_diff
 
-        executor = ExecutingManager(self.api_handler, self.allowed_threads, self.path, self.support, diff, secure_links, self.game_id)
+        executor = ExecutingManager(self.api_handler, self.allowed_threads, self.path, self.support, diff, secure_links, self.game_id, self.allowed_writers,
+                                    cancel_token=cancel_token, cache_budget=self.chunk_cache_size)
         success = executor.setup()
         if not success:
             print('Unable to proceed, Not enough disk space')
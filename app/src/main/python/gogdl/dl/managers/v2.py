@@ -6,11 +6,11 @@ Android-compatible V2 manager for Windows game downloads
 # This was introduced in GOG Galaxy 2.0, it features compression and files split by chunks
 import json
 from sys import exit
-from gogdl.dl import dl_utils
+from gogdl.dl import cancellation, dl_utils, installed_state
 import gogdl.dl.objects.v2 as v2
-import hashlib
 from gogdl.dl.managers import dependencies
 from gogdl.dl.managers.task_executor import ExecutingManager
+from gogdl.dl.verifier import Verifier
 from gogdl.dl.workers import task_executor
 from gogdl.languages import Language
 from gogdl import constants
@@ -33,6 +33,8 @@ class Manager:
             self.support = ""
 
         self.allowed_threads = generic_manager.allowed_threads
+        self.allowed_writers = generic_manager.allowed_writers
+        self.chunk_cache_size = generic_manager.chunk_cache_size
 
         self.api_handler = generic_manager.api_handler
         self.should_append_folder_name = generic_manager.should_append_folder_name
@@ -94,6 +96,7 @@ class Manager:
 
     def download(self):
         manifest_path = os.path.join(constants.MANIFESTS_DIR, self.game_id)
+        state_path = manifest_path + installed_state.STATE_SUFFIX
         old_manifest = None
 
         # Load old manifest
@@ -101,13 +104,22 @@ class Manager:
             self.logger.debug(f"Loading existing manifest for game {self.game_id}")
             with open(manifest_path, 'r') as f_handle:
                 try:
-                    json_data = json.load(f_handle)
+                    manifest_text = f_handle.read()
+                    json_data = json.loads(manifest_text)
                     self.logger.info("Creating Manifest instance from existing manifest")
                     old_manifest = dl_utils.create_manifest_class(json_data, self.api_handler)
                 except json.JSONDecodeError:
                     old_manifest = None
                     pass
 
+            # Installed files are known without fetching depot manifests again
+            state = installed_state.load(state_path, manifest_text) if isinstance(old_manifest, v2.Manifest) else None
+            if state:
+                self.logger.info("Using installed state of existing manifest")
+                old_manifest.files = state.get_files()
+                old_manifest.dirs = state.get_dirs()
+                state.release()
+
         if self.is_verifying:
             if old_manifest:
                 self.logger.warning("Verifying - ignoring obtained manifest in favor of existing one")
@@ -131,12 +143,10 @@ class Manager:
                 self.meta, self.lang, dlcs_user_owns, self.api_handler, self.dlc_only
             )
         patch = None
-        if self.manifest:
-            self.logger.debug("Requesting files of primary manifest")
-            self.manifest.get_files()
+        # Files of both manifests are requested at once
+        self.logger.debug("Requesting files of primary and previous manifest")
+        dl_utils.map_concurrently(lambda manifest: manifest.get_files(), [m for m in (self.manifest, old_manifest) if m and not m.files])
         if old_manifest:
-            self.logger.debug("Requesting files of previous manifest")
-            old_manifest.get_files()
             patch = v2.Patch.get(self.manifest, old_manifest, self.lang, dlcs_user_owns, self.api_handler)
             if not patch:
                 self.logger.info("No patch found, falling back to chunk based updates")
@@ -190,59 +200,28 @@ class Manager:
                 }
             )
         
+        cancel_token = None
         if self.is_verifying:
+            # Shared with executor, so the scan can be cancelled from the Android bridge too
+            cancel_token = cancellation.register(self.game_id)
             new_diff = v2.ManifestDiff()
+            verifier = Verifier(self.path, self.support, cancel_token=cancel_token)
             invalid = 0
-
-            for file in diff.new:
-                if len(file.chunks) == 0:
-                    continue
-                if 'support' in file.flags:
-                    file_path = os.path.join(self.support, file.path)
-                else:
-                    file_path = os.path.join(self.path, file.path)
-                file_path = dl_utils.get_case_insensitive_name(file_path)
-                if not os.path.exists(file_path):
+            damaged_chunks = 0
+
+            for files, target in ((diff.new, new_diff.new), (diff.redist, new_diff.redist)):
+                damaged = verifier.verify(files)
+                if verifier.cancelled():
+                    self.logger.info("Verification cancelled by user")
+                    cancellation.unregister(self.game_id, cancel_token)
+                    return
+                for damage in damaged.values():
                     invalid += 1
-                    new_diff.new.append(file)
-                    continue
-                valid = True
-                with open(file_path, 'rb') as fh:
-                    for chunk in file.chunks:
-                        chunk_sum  = hashlib.md5()
-                        chunk_data = fh.read(chunk['size'])
-                        chunk_sum.update(chunk_data)
-
-                        if chunk_sum.hexdigest() != chunk['md5']:
-                            valid = False
-                            break
-                if not valid:
-                    invalid += 1
-                    new_diff.new.append(file)
-                    continue
+                    target.append(damage.file)
+                    if damage.good_chunks:
+                        new_diff.verified_chunks[(damage.support, damage.file.path.lower())] = damage.good_chunks
+                    damaged_chunks += len(getattr(damage.file, 'chunks', ())) - len(damage.good_chunks)
 
-            for file in diff.redist:
-                if len(file.chunks) == 0:
-                    continue
-                file_path = dl_utils.get_case_insensitive_name(os.path.join(self.path, file.path))
-                if not os.path.exists(file_path):
-                    invalid += 1
-                    new_diff.redist.append(file)
-                    continue
-                valid = True
-                with open(file_path, 'rb') as fh:
-                    for chunk in file.chunks:
-                        chunk_sum  = hashlib.md5()
-                        chunk_data = fh.read(chunk['size'])
-                        chunk_sum.update(chunk_data)
-
-                        if chunk_sum.hexdigest() != chunk['md5']:
-                            valid = False
-                            break
-                if not valid:
-                    invalid += 1
-                    new_diff.redist.append(file)
-                    continue
             for file in diff.links:
                 file_path = os.path.join(self.path, file.path)
                 file_path = dl_utils.get_case_insensitive_name(file_path)
@@ -251,12 +230,14 @@ class Manager:
 
             if not invalid:
                 self.logger.info("All files look good")
+                cancellation.unregister(self.game_id, cancel_token)
                 return
 
-            self.logger.info(f"Found {invalid} broken files, repairing...")
+            self.logger.info(f"Found {invalid} broken files, repairing {damaged_chunks} chunks...")
             diff = new_diff
 
-        executor = ExecutingManager(self.api_handler, self.allowed_threads, self.path, self.support, diff, secure_links, self.game_id)
+        executor = ExecutingManager(self.api_handler, self.allowed_threads, self.path, self.support, diff, secure_links, self.game_id, self.allowed_writers,
+                                    cancel_token=cancel_token, cache_budget=self.chunk_cache_size)
         success = executor.setup()
         if not success:
             print('Unable to proceed, Not enough disk space')
@@ -276,6 +257,10 @@ class Manager:
             with open(manifest_path, 'w') as f_handle:
                 data = self.manifest.serialize_to_json()
                 f_handle.write(data)
+            try:
+                installed_state.write(state_path, data, self.manifest.files, self.manifest.dirs)
+            except OSError as e:
+                self.logger.warning(f"Unable to save installed state {e}")
 
     def get_meta(self):
         meta_url = self.build["link"]
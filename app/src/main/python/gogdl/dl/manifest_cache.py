@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import os
+import re
+from threading import Lock, get_ident
+from typing import Optional
+
+from gogdl import constants
+
+CACHE_DIR = os.path.join(constants.CONFIG_DIR, 'manifest-cache')
+# Bytes of manifests kept on disk, least recently used ones are evicted past it
+MAX_CACHE_SIZE = 256 * 1024 * 1024
+# Entries start with md5 of the payload, so damaged files are detected and dropped
+DIGEST_SIZE = 16
+
+SAFE_ID = re.compile(r'^[0-9A-Za-z]+$')
+
+
+class ManifestCache:
+    """Content addressed store of depot manifests, as served by the CDN
+
+    Depot manifests are named by hashes of their content, so an entry never goes stale.
+    Entries are kept compressed, exactly as downloaded, under kind/xx/yy/id.
+    Reading an entry refreshes its modification time, which eviction orders by.
+    """
+
+    def __init__(self, path: str = CACHE_DIR, max_size: int = MAX_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.logger = logging.getLogger("MANIFEST_CACHE")
+        self.lock = Lock()
+        # Total size of entries, scanned on first write
+        self.size: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, kind: str, manifest_id: str) -> str:
+        name = manifest_id.replace('/', '')
+        if not SAFE_ID.match(name):
+            name = hashlib.md5(manifest_id.encode()).hexdigest()
+        return os.path.join(self.path, kind, name[0:2], name[2:4], name)
+
+    def get(self, kind: str, manifest_id: str) -> Optional[bytes]:
+        path = self.entry_path(kind, manifest_id)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        payload = data[DIGEST_SIZE:]
+        if len(data) < DIGEST_SIZE or hashlib.md5(payload).digest() != data[:DIGEST_SIZE]:
+            self.logger.warning(f"Dropping damaged cache entry {path}")
+            self.remove(kind, manifest_id)
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return payload
+
+    def put(self, kind: str, manifest_id: str, payload: bytes):
+        path = self.entry_path(kind, manifest_id)
+        tmp_path = f'{path}.{os.getpid()}.{get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(hashlib.md5(payload).digest())
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.logger.debug(f"Unable to cache manifest {manifest_id} {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.scan())
+            else:
+                self.size += DIGEST_SIZE + len(payload)
+            if self.size > self.max_size:
+                self.evict()
+
+    def remove(self, kind: str, manifest_id: str):
+        try:
+            os.remove(self.entry_path(kind, manifest_id))
+        except OSError:
+            pass
+
+    def scan(self):
+        """Lists (path, size, mtime) of all entries"""
+        entries = list()
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until cache fits into max_size, called with lock held"""
+        entries = sorted(self.scan(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+            self.logger.debug(f"Evicted {path}")
+
+
+_shared_cache = None
+_shared_cache_lock = Lock()
+
+
+def get_shared_cache() -> ManifestCache:
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = ManifestCache()
+        return _shared_cache
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Flag, auto
 from typing import Optional
 
@@ -13,6 +13,10 @@ class BaseDiff:
 
         self.links = [] # Unix only
 
+        # Chunks known to be intact on disk, e.g. after verification
+        # {(support, path lowercase): {chunk index}}
+        self.verified_chunks = dict()
+
     def __str__(self):
         return f"Deleted: {len(self.deleted)} New: {len(self.new)} Changed: {len(self.changed)}"
 
@@ -31,7 +35,8 @@ class TaskFlag(Flag):
     PATCH = auto()
     RELEASE_MEM = auto()
     RELEASE_TEMP = auto()
-    ZIP_DEC = auto()
+    DIRECT_WRITE = auto()
+    MEMORY_CACHE = auto()
 
 @dataclass
 class MemorySegment:
@@ -58,6 +63,13 @@ class ChunkTask:
     old_flags: TaskFlag = TaskFlag.NONE 
     old_file: Optional[str] = None
 
+    # Position of the chunk inside destination file
+    offset: Optional[int] = None
+    # Chunk is written into destination by download worker
+    direct: bool = False
+    # Chunk is offloaded to or read from RAM instead of .gogdl-download-cache
+    in_memory: bool = False
+
 @dataclass
 class V1Task:
     product: str
@@ -72,6 +84,13 @@ class V1Task:
     old_flags: TaskFlag = TaskFlag.NONE 
     old_file: Optional[str] = None
 
+    # Position of the chunk inside destination file, written sequentially if not set
+    file_offset: Optional[int] = None
+    # Chunk is written into destination by download worker
+    direct: bool = False
+    # Chunk is offloaded to or read from RAM instead of .gogdl-download-cache
+    in_memory: bool = False
+
     # This isn't actual sum, but unique id of chunk we use to decide 
     # if we should push it to writer
     @property
@@ -102,6 +121,16 @@ class FileTask:
     old_file: Optional[str] = None
 
     patch_file: Optional[str] = None
+    # Final size of the file, used to preallocate it on open
+    size: Optional[int] = None
+
+@dataclass
+class TaskGroup:
+    """Tasks planned for a single file, with chunk downloads they wait for"""
+    tasks: list = field(default_factory=list)
+    v1_downloads: list = field(default_factory=list)
+    linux_downloads: list = field(default_factory=list)
+    v2_downloads: list = field(default_factory=list)
 
 @dataclass
 class FileInfo:
@@ -1,5 +1,5 @@
-from io import BytesIO
 import stat
+import struct
 
 
 END_OF_CENTRAL_DIRECTORY = b"\x50\x4b\x05\x06"
@@ -9,6 +9,23 @@ LOCAL_FILE_HEADER = b"\x50\x4b\x03\x04"
 # ZIP64
 ZIP_64_END_OF_CD_LOCATOR = b"\x50\x4b\x06\x07"
 ZIP_64_END_OF_CD = b"\x50\x4b\x06\x06"
+ZIP_64_END_OF_CD_LOCATOR_SIZE = 20
+
+# Central directory record after the signature, up to the file name
+CENTRAL_DIRECTORY_STRUCT = struct.Struct("<6H3I5H2I")
+CENTRAL_DIRECTORY_SIZE = 4 + CENTRAL_DIRECTORY_STRUCT.size
+EXTRA_FIELD_HEADER = struct.Struct("<2H")
+ZIP_64_VALUE = struct.Struct("<Q")
+
+# Bytes read from the end of installer during setup, big enough to hold
+# the central directory of most games, so it comes with the same request
+TAIL_SIZE = 1024 * 1024
+# Fallback search for the archive start, used if offsets in the end records don't add up
+ARCHIVE_SEARCH_RANGE = 2 * 1024 * 1024
+# Ranges closer than MERGE_GAP are fetched by a single request of up to MERGE_MAX_SIZE
+MERGE_GAP = 64 * 1024
+MERGE_MAX_SIZE = 8 * 1024 * 1024
+TIMEOUT = 10
 
 class LocalFile:
     def __init__(self) -> None:
@@ -72,96 +89,103 @@ class LocalFile:
 
 
 class CentralDirectoryFile:
+    __slots__ = (
+        'product', 'version_made_by', 'version_needed_to_extract', 'general_purpose_bit_flag',
+        'compression_method', 'last_modification_time', 'last_modification_date', 'crc32',
+        'compressed_size', 'uncompressed_size', 'file_name_length', 'extra_field_length',
+        'file_comment_length', 'disk_number_start', 'int_file_attrs', 'ext_file_attrs',
+        'relative_local_file_offset', 'file_name', 'extra_field', 'comment', 'last_byte',
+        'file_data_offset',
+    )
+
     def __init__(self, product):
         self.product = product
-        self.version_made_by: bytes
-        self.version_needed_to_extract: bytes
-        self.general_purpose_bit_flag: bytes
+        self.version_made_by: int
+        self.version_needed_to_extract: int
+        self.general_purpose_bit_flag: int
         self.compression_method: int
-        self.last_modification_time: bytes
-        self.last_modification_date: bytes
+        self.last_modification_time: int
+        self.last_modification_date: int
         self.crc32: int
         self.compressed_size: int
         self.uncompressed_size: int
         self.file_name_length: int
         self.extra_field_length: int
         self.file_comment_length: int
-        self.disk_number_start: bytes
-        self.int_file_attrs: bytes
-        self.ext_file_attrs: bytes
+        self.disk_number_start: int
+        self.int_file_attrs: int
+        self.ext_file_attrs: int
         self.relative_local_file_offset: int
         self.file_name: str
-        self.extra_field: BytesIO
+        self.extra_field: bytes
         self.comment: bytes
         self.last_byte: int
         self.file_data_offset: int
 
     @classmethod
-    def from_bytes(cls, data, product):
+    def from_bytes(cls, data, product, offset=0):
+        """Parses record starting at offset of data, returns it with offset of the next one
+
+        data should be a memoryview so that names and fields are read in place,
+        without copying the rest of the central directory
+        """
+        if data[offset:offset + 4] != CENTRAL_DIRECTORY:
+            raise ValueError(f"Invalid central directory record at {offset}")
         cd_file = cls(product)
 
-        cd_file.version_made_by = data[4:6]
-        cd_file.version_needed_to_extract = data[6:8]
-        cd_file.general_purpose_bit_flag = data[8:10]
-        cd_file.compression_method = int.from_bytes(data[10:12], "little")
-        cd_file.last_modification_time = data[12:14]
-        cd_file.last_modification_date = data[14:16]
-        cd_file.crc32 = int.from_bytes(data[16:20], "little")
-        cd_file.compressed_size = int.from_bytes(data[20:24], "little")
-        cd_file.uncompressed_size = int.from_bytes(data[24:28], "little")
-        cd_file.file_name_length = int.from_bytes(data[28:30], "little")
-        cd_file.extra_field_length = int.from_bytes(data[30:32], "little")
-        cd_file.file_comment_length = int.from_bytes(data[32:34], "little")
-        cd_file.disk_number_start = data[34:36]
-        cd_file.int_file_attrs = data[36:38]
-        cd_file.ext_file_attrs = data[38:42]
-        cd_file.relative_local_file_offset = int.from_bytes(data[42:46], "little")
+        (cd_file.version_made_by,
+         cd_file.version_needed_to_extract,
+         cd_file.general_purpose_bit_flag,
+         cd_file.compression_method,
+         cd_file.last_modification_time,
+         cd_file.last_modification_date,
+         cd_file.crc32,
+         cd_file.compressed_size,
+         cd_file.uncompressed_size,
+         cd_file.file_name_length,
+         cd_file.extra_field_length,
+         cd_file.file_comment_length,
+         cd_file.disk_number_start,
+         cd_file.int_file_attrs,
+         cd_file.ext_file_attrs,
+         cd_file.relative_local_file_offset) = CENTRAL_DIRECTORY_STRUCT.unpack_from(data, offset + 4)
         cd_file.file_data_offset = 0
 
-        extra_field_start = 46 + cd_file.file_name_length
-        cd_file.file_name = bytes(data[46:extra_field_start]).decode()
-
-        cd_file.extra_field = BytesIO(data[
-                              extra_field_start: extra_field_start + cd_file.extra_field_length
-                              ])
-
-        field = None
-        while True:
-            id = int.from_bytes(cd_file.extra_field.read(2), "little")
-            size = int.from_bytes(cd_file.extra_field.read(2), "little")
-
-            if id == 0x01:
-                if cd_file.extra_field_length - cd_file.extra_field.tell() >= size:
-                    field = BytesIO(cd_file.extra_field.read(size))
-                break
-
-            cd_file.extra_field.seek(size, 1)
-
-            if cd_file.extra_field_length - cd_file.extra_field.tell() == 0:
-                break
-
-
-        if field:
-            if cd_file.uncompressed_size == 0xFFFFFFFF:
-                cd_file.uncompressed_size = int.from_bytes(field.read(8), "little")
-
-            if cd_file.compressed_size == 0xFFFFFFFF:
-                cd_file.compressed_size = int.from_bytes(field.read(8), "little")
-
-            if cd_file.relative_local_file_offset == 0xFFFFFFFF:
-                cd_file.relative_local_file_offset = int.from_bytes(field.read(8), "little")
-
+        extra_field_start = offset + CENTRAL_DIRECTORY_SIZE + cd_file.file_name_length
         comment_start = extra_field_start + cd_file.extra_field_length
-        cd_file.comment = data[
-                          comment_start: comment_start + cd_file.file_comment_length
-                          ]
+        cd_file.file_name = str(data[offset + CENTRAL_DIRECTORY_SIZE:extra_field_start], 'utf-8')
+        cd_file.extra_field = bytes(data[extra_field_start:comment_start])
 
-        cd_file.last_byte = comment_start + cd_file.file_comment_length
+        if 0xFFFFFFFF in (cd_file.uncompressed_size, cd_file.compressed_size, cd_file.relative_local_file_offset):
+            cd_file._read_zip64_field(data, extra_field_start, comment_start)
 
-        return cd_file, comment_start + cd_file.file_comment_length
+        cd_file.last_byte = comment_start + cd_file.file_comment_length
+        cd_file.comment = bytes(data[comment_start:cd_file.last_byte])
+
+        return cd_file, cd_file.last_byte
+
+    def _read_zip64_field(self, data, position, end):
+        while position + 4 <= end:
+            field_id, size = EXTRA_FIELD_HEADER.unpack_from(data, position)
+            position += 4
+            if field_id == 0x01:
+                if end - position < size:
+                    return
+                # Only values that overflowed are present, in this order
+                field_end = position + size
+                if self.uncompressed_size == 0xFFFFFFFF and position + 8 <= field_end:
+                    self.uncompressed_size = ZIP_64_VALUE.unpack_from(data, position)[0]
+                    position += 8
+                if self.compressed_size == 0xFFFFFFFF and position + 8 <= field_end:
+                    self.compressed_size = ZIP_64_VALUE.unpack_from(data, position)[0]
+                    position += 8
+                if self.relative_local_file_offset == 0xFFFFFFFF and position + 8 <= field_end:
+                    self.relative_local_file_offset = ZIP_64_VALUE.unpack_from(data, position)[0]
+                return
+            position += size
 
     def is_symlink(self):
-        return stat.S_ISLNK(int.from_bytes(self.ext_file_attrs, "little") >> 16)
+        return stat.S_ISLNK(self.ext_file_attrs >> 16)
 
     def as_dict(self):
         return {'file_name': self.file_name, 'crc32': self.crc32, 'compressed_size': self.compressed_size, 'size': self.uncompressed_size, 'is_symlink': self.is_symlink()}
@@ -179,24 +203,26 @@ class CentralDirectory:
         self.product = product
 
     @staticmethod
-    def create_central_dir_file(data, product):
-        return CentralDirectoryFile.from_bytes(data, product)
+    def create_central_dir_file(data, product, offset=0):
+        return CentralDirectoryFile.from_bytes(data, product, offset)
 
     @classmethod
     def from_bytes(cls, data, n, product):
+        """Parses n records in a single pass over data, nothing is copied but the fields"""
         central_dir = cls(product)
-        for record in range(n):
-            cd_file, next_offset = central_dir.create_central_dir_file(data, product)
-            central_dir.files.append(cd_file)
-            data = data[next_offset:]
-            if record == 0:
-                continue
-
-            prev_i = record - 1
-            if not (prev_i >= 0 and prev_i < len(central_dir.files)):
-                continue
-            prev = central_dir.files[prev_i]
-            prev.file_data_offset = cd_file.relative_local_file_offset - prev.compressed_size
+        data = memoryview(data)
+        files = central_dir.files
+        offset = 0
+        prev = None
+        try:
+            for _ in range(n):
+                cd_file, offset = central_dir.create_central_dir_file(data, product, offset)
+                files.append(cd_file)
+                if prev is not None:
+                    prev.file_data_offset = cd_file.relative_local_file_offset - prev.compressed_size
+                prev = cd_file
+        finally:
+            data.release()
 
         return central_dir
 
@@ -280,20 +306,25 @@ class EndOfCentralDir:
 
 
 class InstallerHandler:
+    """Random access to the ZIP archive embedded in a Linux native installer
+
+    The content-system link is resolved to the CDN once and the final URL is reused
+    for every range. Setup takes a single request for the tail of the installer in
+    the common case: it holds the end of central directory records and, for most
+    games, the whole central directory. Start of the archive inside the installer is
+    derived from where the central directory actually is, so the installer prefix
+    doesn't need to be searched.
+    """
+
     def __init__(self, url, product_id, session):
+        self.source_url = url
         self.url = url
         self.product = product_id
         self.session = session
         self.file_size = 0
+        self.resolved = False
 
-        SEARCH_OFFSET = 0
-        SEARCH_RANGE = 2 * 1024 * 1024 # 2 MiB
-
-        beginning_of_file = self.get_bytes_from_file(
-            from_b=SEARCH_OFFSET, size=SEARCH_RANGE, add_archive_index=False
-        )
-
-        self.start_of_archive_index = beginning_of_file.find(LOCAL_FILE_HEADER) + SEARCH_OFFSET
+        self.start_of_archive_index = 0
 
         # ZIP contents
         self.central_directory_offset: int
@@ -301,46 +332,28 @@ class InstallerHandler:
         self.size_of_central_directory: int
         self.central_directory: CentralDirectory
 
-    def get_bytes_from_file(self, from_b=-1, size=None, add_archive_index=True, raw_response=False, redirect_count=0):
-        """Get bytes from file with redirect handling and bounds checking
+    def get_bytes_from_file(self, from_b=-1, size=None, add_archive_index=True, raw_response=False):
+        """Get bytes from file, resolving the CDN URL on first use
 
         Args:
-            from_b: Starting byte offset
+            from_b: Starting byte offset, negative with no size reads the last -from_b bytes
             size: Number of bytes to read
             add_archive_index: Whether to add archive index offset
             raw_response: Whether to return raw response object
-            redirect_count: Current redirect depth (internal, max 5)
 
         Returns:
             Response object or bytes data
         """
-        MAX_REDIRECTS = 5
-
-        if redirect_count >= MAX_REDIRECTS:
-            raise Exception(f"Too many redirects ({MAX_REDIRECTS}) when fetching bytes from {self.url}")
-
-        # Store original from_b before applying archive index
-        original_from_b = from_b
-        if add_archive_index:
+        if add_archive_index and from_b > -1:
             from_b += self.start_of_archive_index
 
-        from_b_repr = str(from_b) if from_b > -1 else ""
-        if size:
-            end_b = from_b + size - 1
+        if from_b > -1:
+            range_header = self.get_range_header(from_b, from_b + size - 1 if size else "")
         else:
-            end_b = ""
-        range_header = self.get_range_header(from_b_repr, end_b)
-
-        response = self.session.get(self.url, headers={'Range': range_header},
-                                    allow_redirects=False, stream=raw_response)
-        if response.status_code == 302:
-            # Skip content-system API and follow redirect
-            self.url = response.headers.get('Location') or self.url
-            # Use original from_b and set add_archive_index=False to prevent double-applying the index
-            return self.get_bytes_from_file(original_from_b, size, add_archive_index=False,
-                                          raw_response=raw_response, redirect_count=redirect_count + 1)
-
-        # Safely extract file_size from Content-Range header if present
+            range_header = self.get_range_header("", -from_b)
+
+        response = self._request(range_header, raw_response)
+
         if not self.file_size:
             content_range = response.headers.get("Content-Range")
             if content_range:
@@ -348,39 +361,81 @@ class InstallerHandler:
                     self.file_size = int(content_range.split("/")[-1])
                 except (ValueError, IndexError) as e:
                     raise Exception(f"Invalid Content-Range header: {content_range}") from e
+            elif response.status_code == 200 and not raw_response:
+                # Range covered the whole file
+                self.file_size = len(response.content)
             else:
                 raise Exception("Content-Range header missing and file_size not set")
 
         if raw_response:
             return response
-        else:
-            data = response.content
-            return data
+        return response.content
+
+    def _request(self, range_header, stream):
+        for attempt in range(2):
+            response = self.session.get(self.url, headers={'Range': range_header}, stream=stream, timeout=TIMEOUT)
+            if not self.resolved:
+                # Skip content-system API for the following requests
+                self.url = response.url
+                self.resolved = True
+            if response.status_code in (403, 410) and self.url != self.source_url and not attempt:
+                # Signed CDN URL expired, resolve again
+                response.close()
+                self.url = self.source_url
+                self.resolved = False
+                continue
+            if not response.ok:
+                # Streamed response would hold its connection
+                response.close()
+            response.raise_for_status()
+            return response
 
     @staticmethod
     def get_range_header(from_b="", to_b=""):
         return f"bytes={from_b}-{to_b}"
 
     def setup(self):
-        self.__find_end_of_cd()
-        self.__find_central_directory()
+        tail = self.get_bytes_from_file(from_b=-TAIL_SIZE, add_archive_index=False)
+        tail_offset = self.file_size - len(tail)
+        central_directory_start = self.__find_end_of_cd(tail, tail_offset)
+
+        # Central directory normally ends right where the end of central directory records begin
+        if central_directory_start >= tail_offset:
+            start = central_directory_start - tail_offset
+            central_directory_data = memoryview(tail)[start:start + self.size_of_central_directory]
+        else:
+            central_directory_data = self.get_bytes_from_file(
+                from_b=self.central_directory_offset,
+                size=self.size_of_central_directory,
+            )
+        self.__parse_central_directory(central_directory_data)
 
-    def __find_end_of_cd(self):
-        end_of_cd_data = self.get_bytes_from_file(
-            from_b=self.file_size - 100, add_archive_index=False
-        )
+    def __find_end_of_cd(self, data, data_offset):
+        """Reads end of central directory records from the installer tail
 
-        end_of_cd_header_data_index = end_of_cd_data.find(END_OF_CENTRAL_DIRECTORY)
-        zip64_end_of_cd_locator_index = end_of_cd_data.find(ZIP_64_END_OF_CD_LOCATOR)
+        Returns absolute offset of the central directory in the installer
+        """
+        end_of_cd_header_data_index = data.rfind(END_OF_CENTRAL_DIRECTORY)
         assert end_of_cd_header_data_index != -1
-        end_of_cd = EndOfCentralDir.from_bytes(end_of_cd_data[end_of_cd_header_data_index:])
+        end_of_cd = EndOfCentralDir.from_bytes(data[end_of_cd_header_data_index:])
+        # Locator of zip64 records directly precedes the end of central directory record,
+        # values in the latter may be set to 0xFFFF(FFFF) or be just the lower bits
+        zip64_end_of_cd_locator_index = end_of_cd_header_data_index - ZIP_64_END_OF_CD_LOCATOR_SIZE
+        is_zip64 = zip64_end_of_cd_locator_index >= 0 and \
+            data[zip64_end_of_cd_locator_index:zip64_end_of_cd_locator_index + 4] == ZIP_64_END_OF_CD_LOCATOR
         if end_of_cd.central_directory_offset == 0xFFFFFFFF:
-            assert zip64_end_of_cd_locator_index != -1
-            # We need to find zip64 headers
-
-            zip64_end_of_cd_locator = Zip64EndOfCentralDirLocator.from_bytes(end_of_cd_data[zip64_end_of_cd_locator_index:])
-            zip64_end_of_cd_data = self.get_bytes_from_file(from_b=zip64_end_of_cd_locator.zip64_end_of_cd_offset, size=200)
-            zip64_end_of_cd = Zip64EndOfCentralDir.from_bytes(zip64_end_of_cd_data)
+            assert is_zip64
+
+        if is_zip64:
+            zip64_end_of_cd_locator = Zip64EndOfCentralDirLocator.from_bytes(data[zip64_end_of_cd_locator_index:])
+            zip64_end_of_cd_index = data.rfind(ZIP_64_END_OF_CD, 0, zip64_end_of_cd_locator_index)
+            if zip64_end_of_cd_index != -1:
+                zip64_end_of_cd = Zip64EndOfCentralDir.from_bytes(data[zip64_end_of_cd_index:])
+                self.start_of_archive_index = data_offset + zip64_end_of_cd_index - zip64_end_of_cd_locator.zip64_end_of_cd_offset
+            else:
+                self.__find_start_of_archive()
+                zip64_end_of_cd_data = self.get_bytes_from_file(from_b=zip64_end_of_cd_locator.zip64_end_of_cd_offset, size=200)
+                zip64_end_of_cd = Zip64EndOfCentralDir.from_bytes(zip64_end_of_cd_data)
 
             self.central_directory_offset = zip64_end_of_cd.central_directory_offset
             self.size_of_central_directory = zip64_end_of_cd.size_of_central_directory
@@ -389,13 +444,22 @@ class InstallerHandler:
             self.central_directory_offset = end_of_cd.central_directory_offset
             self.size_of_central_directory = end_of_cd.size_of_central_directory
             self.central_directory_records = end_of_cd.central_directory_records
-
-    def __find_central_directory(self):
-        central_directory_data = self.get_bytes_from_file(
-            from_b=self.central_directory_offset,
-            size=self.size_of_central_directory,
-        )
-
+            self.start_of_archive_index = (data_offset + end_of_cd_header_data_index
+                                           - self.size_of_central_directory - self.central_directory_offset)
+
+        central_directory_start = self.start_of_archive_index + self.central_directory_offset
+        if self.start_of_archive_index < 0 or (central_directory_start >= data_offset and
+                                               data[central_directory_start - data_offset:central_directory_start - data_offset + 4] != CENTRAL_DIRECTORY):
+            # Something is stored between the central directory and its end record
+            self.__find_start_of_archive()
+            central_directory_start = self.start_of_archive_index + self.central_directory_offset
+        return central_directory_start
+
+    def __find_start_of_archive(self):
+        beginning_of_file = self.get_bytes_from_file(from_b=0, size=ARCHIVE_SEARCH_RANGE, add_archive_index=False)
+        self.start_of_archive_index = beginning_of_file.find(LOCAL_FILE_HEADER)
+
+    def __parse_central_directory(self, central_directory_data):
         assert central_directory_data[:4] == CENTRAL_DIRECTORY
 
         self.central_directory = CentralDirectory.from_bytes(
@@ -404,6 +468,29 @@ class InstallerHandler:
         last_entry = self.central_directory.files[-1]
         last_entry.file_data_offset = self.central_directory_offset - last_entry.compressed_size
 
+    @staticmethod
+    def coalesce_ranges(ranges, max_gap=MERGE_GAP, max_size=MERGE_MAX_SIZE):
+        """Groups (offset, size) ranges into requests
+
+        Ranges that are at most max_gap bytes apart are fetched with a single request
+        of up to max_size bytes. Returns list of (offset, size, [range indices]).
+        Every group is a download task of its own, executor's download workers fetch
+        them concurrently through the shared connection pool.
+        """
+        groups = list()
+        order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+        for i in order:
+            offset, size = ranges[i]
+            if groups:
+                group_offset, group_size, members = groups[-1]
+                end = offset + size
+                if offset - (group_offset + group_size) <= max_gap and end - group_offset <= max_size:
+                    groups[-1] = (group_offset, max(group_size, end - group_offset), members)
+                    members.append(i)
+                    continue
+            groups.append((offset, size, [i]))
+        return groups
+
 
 class LinuxFile:
     def __init__(self, product, path, compression, start, compressed_size, size, checksum, executable):
@@ -121,8 +121,9 @@ class Manifest:
 
     
     def get_files(self):
-        for depot in self.depots:
-            manifest = dl_utils.get_json(self.api_handler, f"{constants.GOG_CDN}/content-system/v1/manifests/{depot.game_ids[0]}/{self.platform}/{self.data['product']['timestamp']}/{depot.manifest}")
+        # Depot manifests are fetched concurrently, files are listed in depot order
+        manifests = dl_utils.map_concurrently(lambda depot: dl_utils.get_json(self.api_handler, f"{constants.GOG_CDN}/content-system/v1/manifests/{depot.game_ids[0]}/{self.platform}/{self.data['product']['timestamp']}/{depot.manifest}"), self.depots)
+        for depot, manifest in zip(self.depots, manifests):
             for record in manifest["depot"]["files"]:
                 if "directory" in record:
                     self.dirs.append(Directory(record)) 
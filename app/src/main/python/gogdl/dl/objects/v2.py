@@ -1,5 +1,9 @@
+import copy
 import json
 import os
+import sys
+from array import array
+from typing import Iterator, NamedTuple, Optional
 
 from gogdl.dl import dl_utils
 from gogdl.dl.objects import generic, v1
@@ -7,16 +11,100 @@ from gogdl import constants
 from gogdl.languages import Language
 
 
+class Chunk(NamedTuple):
+    md5: str
+    compressed_md5: str
+    size: int
+    compressed_size: int
+
+
+class ChunkTable:
+    """Chunks of a depot file stored column-wise
+
+    Digests are concatenated 16 byte binary md5s and sizes are kept in arrays, instead
+    of a dict with hex strings per chunk. Iterating or indexing yields Chunk tuples
+    made on the fly, hot paths can compare binary digests through md5_digest.
+    """
+    __slots__ = ('md5s', 'compressed_md5s', 'sizes', 'compressed_sizes')
+
+    def __init__(self, md5s: bytes = b'', compressed_md5s: bytes = b'', sizes=None, compressed_sizes=None):
+        self.md5s = md5s
+        self.compressed_md5s = compressed_md5s
+        self.sizes = sizes if sizes is not None else array('I')
+        self.compressed_sizes = compressed_sizes if compressed_sizes is not None else array('I')
+
+    @classmethod
+    def from_json(cls, chunks):
+        return cls(bytes.fromhex(''.join([chunk['md5'] for chunk in chunks])),
+                   bytes.fromhex(''.join([chunk['compressedMd5'] for chunk in chunks])),
+                   array('I', [chunk['size'] for chunk in chunks]),
+                   array('I', [chunk['compressedSize'] for chunk in chunks]))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, i) -> Chunk:
+        if i < 0:
+            i += len(self.sizes)
+        return Chunk(self.md5s[i * 16:i * 16 + 16].hex(), self.compressed_md5s[i * 16:i * 16 + 16].hex(),
+                     self.sizes[i], self.compressed_sizes[i])
+
+    def __iter__(self) -> Iterator[Chunk]:
+        for i in range(len(self.sizes)):
+            yield self[i]
+
+    def md5_digest(self, i) -> bytes:
+        return self.md5s[i * 16:i * 16 + 16]
+
+    def total_size(self) -> int:
+        return sum(self.sizes)
+
+
+# Flags are the same handful of lists across all files, shared as tuples
+_flags = dict()
+
+
+def intern_flags(flags) -> tuple:
+    flags = tuple(flags)
+    return _flags.setdefault(flags, flags)
+
+
 class DepotFile:
+    __slots__ = ('flags', 'path', 'chunks', 'md5_digest', 'sha256_digest', 'product_id')
+
     def __init__(self, item_data, product_id):
-        self.flags = item_data.get("flags") or list()
-        self.path = item_data["path"].replace(constants.NON_NATIVE_SEP, os.sep).lstrip(os.sep)
+        self.flags = intern_flags(item_data.get("flags") or ())
+        path = item_data["path"].replace(constants.NON_NATIVE_SEP, os.sep).lstrip(os.sep)
         if "support" in self.flags:
-            self.path = os.path.join(product_id, self.path)
-        self.chunks = item_data["chunks"]
-        self.md5 = item_data.get("md5")
-        self.sha256 = item_data.get("sha256")
-        self.product_id = product_id
+            path = os.path.join(product_id, path)
+        # Old and new manifest of an update share path strings
+        self.path = sys.intern(path)
+        self.chunks = ChunkTable.from_json(item_data["chunks"])
+        md5 = item_data.get("md5")
+        sha256 = item_data.get("sha256")
+        self.md5_digest = bytes.fromhex(md5) if md5 else None
+        self.sha256_digest = bytes.fromhex(sha256) if sha256 else None
+        self.product_id = sys.intern(product_id)
+
+    @property
+    def md5(self) -> Optional[str]:
+        return self.md5_digest.hex() if self.md5_digest else None
+
+    @property
+    def sha256(self) -> Optional[str]:
+        return self.sha256_digest.hex() if self.sha256_digest else None
+
+    @classmethod
+    def from_state(cls, path, flags, chunks, md5_digest, sha256_digest, product_id):
+        """DepotFile restored from installed state, path there is already resolved"""
+        file = cls.__new__(cls)
+        file.flags = intern_flags(flags)
+        file.path = sys.intern(path)
+        file.chunks = chunks
+        file.md5_digest = md5_digest
+        file.sha256_digest = sha256_digest
+        file.product_id = sys.intern(product_id)
+        return file
 
 
 # That exists in some depots, indicates directory to be created, it has only path in it
@@ -121,11 +209,13 @@ class Manifest:
         return data 
 
     def get_files(self):
-        for depot in self.depots:
-            manifest = dl_utils.get_zlib_encoded(
-                self.api_handler,
-                f"{constants.GOG_CDN}/content-system/v2/meta/{dl_utils.galaxy_path(depot.manifest)}",
-            )[0]
+        # Depot manifests are fetched concurrently, files are listed in depot order
+        manifests = dl_utils.map_concurrently(lambda depot: dl_utils.get_cached_manifest(
+            self.api_handler,
+            f"{constants.GOG_CDN}/content-system/v2/meta/{dl_utils.galaxy_path(depot.manifest)}",
+            'meta', depot.manifest,
+        ), self.depots)
+        for depot, manifest in zip(self.depots, manifests):
             for item in manifest["depot"]["items"]:
                 if item["type"] == "DepotFile":
                     self.files.append(DepotFile(item, depot.product_id))
@@ -137,21 +227,26 @@ class Manifest:
 class FileDiff:
     def __init__(self):
         self.file: DepotFile
-        self.old_file_flags: list[str]
+        self.old_file_flags: tuple[str, ...]
         self.disk_size_diff: int = 0
+        # {new chunk index: offset of the same chunk in old file}
+        self.old_offsets: dict[int, int] = dict()
 
     @classmethod
     def compare(cls, new: DepotFile, old: DepotFile):
         diff = cls()
-        diff.disk_size_diff = sum([ch['size'] for ch in new.chunks])
-        diff.disk_size_diff -= sum([ch['size'] for ch in old.chunks])
+        diff.disk_size_diff = new.chunks.total_size() - old.chunks.total_size()
         diff.old_file_flags = old.flags
-        for new_chunk in new.chunks:
-            old_offset = 0
-            for old_chunk in old.chunks:
-                if old_chunk["md5"] == new_chunk["md5"]:
-                    new_chunk["old_offset"] = old_offset
-                old_offset += old_chunk["size"]
+        # Offset of the first occurrence of each chunk in old file
+        old_offsets = dict()
+        old_offset = 0
+        for i, size in enumerate(old.chunks.sizes):
+            old_offsets.setdefault(old.chunks.md5_digest(i), old_offset)
+            old_offset += size
+        for i in range(len(new.chunks)):
+            old_offset = old_offsets.get(new.chunks.md5_digest(i))
+            if old_offset is not None:
+                diff.old_offsets[i] = old_offset
         diff.file = new
         return diff
 
@@ -163,11 +258,18 @@ class FilePatchDiff:
         self.source = data['path_source'].replace('\\', '/')
         self.target = data['path_target'].replace('\\', '/')
         self.md5 = data['md5']
-        self.chunks = data['chunks']
+        self.chunks = ChunkTable.from_json(data['chunks'])
 
         self.old_file: DepotFile
         self.new_file: DepotFile
 
+    def bind(self, old_file, new_file):
+        """Copy of this patch entry applied to given files, entries held by Patch stay untouched"""
+        bound = copy.copy(self)
+        bound.old_file = old_file
+        bound.new_file = new_file
+        return bound
+
 class ManifestDiff(generic.BaseDiff):
     def __init__(self):
         super().__init__()
@@ -204,7 +306,7 @@ class ManifestDiff(generic.BaseDiff):
                 if is_manifest_upgrade:
                     if len(new_file.chunks) == 0:
                         continue
-                    new_final_sum = new_file.md5 or new_file.chunks[0]["md5"]
+                    new_final_sum = new_file.md5 or new_file.chunks[0].md5
                     if new_final_sum:
                         if old_file.hash != new_final_sum:
                             comparison.changed.append(new_file)
@@ -212,22 +314,20 @@ class ManifestDiff(generic.BaseDiff):
 
                 patch_file = None
                 if patch and len(old_file.chunks):
-                    for p_file in patch.files:
-                        old_final_sum = old_file.md5 or old_file.chunks[0]["md5"]
-                        if p_file.md5_source == old_final_sum:
-                            patch_file = p_file
-                            patch_file.old_file = old_file
-                            patch_file.new_file = new_file 
+                    old_final_sum = old_file.md5 or old_file.chunks[0].md5
+                    patch_file = patch.find(old_final_sum, new_file.path)
+                    if patch_file:
+                        patch_file = patch_file.bind(old_file, new_file)
 
                 if patch_file:
                     comparison.changed.append(patch_file)
                     continue
 
                 if len(new_file.chunks) == 1 and len(old_file.chunks) == 1:
-                    if new_file.chunks[0]["md5"] != old_file.chunks[0]["md5"]:
+                    if new_file.chunks.md5_digest(0) != old_file.chunks.md5_digest(0):
                         comparison.changed.append(new_file)
                 else:
-                    if (new_file.md5 and old_file.md5 and new_file.md5 != old_file.md5) or (new_file.sha256 and old_file.sha256 and old_file.sha256 != new_file.sha256):
+                    if (new_file.md5_digest and old_file.md5_digest and new_file.md5_digest != old_file.md5_digest) or (new_file.sha256_digest and old_file.sha256_digest and old_file.sha256_digest != new_file.sha256_digest):
                         comparison.changed.append(FileDiff.compare(new_file, old_file))
                     elif len(new_file.chunks) != len(old_file.chunks):
                         comparison.changed.append(FileDiff.compare(new_file, old_file))
@@ -237,6 +337,19 @@ class Patch:
     def __init__(self):
         self.patch_data = {}
         self.files = []
+        # FilePatchDiff lookup, {(md5_source, target path lowercase): entry}
+        self.index = {}
+
+    def build_index(self):
+        self.index = {(p_file.md5_source, p_file.target.lower()): p_file for p_file in self.files}
+
+    def find(self, source_sum, target_path):
+        """Patch entry for file at target_path with source_sum checksum
+
+        Entry has to patch that very path, patch output is written to its target,
+        so entry of another file sharing the same old content can't be used.
+        """
+        return self.index.get((source_sum, target_path.replace(os.sep, '/').lower()))
 
     @classmethod
     def get(cls,  manifest, old_manifest, lang: str, dlcs: list, api_handler):
@@ -271,7 +384,8 @@ class Patch:
         files = []
         fail = False
         for depot in depots:
-            depotdiffs = dl_utils.get_zlib_encoded(api_handler, f'{constants.GOG_CDN}/content-system/v2/patches/meta/{dl_utils.galaxy_path(depot["manifest"])}')[0]
+            depotdiffs = dl_utils.get_cached_manifest(api_handler, f'{constants.GOG_CDN}/content-system/v2/patches/meta/{dl_utils.galaxy_path(depot["manifest"])}',
+                                                      'patches', depot["manifest"])
             if not depotdiffs:
                 fail = True
                 break
@@ -291,5 +405,6 @@ class Patch:
         patch = cls()
         patch.patch_data = patch_data
         patch.files = files
+        patch.build_index()
 
         return patch
@@ -1,89 +1,136 @@
-import queue
-from multiprocessing import Queue
 import threading
 import logging
-from time import sleep, time
+from dataclasses import dataclass, field
+from queue import Queue
+from typing import Dict, List, Optional
+from time import time
+
+
+class SpeedCounter:
+    """Byte counters of a single worker thread
+
+    Only the owning worker adds to them, ProgressBar samples them on its own tick,
+    so no locking or queue traffic is needed per read/write.
+    Meaning of the pair depends on the worker: (downloaded, decompressed) for
+    download workers, (written, read) for writers.
+    """
+    __slots__ = ('name', 'first', 'second')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.first = 0
+        self.second = 0
+
+    def add(self, first: int, second: int):
+        self.first += first
+        self.second += second
+
+
+@dataclass
+class WorkerStats:
+    name: str
+    # Totals and per second rates of the counter pair, see SpeedCounter
+    first_total: int
+    second_total: int
+    first_rate: float
+    second_rate: float
+
+
+@dataclass
+class ProgressSnapshot:
+    timestamp: float
+    percentage: float
+    written_total: int
+    total: int
+    downloaded: int
+    running_time: float
+    eta: float
+
+    download_speed: float
+    decompress_speed: float
+    write_speed: float
+    read_speed: float
+
+    download_workers: List[WorkerStats] = field(default_factory=list)
+    writer_workers: List[WorkerStats] = field(default_factory=list)
+    queue_depths: Dict[str, int] = field(default_factory=dict)
 
 
 class ProgressBar(threading.Thread):
-    def __init__(self, max_val: int, speed_queue: Queue, write_queue: Queue, game_id=None):
+    def __init__(self, max_val: int, download_counters: List[SpeedCounter], writer_counters: List[SpeedCounter],
+                 cancel_token=None, queues: Optional[Dict[str, Queue]] = None):
         self.logger = logging.getLogger("PROGRESS")
         self.downloaded = 0
         self.total = max_val
-        self.speed_queue = speed_queue
-        self.write_queue = write_queue
+        self.download_counters = download_counters
+        self.writer_counters = writer_counters
+        self.queues = queues or dict()
         self.started_at = time()
         self.last_update = time()
-        self.completed = False
-        self.game_id = game_id
+        self._completed = threading.Event()
+        self.cancel_token = cancel_token
 
         self.decompressed = 0
 
-        self.downloaded_since_last_update = 0
-        self.decompressed_since_last_update = 0
-        self.written_since_last_update = 0
-        self.read_since_last_update = 0
-
         self.written_total = 0
 
+        # Counter values at previous tick, used to compute rates
+        self.last_samples = dict()
+        self.last_snapshot: Optional[ProgressSnapshot] = None
+
         super().__init__(target=self.loop)
 
+    @property
+    def completed(self):
+        return self._completed.is_set()
+
+    @completed.setter
+    def completed(self, value):
+        if value:
+            self._completed.set()
+        else:
+            self._completed.clear()
+
     def loop(self):
-        while not self.completed:
-            # Check for cancellation signal
-            if self.game_id:
-                try:
-                    import builtins
-                    flag_name = f'GOGDL_CANCEL_{self.game_id}'
-                    if hasattr(builtins, flag_name) and getattr(builtins, flag_name, False):
-                        self.logger.info(f"Progress reporting cancelled for game {self.game_id}")
-                        self.completed = True
-                        break
-                except (ImportError, AttributeError) as e:
-                    self.logger.debug(f"Failed to check cancellation flag: {e}")
+        while not self._completed.wait(1):
+            if self.cancel_token and self.cancel_token.is_cancelled():
+                self.logger.info("Progress reporting cancelled")
+                self.completed = True
+                break
 
             self.print_progressbar()
-            self.downloaded_since_last_update = self.decompressed_since_last_update = 0
-            self.written_since_last_update = self.read_since_last_update = 0
-            timestamp = time()
-            while not self.completed and (time() - timestamp) < 1:
-                try:
-                    dl, dec = self.speed_queue.get(timeout=0.3)
-                    self.downloaded_since_last_update += dl
-                    self.decompressed_since_last_update += dec
-                except queue.Empty:
-                    pass
-                try:
-                    wr, r = self.write_queue.get(timeout=0.3)
-                    self.written_since_last_update += wr
-                    self.read_since_last_update += r
-                except queue.Empty:
-                    pass
 
         self.print_progressbar()
-    def print_progressbar(self):
+
+    def sample_workers(self, counters: List[SpeedCounter], delta: float) -> List[WorkerStats]:
+        stats = list()
+        for counter in counters:
+            first, second = counter.first, counter.second
+            last_first, last_second = self.last_samples.get(counter.name, (0, 0))
+            self.last_samples[counter.name] = (first, second)
+            stats.append(WorkerStats(
+                counter.name, first, second,
+                (first - last_first) / delta if delta else 0,
+                (second - last_second) / delta if delta else 0,
+            ))
+        return stats
+
+    def snapshot(self) -> ProgressSnapshot:
+        """Samples worker counters and queue depths
+
+        Rates are computed since the previous snapshot, so this is meant to be called
+        from the progress thread, other consumers should read last_snapshot.
+        """
+        now = time()
+        delta = now - self.last_update
+        self.last_update = now
+
         # Guard against division by zero when total is 0
         if self.total:
             percentage = (self.written_total / self.total) * 100
         else:
             percentage = 0
-        running_time = time() - self.started_at
-        runtime_h = int(running_time // 3600)
-        runtime_m = int((running_time % 3600) // 60)
-        runtime_s = int((running_time % 3600) % 60)
-
-        print_time_delta = time() - self.last_update
-
-        current_dl_speed = 0
-        current_decompress = 0
-        if print_time_delta:
-            current_dl_speed = self.downloaded_since_last_update / print_time_delta
-            current_decompress = self.decompressed_since_last_update / print_time_delta
-            current_w_speed = self.written_since_last_update / print_time_delta
-            current_r_speed = self.read_since_last_update / print_time_delta
-        else:
-            current_w_speed = 0
-            current_r_speed = 0
+        running_time = now - self.started_at
 
         if percentage > 0:
             estimated_time = (100 * running_time) / percentage - running_time
@@ -91,6 +138,42 @@ class ProgressBar(threading.Thread):
             estimated_time = 0
         estimated_time = max(estimated_time, 0) # Floor at 0
 
+        download_workers = self.sample_workers(self.download_counters, delta)
+        writer_workers = self.sample_workers(self.writer_counters, delta)
+
+        snapshot = ProgressSnapshot(
+            timestamp=now,
+            percentage=percentage,
+            written_total=self.written_total,
+            total=self.total,
+            downloaded=self.downloaded,
+            running_time=running_time,
+            eta=estimated_time,
+            download_speed=sum(w.first_rate for w in download_workers),
+            decompress_speed=sum(w.second_rate for w in download_workers),
+            write_speed=sum(w.first_rate for w in writer_workers),
+            read_speed=sum(w.second_rate for w in writer_workers),
+            download_workers=download_workers,
+            writer_workers=writer_workers,
+            queue_depths={name: queue.qsize() for name, queue in self.queues.items()},
+        )
+        self.last_snapshot = snapshot
+        return snapshot
+
+    def print_progressbar(self):
+        snapshot = self.snapshot()
+        percentage = snapshot.percentage
+        running_time = snapshot.running_time
+        runtime_h = int(running_time // 3600)
+        runtime_m = int((running_time % 3600) // 60)
+        runtime_s = int((running_time % 3600) % 60)
+
+        current_dl_speed = snapshot.download_speed
+        current_decompress = snapshot.decompress_speed
+        current_w_speed = snapshot.write_speed
+        current_r_speed = snapshot.read_speed
+
+        estimated_time = snapshot.eta
         estimated_h = int(estimated_time // 3600)
         estimated_time = estimated_time % 3600
         estimated_m = int(estimated_time // 60)
@@ -117,6 +200,10 @@ class ProgressBar(threading.Thread):
             f"{current_r_speed / 1024 / 1024:.02f} MiB/s (read)"
         )
 
+        self.logger.debug(
+            " + Queues\t- " + ", ".join(f"{name}: {depth}" for name, depth in snapshot.queue_depths.items())
+        )
+
         # Call Android progress callback if available
         try:
             import gogdl
@@ -131,8 +218,6 @@ class ProgressBar(threading.Thread):
             # Silently ignore if callback not available (e.g. running standalone)
             pass
 
-        self.last_update = time()
-
     def update_downloaded_size(self, addition):
         self.downloaded += addition
 
@@ -0,0 +1,177 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from gogdl.dl import dl_utils
+from gogdl.dl.objects import v1, v2
+from gogdl.dl.progressbar import ProgressBar, SpeedCounter
+
+# Bytes of a file verified by a single job, so big files are spread across workers
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Read size for files without chunk checksums (v1)
+READ_SIZE = 8 * 1024 * 1024
+
+
+@dataclass
+class FileDamage:
+    file: object  # v1.File or v2.DepotFile
+    support: str  # "support" if file lives in support directory
+    missing: bool = False
+    # Indices of chunks that don't match, files without chunk checksums are
+    # reported with whole_file set instead
+    bad_chunks: Set[int] = field(default_factory=set)
+    whole_file: bool = False
+
+    @property
+    def good_chunks(self) -> Set[int]:
+        if self.missing or self.whole_file or not isinstance(self.file, v2.DepotFile):
+            return set()
+        return set(range(len(self.file.chunks))) - self.bad_chunks
+
+
+class Verifier:
+    """Verifies installed files against manifest on a pool of threads
+
+    Files of a v2 manifest are split into segments of whole chunks, each verified by
+    a worker reading into its own reusable buffer; hashlib releases the GIL, so hashing
+    runs in parallel. Progress is reported through the same ProgressBar as downloads.
+    Result is a damage map, listing the exact chunks that need to be fetched again.
+    """
+
+    def __init__(self, path, support, workers: Optional[int] = None, cancel_token=None):
+        self.path = path
+        # Resolved the way ExecutingManager does, files are checked where it writes them
+        self.support = support or os.path.join(path, 'gog-support')
+        self.workers = max(workers or os.cpu_count() or 2, 1)
+        self.cancel_token = cancel_token
+        self.logger = logging.getLogger("VERIFIER")
+
+        self.local = threading.local()
+        self.counters: List[SpeedCounter] = list()
+        self.counters_lock = threading.Lock()
+        self.progress: Optional[ProgressBar] = None
+
+    def get_counter(self) -> SpeedCounter:
+        counter = getattr(self.local, 'counter', None)
+        if counter is None:
+            with self.counters_lock:
+                counter = SpeedCounter(f'verify-{len(self.counters)}')
+                self.counters.append(counter)
+            self.local.counter = counter
+        return counter
+
+    def get_buffer(self, size) -> memoryview:
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None or len(buffer) < size:
+            buffer = bytearray(size)
+            self.local.buffer = buffer
+        return memoryview(buffer)[:size]
+
+    def report(self, size):
+        with self.counters_lock:
+            self.progress.update_bytes_written(size)
+
+    def cancelled(self):
+        return self.cancel_token is not None and self.cancel_token.is_cancelled()
+
+    def verify(self, files) -> Dict[Tuple[str, str], FileDamage]:
+        """Returns {(support, path lowercase): FileDamage} of files that need repair
+
+        Keys match the ones ExecutingManager.load_resumed_chunks looks verified chunks up with
+        """
+        damage: Dict[Tuple[str, str], FileDamage] = dict()
+        jobs = list()
+        total = 0
+
+        for file in files:
+            if isinstance(file, v2.DepotFile):
+                if not len(file.chunks):
+                    continue
+                size = file.chunks.total_size()
+            elif isinstance(file, v1.File):
+                if not file.size:
+                    continue
+                size = file.size
+            else:
+                continue
+
+            support = dl_utils.support_key(file.flags)
+            file_path = os.path.join(self.support if support else self.path, file.path)
+            file_path = dl_utils.get_case_insensitive_name(file_path)
+            entry = FileDamage(file, support)
+            if not os.path.exists(file_path):
+                entry.missing = True
+                damage[(support, file.path.lower())] = entry
+                continue
+
+            total += size
+            if isinstance(file, v1.File):
+                jobs.append((self.verify_whole_file, file_path, entry, None))
+                continue
+
+            # Split into segments of whole chunks
+            offset = 0
+            segment = list()
+            segment_size = 0
+            for i, size in enumerate(file.chunks.sizes):
+                segment.append((i, offset, size, file.chunks.md5_digest(i)))
+                offset += size
+                segment_size += size
+                if segment_size >= SEGMENT_SIZE:
+                    jobs.append((self.verify_chunks, file_path, entry, segment))
+                    segment = list()
+                    segment_size = 0
+            if segment:
+                jobs.append((self.verify_chunks, file_path, entry, segment))
+
+        self.progress = ProgressBar(total, [], self.counters, self.cancel_token)
+        if total:
+            self.progress.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='verify') as pool:
+                # Jobs still queued once cancelled are skipped, running ones stop at the next chunk
+                for entry in pool.map(lambda job: None if self.cancelled() else job[0](job[1], job[2], job[3]), jobs):
+                    if entry and (entry.bad_chunks or entry.whole_file):
+                        damage[(entry.support, entry.file.path.lower())] = entry
+        finally:
+            self.progress.completed = True
+            if total:
+                self.progress.join()
+
+        return damage
+
+    def verify_chunks(self, file_path, entry: FileDamage, segment):
+        counter = self.get_counter()
+        with open(file_path, 'rb') as fh:
+            fh.seek(segment[0][1])
+            for i, offset, size, md5 in segment:
+                if self.cancelled():
+                    break
+                view = self.get_buffer(size)
+                read = fh.readinto(view)
+                counter.add(0, read)
+                self.report(size)
+                # Segments of the same file may run concurrently, set.add is atomic
+                if read != size or hashlib.md5(view[:read]).digest() != md5:
+                    entry.bad_chunks.add(i)
+        return entry
+
+    def verify_whole_file(self, file_path, entry: FileDamage, _):
+        counter = self.get_counter()
+        file_sum = hashlib.md5()
+        view = self.get_buffer(READ_SIZE)
+        with open(file_path, 'rb') as fh:
+            while not self.cancelled():
+                read = fh.readinto(view)
+                if not read:
+                    break
+                file_sum.update(view[:read])
+                counter.add(0, read)
+                self.report(read)
+        if not self.cancelled() and file_sum.hexdigest() != entry.file.hash:
+            entry.whole_file = True
+        return entry
@@ -1,21 +1,27 @@
 import os
 import shutil
+import socket
 import sys
 import stat
 import traceback
 import time
-import requests
 import zlib
 import hashlib
 from io import BytesIO
-from typing import Optional, Union
+from collections import deque
+from typing import Callable, List, Optional, Union
 from copy import copy, deepcopy
-from gogdl.dl import dl_utils
+from gogdl.dl import dl_utils, connection_pool
 from dataclasses import dataclass
 from enum import Enum, auto
 from gogdl.dl.objects.generic import TaskFlag, TerminateWorker
 from gogdl.xdelta import patcher
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 class FailReason(Enum):
     UNKNOWN = 0
@@ -34,12 +40,32 @@ class DownloadTask1(DownloadTask):
     offset: int
     size: int
     compressed_sum: str
-    temp_file: str  # Use temp file instead of memory segment
+    temp_file: Optional[str]  # Use temp file instead of memory segment
+
+    # Range of Linux installer holding these ZIP entries, each is inflated
+    # into its destination as it arrives and checked against its CRC32
+    entries: Optional[List['InstallerEntry']] = None
+
+@dataclass
+class InstallerEntry:
+    compressed_sum: str  # Id of the V1Task writing the entry
+    offset: int  # Position of entry data inside installer
+    compressed_size: int
+    destination: str
+    compressed: bool  # Raw deflate stream
+    crc32: int
+    size: int
 
 @dataclass
 class DownloadTask2(DownloadTask):
     compressed_sum: str
-    temp_file: str  # Use temp file instead of memory segment
+    temp_file: Optional[str]  # Use temp file instead of memory segment
+
+    # Direct write mode, chunk is written into destination at offset
+    # instead of the temp file
+    destination: Optional[str] = None
+    offset: int = 0
+    md5: Optional[str] = None
 
 
 @dataclass
@@ -50,12 +76,18 @@ class WriterTask:
 
     hash: Optional[str] = None
     size: Optional[int] = None
+    offset: Optional[int] = None
     temp_file: Optional[str] = None  # Use temp file instead of shared memory
     old_destination: Optional[str] = None
     old_file: Optional[str] = None
     old_offset: Optional[int] = None
     patch_file: Optional[str] = None
 
+    writer: int = 0  # Index of writer worker the task was routed to
+    chunk_index: Optional[int] = None  # Index of the chunk inside file, for chunk journal
+    # Blocks until tasks this one depends on are done on other writers, False if download stopped
+    wait_for: Optional[Callable[[], bool]] = None
+
 @dataclass
 class DownloadTaskResult:
     success: bool
@@ -64,6 +96,9 @@ class DownloadTaskResult:
     temp_file: Optional[str] = None
     download_size: Optional[int] = None
     decompressed_size: Optional[int] = None
+    cpu_time: Optional[float] = None  # Worker CPU seconds spent on this chunk
+    peak_rss: Optional[int] = None  # Process peak RSS in bytes after this chunk
+    ttfb: Optional[float] = None  # Seconds until response headers arrived
 
 @dataclass
 class WriterTaskResult:
@@ -72,38 +107,70 @@ class WriterTaskResult:
     written: int = 0
 
 
-def download_worker(download_queue, results_queue, speed_queue, secure_links, temp_dir, game_id):
+def get_peak_rss():
+    """Peak resident set size of the process in bytes, None where unsupported"""
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux/Android report KiB
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def open_chunk_output(task: Union[InstallerEntry, DownloadTask2]):
+    """Opens file the chunk is decompressed into, positioned at the chunk offset"""
+    if not task.destination:
+        return open(task.temp_file, 'wb')
+
+    destination = dl_utils.get_case_insensitive_name(task.destination)
+    dl_utils.prepare_location(os.path.dirname(destination))
+    # Don't truncate, other workers may be writing their chunks into the same file
+    fd = os.open(destination, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+    handle = os.fdopen(fd, 'wb')
+    # Installer entries are always whole files, offset is the one inside installer
+    handle.seek(task.offset if isinstance(task, DownloadTask2) else 0)
+    return handle
+
+
+def abort_response(response):
+    """Interrupts a streamed response being read in another thread
+
+    Closing the response doesn't wake up a pending recv, shutting down the socket does.
+    """
+    try:
+        sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+        if sock:
+            sock.shutdown(socket.SHUT_RDWR)
+            return
+        # Connection hands its socket over to the response when server is going to
+        # close it (HTTP/1.0, Connection: close), it's only reachable by descriptor then
+        with socket.socket(fileno=os.dup(response.raw.fileno())) as sock:
+            sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, ValueError):
+        pass
+
+
+def download_worker(download_queue, results_queue, speed_counter, secure_links, temp_dir, cancel_token):
     """Download worker function that runs in a thread"""
-    session = requests.session()
+    # Doesn't carry API authorization, connections are shared with other workers
+    session = connection_pool.create_session()
     
     while True:
-        # Check for cancellation signal before processing next task
-        try:
-            import builtins
-            flag_name = f'GOGDL_CANCEL_{game_id}'
-            if hasattr(builtins, flag_name) and getattr(builtins, flag_name, False):
-                session.close()
-                return  # Exit worker thread if cancelled
-        except:
-            pass  # Continue if cancellation check fails
-            
-        try:
-            task: Union[DownloadTask1, DownloadTask2, TerminateWorker] = download_queue.get(timeout=1)
-        except:
-            continue
+        task: Union[DownloadTask1, DownloadTask2, TerminateWorker] = download_queue.get()
 
-        if isinstance(task, TerminateWorker):
+        if isinstance(task, TerminateWorker) or cancel_token.is_cancelled():
             break
 
         if type(task) == DownloadTask2:
-            download_v2_chunk(task, session, secure_links, results_queue, speed_queue, game_id)
+            download_v2_chunk(task, session, secure_links, results_queue, speed_counter, cancel_token)
+        elif type(task) == DownloadTask1 and task.entries:
+            download_installer_entries(task, session, secure_links, results_queue, speed_counter, cancel_token)
         elif type(task) == DownloadTask1:
-            download_v1_chunk(task, session, secure_links, results_queue, speed_queue, game_id)
+            download_v1_chunk(task, session, secure_links, results_queue, speed_counter, cancel_token)
 
     session.close()
 
 
-def download_v2_chunk(task: DownloadTask2, session, secure_links, results_queue, speed_queue, game_id):
+def download_v2_chunk(task: DownloadTask2, session, secure_links, results_queue, speed_counter, cancel_token):
     retries = 5 
     urls = secure_links[task.product_id]
     compressed_md5 = task.compressed_sum
@@ -118,68 +185,80 @@ def download_v2_chunk(task: DownloadTask2, session, secure_links, results_queue,
         endpoint["url"] += "/" + dl_utils.galaxy_path(compressed_md5)
         url = endpoint["url"]
 
-    buffer = bytes()
     compressed_sum = hashlib.md5()
+    decompressed_sum = hashlib.md5()
     download_size = 0
+    decompressed_size = 0
     response = None
+    cpu_started = time.thread_time()
     
     while retries > 0:
-        buffer = bytes()
         compressed_sum = hashlib.md5()
+        decompressed_sum = hashlib.md5()
         download_size = 0
+        decompressed_size = 0
         decompressor = zlib.decompressobj()
+        abort = None
+        response = None
         
         try:
-            response = session.get(url, stream=True, timeout=10)
-            response.raise_for_status()
-            for chunk in response.iter_content(1024 * 512):
-                # Check for cancellation during download
-                try:
-                    import builtins
-                    flag_name = f'GOGDL_CANCEL_{game_id}'
-                    if hasattr(builtins, flag_name) and getattr(builtins, flag_name, False):
-                        return  # Exit immediately if cancelled
-                except:
-                    pass
-                    
-                download_size += len(chunk)
-                compressed_sum.update(chunk)
-                decompressed = decompressor.decompress(chunk)
-                buffer += decompressed
-                speed_queue.put((len(chunk), len(decompressed)))
+            # Decompress straight into the output as data arrives, so memory
+            # use per worker doesn't grow with the chunk size
+            with open_chunk_output(task) as temp_f:
+                request_started = time.monotonic()
+                response = session.get(url, stream=True, timeout=10)
+                ttfb = time.monotonic() - request_started
+                abort = cancel_token.on_cancel(lambda: abort_response(response))
+                response.raise_for_status()
+                for chunk in response.iter_content(1024 * 512):
+                    if cancel_token.is_cancelled():
+                        return
+                    download_size += len(chunk)
+                    compressed_sum.update(chunk)
+                    decompressed = decompressor.decompress(chunk)
+                    if task.md5:
+                        decompressed_sum.update(decompressed)
+                    decompressed_size += temp_f.write(decompressed)
+                    speed_counter.add(len(chunk), len(decompressed))
+                decompressed = decompressor.flush()
+                if task.md5:
+                    decompressed_sum.update(decompressed)
+                decompressed_size += temp_f.write(decompressed)
 
         except Exception as e:
+            if cancel_token.is_cancelled():
+                return
             print("Connection failed", e)
-            if response and response.status_code == 401:
+            if response is not None and response.status_code == 401:
                 results_queue.put(DownloadTaskResult(False, FailReason.UNAUTHORIZED, task))
                 return
             retries -= 1
-            time.sleep(2)
+            if cancel_token.wait(2):
+                return
             continue
+        finally:
+            cancel_token.remove_callback(abort)
+            # Returns connection to the shared pool, or drops it if body wasn't read to the end
+            if response is not None:
+                response.close()
         break
     else:
         results_queue.put(DownloadTaskResult(False, FailReason.CHECKSUM, task))
         return
 
-    decompressed_size = len(buffer)
-    
-    # Write to temp file instead of shared memory
-    try:
-        with open(task.temp_file, 'wb') as f:
-            f.write(buffer)
-    except Exception as e:
-        print("ERROR writing temp file", e)
-        results_queue.put(DownloadTaskResult(False, FailReason.UNKNOWN, task))
-        return 
-
     if compressed_sum.hexdigest() != compressed_md5:
         results_queue.put(DownloadTaskResult(False, FailReason.CHECKSUM, task))
         return 
 
-    results_queue.put(DownloadTaskResult(True, None, task, temp_file=task.temp_file, download_size=download_size, decompressed_size=decompressed_size))
+    if task.md5 and decompressed_sum.hexdigest() != task.md5:
+        results_queue.put(DownloadTaskResult(False, FailReason.CHECKSUM, task))
+        return
+
+    results_queue.put(DownloadTaskResult(True, None, task, temp_file=task.temp_file, download_size=download_size, decompressed_size=decompressed_size, ttfb=ttfb,
+                                         cpu_time=time.thread_time() - cpu_started, peak_rss=get_peak_rss()))
 
 
-def download_v1_chunk(task: DownloadTask1, session, secure_links, results_queue, speed_queue, game_id):
+def download_v1_chunk(task: DownloadTask1, session, secure_links, results_queue, speed_counter, cancel_token):
     retries = 5
     urls = secure_links[task.product_id]
 
@@ -198,34 +277,40 @@ def download_v1_chunk(task: DownloadTask1, session, secure_links, results_queue,
     download_size = 0
     while retries > 0:
         download_size = 0
+        abort = None
+        response = None
         try:
+            request_started = time.monotonic()
             response = session.get(url, stream=True, timeout=10, headers={'Range': range_header})
+            ttfb = time.monotonic() - request_started
+            abort = cancel_token.on_cancel(lambda: abort_response(response))
             response.raise_for_status()
             
             # Stream directly to temp file instead of loading into memory
             with open(task.temp_file, 'wb') as temp_f:
                 for chunk in response.iter_content(1024 * 512):  # 512KB chunks
-                    # Check for cancellation during download
-                    try:
-                        import builtins
-                        flag_name = f'GOGDL_CANCEL_{game_id}'
-                        if hasattr(builtins, flag_name) and getattr(builtins, flag_name, False):
-                            return  # Exit immediately if cancelled
-                    except:
-                        pass
-                        
+                    if cancel_token.is_cancelled():
+                        return
                     temp_f.write(chunk)
                     download_size += len(chunk)
-                    speed_queue.put((len(chunk), len(chunk)))
+                    speed_counter.add(len(chunk), len(chunk))
                     
         except Exception as e:
+            if cancel_token.is_cancelled():
+                return
             print("Connection failed", e)
-            if response and response.status_code == 401:
+            if response is not None and response.status_code == 401:
                 results_queue.put(DownloadTaskResult(False, FailReason.UNAUTHORIZED, task))
                 return
             retries -= 1
-            time.sleep(2)
+            if cancel_token.wait(2):
+                return
             continue
+        finally:
+            cancel_token.remove_callback(abort)
+            # Returns connection to the shared pool, or drops it if body wasn't read to the end
+            if response is not None:
+                response.close()
         break
     else:
         results_queue.put(DownloadTaskResult(False, FailReason.CHECKSUM, task))
@@ -236,25 +321,151 @@ def download_v1_chunk(task: DownloadTask1, session, secure_links, results_queue,
         results_queue.put(DownloadTaskResult(False, FailReason.CHECKSUM, task))
         return 
 
-    results_queue.put(DownloadTaskResult(True, None, task, temp_file=task.temp_file, download_size=download_size, decompressed_size=download_size))
+    results_queue.put(DownloadTaskResult(True, None, task, temp_file=task.temp_file, download_size=download_size, decompressed_size=download_size, ttfb=ttfb))
+
+
+class InstallerEntryOutput:
+    """Inflates single installer entry into its destination"""
+
+    def __init__(self, entry: InstallerEntry):
+        self.entry = entry
+        self.end = entry.offset + entry.compressed_size
+        self.output = open_chunk_output(entry)
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if entry.compressed else None
+        self.received = 0
+        self.written = 0
+        self.crc = 0
+
+    def write(self, data):
+        self.received += len(data)
+        data = self.decompressor.decompress(data) if self.decompressor else data
+        self.crc = zlib.crc32(data, self.crc)
+        self.written += self.output.write(data)
+        return len(data)
+
+    def close(self):
+        """Returns whether entry matches sizes and CRC32 from central directory"""
+        if self.decompressor:
+            data = self.decompressor.flush()
+            self.crc = zlib.crc32(data, self.crc)
+            self.written += self.output.write(data)
+        self.output.close()
+        return self.received == self.entry.compressed_size and self.written == self.entry.size and self.crc == self.entry.crc32
+
+
+def download_installer_entries(task: DownloadTask1, session, secure_links, results_queue, speed_counter, cancel_token):
+    """Streams range of Linux installer, inflating ZIP entries inside it into their destinations
+
+    Range holds entries close to each other, see InstallerHandler.coalesce_ranges, bytes
+    between them (local file headers) are skipped. Compressed entries are raw deflate
+    streams, they're inflated as data arrives, so every entry is written once, without
+    an intermediate compressed copy.
+    """
+    retries = 5
+    url = secure_links[task.product_id]
+    range_header = dl_utils.get_range_header(task.offset, task.size)
+    entries = sorted(task.entries, key=lambda entry: entry.offset)
+
+    response = None
+    download_size = 0
+    decompressed_size = 0
+    valid = False
+    cpu_started = time.thread_time()
+    while retries > 0:
+        download_size = 0
+        decompressed_size = 0
+        valid = True
+        position = task.offset
+        pending = deque(entries)
+        current = None
+        abort = None
+        response = None
+        try:
+            request_started = time.monotonic()
+            response = session.get(url, stream=True, timeout=10, headers={'Range': range_header})
+            ttfb = time.monotonic() - request_started
+            abort = cancel_token.on_cancel(lambda: abort_response(response))
+            response.raise_for_status()
+            for chunk in response.iter_content(1024 * 512):
+                if cancel_token.is_cancelled():
+                    return
+                download_size += len(chunk)
+                written = 0
+                view = memoryview(chunk)
+                while view and (current or pending):
+                    if current is None:
+                        skip = min(max(pending[0].offset - position, 0), len(view))
+                        if skip:
+                            view = view[skip:]
+                            position += skip
+                            continue
+                        current = InstallerEntryOutput(pending.popleft())
+                    data = view[:current.end - position]
+                    written += current.write(data)
+                    view = view[len(data):]
+                    position += len(data)
+                    if position == current.end:
+                        valid = current.close() and valid
+                        decompressed_size += current.written
+                        current = None
+                speed_counter.add(len(chunk), written)
+
+        except Exception as e:
+            if cancel_token.is_cancelled():
+                return
+            print("Connection failed", e)
+            if response is not None and response.status_code == 401:
+                results_queue.put(DownloadTaskResult(False, FailReason.UNAUTHORIZED, task))
+                return
+            retries -= 1
+            if cancel_token.wait(2):
+                return
+            continue
+        finally:
+            cancel_token.remove_callback(abort)
+            # Returns connection to the shared pool, or drops it if body wasn't read to the end
+            if response is not None:
+                response.close()
+            if current:
+                current.output.close()
+        break
+    else:
+        results_queue.put(DownloadTaskResult(False, FailReason.CHECKSUM, task))
+        return
+
+    if download_size != task.size or pending or current or not valid:
+        results_queue.put(DownloadTaskResult(False, FailReason.CHECKSUM, task))
+        return
 
+    results_queue.put(DownloadTaskResult(True, None, task, download_size=download_size, decompressed_size=decompressed_size, ttfb=ttfb,
+                                         cpu_time=time.thread_time() - cpu_started, peak_rss=get_peak_rss()))
 
-def writer_worker(writer_queue, results_queue, speed_queue, cache, temp_dir):
+
+def writer_worker(writer_queue, results_queue, speed_counter, cache, temp_dir, memory_cache):
     """Writer worker function that runs in a thread"""
     file_handle = None
     current_file = ''
 
     while True:
-        try:
-            task: Union[WriterTask, TerminateWorker] = writer_queue.get(timeout=2)
-        except:
-            continue
+        task: Union[WriterTask, TerminateWorker] = writer_queue.get()
 
         if isinstance(task, TerminateWorker):
+            if file_handle:
+                file_handle.close()
             results_queue.put(WriterTaskResult(True, task))
             break
 
         written = 0
+
+        if task.wait_for and not task.wait_for():
+            results_queue.put(WriterTaskResult(False, task))
+            continue
+
+        if task.flags & TaskFlag.RELEASE_MEM:
+            # Chunk kept in RAM isn't going to be read anymore
+            memory_cache.pop(os.path.basename(task.file_path))
+            results_queue.put(WriterTaskResult(True, task))
+            continue
         
         task_path = dl_utils.get_case_insensitive_name(os.path.join(task.destination, task.file_path))
         split_path = os.path.split(task_path)
@@ -270,7 +481,11 @@ def writer_worker(writer_queue, results_queue, speed_queue, cache, temp_dir):
             if file_handle:
                 print("Opening on unclosed file")
                 file_handle.close()
-            file_handle = open(task_path, 'wb')
+            # Download workers may have already written their chunks
+            # into this file, so it's not truncated but resized to final size
+            fd = os.open(task_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+            file_handle = os.fdopen(fd, 'r+b')
+            file_handle.truncate(task.size or 0)
             current_file = task_path
             results_queue.put(WriterTaskResult(True, task))
             continue
@@ -282,6 +497,47 @@ def writer_worker(writer_queue, results_queue, speed_queue, cache, temp_dir):
             results_queue.put(WriterTaskResult(True, task))
             continue
 
+        elif task.flags & TaskFlag.DIRECT_WRITE:
+            # Chunk was already written by download worker
+            results_queue.put(WriterTaskResult(True, task, written=task.size or 0))
+            continue
+
+        elif task.flags & TaskFlag.RENAME_FILE:
+            if file_handle and task_path == current_file:
+                print("Renaming on unclosed file")
+                file_handle.close()
+                file_handle = None
+
+            if not task.old_file:
+                results_queue.put(WriterTaskResult(False, task))
+                continue
+
+            try:
+                if task.flags & TaskFlag.DELETE_FILE and os.path.exists(task_path):
+                    os.remove(task_path)
+                os.rename(dl_utils.get_case_insensitive_name(os.path.join(task.destination, task.old_file)), task_path)
+            except OSError as e:
+                print("Rename failed", e)
+                results_queue.put(WriterTaskResult(False, task))
+                continue
+            results_queue.put(WriterTaskResult(True, task))
+            continue
+
+        elif task.flags & TaskFlag.DELETE_FILE:
+            if file_handle and task_path == current_file:
+                print("Deleting unclosed file")
+                file_handle.close()
+                file_handle = None
+            try:
+                if os.path.exists(task_path):
+                    os.remove(task_path)
+            except OSError as e:
+                print("Delete failed", e)
+                results_queue.put(WriterTaskResult(False, task))
+                continue
+            results_queue.put(WriterTaskResult(True, task))
+            continue
+
         elif task.flags & TaskFlag.COPY_FILE:
             if file_handle and task.file_path == current_file:
                 print("Copy on unclosed file")
@@ -303,6 +559,28 @@ def writer_worker(writer_queue, results_queue, speed_queue, cache, temp_dir):
             results_queue.put(WriterTaskResult(True, task))
             continue
 
+        elif task.flags & TaskFlag.PATCH:
+            if file_handle and task_path == current_file:
+                print("Patching unclosed file")
+                file_handle.close()
+                file_handle = None
+
+            if not task.old_file or not task.patch_file:
+                results_queue.put(WriterTaskResult(False, task))
+                continue
+
+            source_path = dl_utils.get_case_insensitive_name(os.path.join(task.old_destination or task.destination, task.old_file))
+            patch_path = dl_utils.get_case_insensitive_name(os.path.join(task.destination, task.patch_file))
+            try:
+                patcher.patch(source_path, patch_path, task_path, speed_counter)
+                written = os.path.getsize(task_path)
+            except Exception as e:
+                print("Patch failed", e)
+                results_queue.put(WriterTaskResult(False, task))
+                continue
+            results_queue.put(WriterTaskResult(True, task, written=written))
+            continue
+
         elif task.flags & TaskFlag.MAKE_EXE:
             if file_handle and task.file_path == current_file:
                 print("Making exe on unclosed file")
@@ -319,27 +597,45 @@ def writer_worker(writer_queue, results_queue, speed_queue, cache, temp_dir):
             continue
 
         try:
+            if task.offset is not None:
+                file_handle.seek(task.offset)
+
             if task.temp_file:
                 if not task.size:
                     print("No size")
                     results_queue.put(WriterTaskResult(False, task))
                     continue
                     
+                keep_in_memory = task.flags & TaskFlag.OFFLOAD_TO_CACHE and task.flags & TaskFlag.MEMORY_CACHE
+                kept = list()
                 # Read from temp file instead of shared memory
                 with open(task.temp_file, 'rb') as temp_f:
                     left = task.size
                     while left > 0:
                         chunk = temp_f.read(min(1024 * 1024, left))   
                         written += file_handle.write(chunk)
-                        speed_queue.put((len(chunk), 0))
+                        speed_counter.add(len(chunk), 0)
                         left -= len(chunk)
+                        if keep_in_memory:
+                            kept.append(chunk)
                         
-                if task.flags & TaskFlag.OFFLOAD_TO_CACHE and task.hash:
+                if keep_in_memory and task.hash:
+                    memory_cache.put(task.hash, b''.join(kept))
+                elif task.flags & TaskFlag.OFFLOAD_TO_CACHE and task.hash:
                     cache_file_path = os.path.join(cache, task.hash)
                     dl_utils.prepare_location(cache)
                     shutil.copy(task.temp_file, cache_file_path)
-                    speed_queue.put((task.size, 0))
+                    speed_counter.add(task.size, 0)
                     
+            elif task.old_file and task.flags & TaskFlag.MEMORY_CACHE:
+                data = memory_cache.get(task.hash)
+                if data is None or len(data) != task.size:
+                    print("Chunk missing from memory cache", task.hash)
+                    results_queue.put(WriterTaskResult(False, task))
+                    continue
+                written += file_handle.write(data)
+                speed_counter.add(len(data), len(data))
+
             elif task.old_file:
                 if not task.size:
                     print("No size")
@@ -355,10 +651,13 @@ def writer_worker(writer_queue, results_queue, speed_queue, cache, temp_dir):
                     chunk = old_file_handle.read(min(1024*1024, left))
                     data = chunk
                     written += file_handle.write(data)
-                    speed_queue.put((len(data), len(chunk)))
+                    speed_counter.add(len(data), len(chunk))
                     left -= len(chunk)
                 old_file_handle.close()
 
+            # Chunk is journaled once reported, so it can't stay in our buffer
+            file_handle.flush()
+
         except Exception as e:
             print("Writer exception", e)
             results_queue.put(WriterTaskResult(False, task))
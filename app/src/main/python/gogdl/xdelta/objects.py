@@ -135,5 +135,14 @@ def build_code_table():
 
 CODE_TABLE = build_code_table()
 
+# (type, size) pairs of non empty halves for each opcode, size 0 means it follows in instructions
+HALF_INSTRUCTIONS = [
+    tuple((inst_type, size) for inst_type, size in ((ins.type1, ins.size1), (ins.type2, ins.size2)) if inst_type != XD3_NOOP)
+    for ins in CODE_TABLE
+]
+
 class ChecksumMissmatch(AssertionError):
     pass
+
+class InvalidPatch(ValueError):
+    pass
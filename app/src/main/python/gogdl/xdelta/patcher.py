@@ -1,8 +1,7 @@
-from io import BytesIO
-import math
-from multiprocessing import Queue
+import mmap
+import os
 from zlib import adler32
-from gogdl.xdelta import objects
+from gogdl.xdelta import objects, secondary
 
 # Convert stfio integer
 def read_integer_stream(stream):
@@ -16,82 +15,149 @@ def read_integer_stream(stream):
 
     return res
 
-def parse_halfinst(context: objects.Context, halfinst: objects.HalfInstruction):
-    if halfinst.size == 0:
-        halfinst.size = read_integer_stream(context.inst_sec)
-
-    if halfinst.type >= objects.XD3_CPY:
-        # Decode address
-        mode = halfinst.type - objects.XD3_CPY
-        same_start = 2 + context.acache.s_near
-
-        if mode < same_start:
-            halfinst.addr = read_integer_stream(context.addr_sec)
-
-            if mode == 0:
-                pass
-            elif mode == 1:
-                halfinst.addr = context.dec_pos - halfinst.addr
-                if halfinst.addr < 0:
-                    halfinst.addr = context.cpy_len + halfinst.addr
-            else:
-                halfinst.addr += context.acache.near_array[mode - 2]
-        else:
-            mode -= same_start
-            addr = context.addr_sec.read(1)[0]
-            halfinst.addr = context.acache.same_array[(mode * 256) + addr]
-        context.acache.update(halfinst.addr)
-
-    context.dec_pos += halfinst.size
-
-
-def decode_halfinst(context:objects.Context, halfinst: objects.HalfInstruction, speed_queue: Queue):
-    take = halfinst.size
-
-    if halfinst.type == objects.XD3_RUN:
-        byte = context.data_sec.read(1)
-
-        for _ in range(take):
-            context.target_buffer.extend(byte)
-
-        halfinst.type = objects.XD3_NOOP
-    elif halfinst.type == objects.XD3_ADD:
-        buffer = context.data_sec.read(take)
-        assert len(buffer) == take
-        context.target_buffer.extend(buffer)
-        halfinst.type = objects.XD3_NOOP
-    else: # XD3_CPY and higher
-        if halfinst.addr < (context.cpy_len or 0):
-            context.source.seek(context.cpy_off + halfinst.addr)
-            left = take
-            while left > 0:
-                buffer = context.source.read(min(1024 * 1024, left))
-                size = len(buffer)
-                speed_queue.put((0, size))
-                context.target_buffer.extend(buffer)
-                left -= size
-
-        else:
-            print("OVERLAP NOT IMPLEMENTED")
-            raise Exception("OVERLAP")
-        halfinst.type = objects.XD3_NOOP
-
-
-def patch(source: str, patch: str, out: str, speed_queue: Queue):
-    src_handle = open(source, 'rb') 
-    patch_handle = open(patch, 'rb')
-    dst_handle = open(out, 'wb')
-
-
+def read_integer(data, pos):
+    """Decodes integer at pos of data, returns it with position of the next byte"""
+    res = 0
+    while True:
+        integer = data[pos]
+        pos += 1
+        res = (res << 7) | (integer & 0b1111111)
+        if not (integer & 0b10000000):
+            return res, pos
+
+
+def decode_window(source, cpy_len, data_sec, inst_sec, addr_sec, window_length, speed_counter):
+    """Decodes instructions of a single window into a new target window
+
+    Hot loop of the patcher, kept flat on purpose: instruction halves come
+    from a prebuilt table, integers fitting one byte are decoded inline, code table
+    constants are inlined and every ADD/RUN/CPY appends a single slice to the target,
+    so Python work is per instruction rather than per byte.
+    """
+    target = bytearray()
+    code_table = objects.HALF_INSTRUCTIONS
+    # Default code table: 4 near and 3 same modes, see objects.CodeTable
+    near_array = [0, 0, 0, 0]
+    same_array = [0] * 768
+    next_slot = 0
+
+    pos = 0
+    data_pos = 0
+    addr_pos = 0
+    inst_pos = 0
+    inst_len = len(inst_sec)
+    copied = 0
+
+    while inst_pos < inst_len:
+        halves = code_table[inst_sec[inst_pos]]
+        inst_pos += 1
+        for inst_type, size in halves:
+            if not size:
+                size = inst_sec[inst_pos]
+                if size < 0x80:
+                    inst_pos += 1
+                else:
+                    size, inst_pos = read_integer(inst_sec, inst_pos)
+
+            if inst_type == 1: # XD3_ADD
+                target += data_sec[data_pos:data_pos + size]
+                data_pos += size
+            elif inst_type == 2: # XD3_RUN
+                target += bytes((data_sec[data_pos],)) * size
+                data_pos += 1
+            else: # XD3_CPY and higher
+                if inst_type >= 9:
+                    # Same modes
+                    addr = same_array[(inst_type - 9) * 256 + addr_sec[addr_pos]]
+                    addr_pos += 1
+                else:
+                    addr = addr_sec[addr_pos]
+                    if addr < 0x80:
+                        addr_pos += 1
+                    else:
+                        addr, addr_pos = read_integer(addr_sec, addr_pos)
+                    if inst_type == 4:
+                        # Relative to current position in source + target address space
+                        addr = cpy_len + pos - addr
+                    elif inst_type != 3:
+                        # Near modes
+                        addr += near_array[inst_type - 5]
+                near_array[next_slot] = addr
+                next_slot = (next_slot + 1) & 3
+                same_array[addr % 768] = addr
+
+                if addr + size <= cpy_len:
+                    target += source[addr:addr + size]
+                    copied += size
+                elif addr < cpy_len:
+                    raise objects.InvalidPatch("Copy spans source segment and target window")
+                else:
+                    # Copy from the part of target window decoded so far
+                    addr -= cpy_len
+                    if addr >= pos:
+                        raise objects.InvalidPatch("Copy address past decoded target")
+                    if addr + size <= pos:
+                        target += target[addr:addr + size]
+                    else:
+                        # Overlapping copy repeats the bytes between addr and pos
+                        period = target[addr:pos]
+                        target += (period * (size // len(period) + 1))[:size]
+            pos += size
+
+    if pos != window_length:
+        raise objects.ChecksumMissmatch(f"Window decoded to {pos} bytes instead of {window_length}")
+    speed_counter.add(0, copied)
+    return target
+
+
+def decompress_section(decoder, section):
+    """Decodes section compressed with secondary compressor, prefixed with its decoded size"""
+    if decoder is None:
+        raise objects.InvalidPatch("Compressed section in patch without secondary compressor")
+    size, pos = read_integer(section, 0)
+    if not size:
+        raise objects.InvalidPatch("Invalid decoded size of compressed section")
+    return decoder.decode(section[pos:], size)
+
+
+def map_source(handle):
+    """Maps source file read only, returns the mapping and a view of it
+
+    Empty files can't be mapped, they get an empty view without a mapping.
+    """
+    if not os.fstat(handle.fileno()).st_size:
+        return None, memoryview(b'')
+    source_map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    return source_map, memoryview(source_map)
+
+
+def patch(source: str, patch: str, out: str, speed_counter):
+    # Output is readable, as VCD_TARGET windows copy from previously written target
+    with open(source, 'rb') as src_handle, open(patch, 'rb') as patch_handle, open(out, 'w+b') as dst_handle:
+        source_map, source_view = map_source(src_handle)
+        try:
+            apply_windows(source_view, patch_handle, dst_handle, speed_counter)
+            dst_handle.flush()
+        finally:
+            source_view.release()
+            if source_map is not None:
+                try:
+                    source_map.close()
+                except BufferError:
+                    # Slices are still referenced by a traceback, mapping goes away with them
+                    pass
+
+
+def apply_windows(source_view, patch_handle, dst_handle, speed_counter):
+    """Decodes windows of patch_handle into dst_handle
+
+    Source copies are sliced from source_view, a mapping of the whole source file,
+    so pages are read by the kernel on demand and only the target window is held in memory.
+    """
     # Verify if patch is actually xdelta patch
     headers = patch_handle.read(5)
-    try:
-        assert headers[0] == 0xD6
-        assert headers[1] == 0xC3
-        assert headers[2] == 0xC4
-    except AssertionError:
-        print("Specified patch file is unlikely to be xdelta patch")
-        return
+    if len(headers) < 5 or headers[:3] != b'\xd6\xc3\xc4':
+        raise objects.InvalidPatch("Specified patch file is unlikely to be xdelta patch")
 
     HDR_INDICATOR = headers[4]
     COMPRESSOR_ID = HDR_INDICATOR & (1 << 0) != 0
@@ -99,44 +165,57 @@ def patch(source: str, patch: str, out: str, speed_queue: Queue):
     APP_HEADER = HDR_INDICATOR & (1 << 2) != 0
     app_header_data = bytes()
 
-    if COMPRESSOR_ID or CODE_TABLE:
-        print("Compressor ID and codetable are yet not supported")
-        return
+    # Secondary decoders keep their state across windows, one for each section type
+    data_decoder = inst_decoder = addr_decoder = None
+    if COMPRESSOR_ID:
+        compressor_id = patch_handle.read(1)[0]
+        data_decoder = secondary.get_decoder(compressor_id)
+        inst_decoder = secondary.get_decoder(compressor_id)
+        addr_decoder = secondary.get_decoder(compressor_id)
+
+    if CODE_TABLE:
+        # Not produced nor accepted by xdelta3 either
+        raise objects.InvalidPatch("Application defined code tables are not supported")
 
     if APP_HEADER:
         app_header_size = read_integer_stream(patch_handle)
         app_header_data = patch_handle.read(app_header_size)
 
-    context = objects.Context(src_handle, dst_handle, BytesIO(), BytesIO(), BytesIO(), objects.AddressCache())
-
     win_number = 0
-    win_indicator = patch_handle.read(1)[0]
-    while win_indicator is not None:
-        context.acache = objects.AddressCache()
+    while True:
+        indicator = patch_handle.read(1)
+        if not len(indicator):
+            break
+        win_indicator = indicator[0]
         source_used = win_indicator & (1 << 0) != 0
         target_used = win_indicator & (1 << 1) != 0
         adler32_sum = win_indicator & (1 << 2) != 0
 
-        if source_used:
+        if source_used and target_used:
+            raise objects.InvalidPatch("Window copies from both source and target")
+        if source_used or target_used:
             source_segment_length = read_integer_stream(patch_handle)
             source_segment_position = read_integer_stream(patch_handle)
         else:
             source_segment_length = 0
             source_segment_position = 0
 
-        context.cpy_len = source_segment_length
-        context.cpy_off = source_segment_position
-        context.source.seek(context.cpy_off or 0)
-        context.dec_pos = 0
+        if target_used:
+            dst_handle.seek(source_segment_position)
+            source_segment = memoryview(dst_handle.read(source_segment_length))
+            dst_handle.seek(0, 2)
+        else:
+            source_segment = source_view[source_segment_position:source_segment_position + source_segment_length]
+        if len(source_segment) != source_segment_length:
+            raise objects.ChecksumMissmatch("Source file is shorter than patch expects")
 
         # Parse delta
         delta_encoding_length = read_integer_stream(patch_handle)
 
         window_length = read_integer_stream(patch_handle)
-        context.target_buffer = bytearray()
 
         delta_indicator = patch_handle.read(1)[0]
-        
+
         add_run_data_length = read_integer_stream(patch_handle)
         instructions_length = read_integer_stream(patch_handle)
         addresses_length = read_integer_stream(patch_handle)
@@ -145,60 +224,28 @@ def patch(source: str, patch: str, out: str, speed_queue: Queue):
         if adler32_sum:
             checksum = patch_handle.read(4)
             parsed_sum = int.from_bytes(checksum, 'big')
-        
-
-        context.data_sec = BytesIO(patch_handle.read(add_run_data_length))
-        context.inst_sec = BytesIO(patch_handle.read(instructions_length))
-        context.addr_sec = BytesIO(patch_handle.read(addresses_length))
-
-
-        current1 = objects.HalfInstruction()
-        current2 = objects.HalfInstruction()
-
-        while context.inst_sec.tell() < instructions_length or current1.type != objects.XD3_NOOP or current2.type != objects.XD3_NOOP:
-            if current1.type == objects.XD3_NOOP and current2.type == objects.XD3_NOOP:
-                ins = objects.CODE_TABLE[context.inst_sec.read(1)[0]]
-                current1.type = ins.type1
-                current2.type = ins.type2
-                current1.size = ins.size1
-                current2.size = ins.size2
-    
-                if current1.type != objects.XD3_NOOP:
-                    parse_halfinst(context, current1)
-                if current2.type != objects.XD3_NOOP:
-                    parse_halfinst(context, current2)
-            
-            while current1.type != objects.XD3_NOOP:
-                decode_halfinst(context, current1, speed_queue)
-                
-            while current2.type != objects.XD3_NOOP:
-                decode_halfinst(context, current2, speed_queue)
 
-        if adler32_sum:
-            calculated_sum = adler32(context.target_buffer)
-            if parsed_sum != calculated_sum:
-                raise objects.ChecksumMissmatch
 
-        total_size = len(context.target_buffer)
-        chunk_size = 1024 * 1024
-        for i in range(math.ceil(total_size / chunk_size)):
-            chunk = context.target_buffer[i * chunk_size : min((i + 1) * chunk_size, total_size)]
-            context.target.write(chunk)
-            speed_queue.put((len(chunk), 0))
-            
-        context.target.flush()
+        data_sec = patch_handle.read(add_run_data_length)
+        inst_sec = patch_handle.read(instructions_length)
+        addr_sec = patch_handle.read(addresses_length)
 
-        indicator = patch_handle.read(1)
-        if not len(indicator):
-            win_indicator = None
-            continue
-        win_indicator = indicator[0]
-        win_number += 1
+        if delta_indicator & 1: # VCD_DATACOMP
+            data_sec = decompress_section(data_decoder, data_sec)
+        if delta_indicator & 2: # VCD_INSTCOMP
+            inst_sec = decompress_section(inst_decoder, inst_sec)
+        if delta_indicator & 4: # VCD_ADDRCOMP
+            addr_sec = decompress_section(addr_decoder, addr_sec)
 
+        with source_segment:
+            target_buffer = decode_window(source_segment, source_segment_length, data_sec, inst_sec, addr_sec,
+                                          window_length, speed_counter)
 
-    dst_handle.flush()
-    src_handle.close()
-    patch_handle.close()
-    dst_handle.close()
+        if adler32_sum:
+            calculated_sum = adler32(target_buffer)
+            if parsed_sum != calculated_sum:
+                raise objects.ChecksumMissmatch
 
- 
+        dst_handle.write(target_buffer)
+        speed_counter.add(len(target_buffer), 0)
+        win_number += 1
@@ -0,0 +1,534 @@
+# Secondary decompressors of VCDIFF sections, ported from xdelta3
+# (xdelta3-djw.h, xdelta3-fgk.h and xdelta3-lzma.h)
+import lzma
+
+from gogdl.xdelta.objects import InvalidPatch
+
+# Compressor ids written to the header when VCD_SECONDARY is set
+DJW_ID = 1
+LZMA_ID = 2
+FGK_ID = 16
+
+ALPHABET_SIZE = 256
+
+# DJW constants, see xdelta3-djw.h
+DJW_MAX_CODELEN = 20
+DJW_TOTAL_CODES = 22  # RUN_0, RUN_1 and code lengths 1 to 20
+RUN_1 = 1
+DJW_EXTRA_12OFFSET = 7
+DJW_EXTRA_CODE_BITS = 4
+DJW_GROUP_BITS = 3
+DJW_SECTORSZ_MULT = 5
+DJW_SECTORSZ_BITS = 5
+DJW_MAX_CLCLEN = 15
+DJW_CLCLEN_BITS = 4
+DJW_MAX_GBCLEN = 7
+DJW_GBCLEN_BITS = 3
+# Initial move to front state of code lengths: 0, then basic and extra codes
+DJW_CLEN_MTF = [0, 4, 5, 6, 7, 8, 9, 10, 3, 11, 2, 12, 13, 1, 14, 15, 16, 17, 18, 19, 20]
+
+# Width of the table resolving short codes with a single lookup
+LOOKUP_BITS = 10
+
+
+class BitReader:
+    """Reads bits in xdelta3 order, least significant bit of each byte first"""
+    __slots__ = ('data', 'pos', 'acc', 'bits')
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.acc = 0
+        self.bits = 0
+
+    def fill(self):
+        data = self.data
+        while self.bits <= 32 and self.pos < len(data):
+            self.acc |= data[self.pos] << self.bits
+            self.pos += 1
+            self.bits += 8
+
+    def read_bits(self, nbits):
+        """Reads nbits as a number, first bit being the most significant one"""
+        self.fill()
+        if self.bits < nbits:
+            raise InvalidPatch("Secondary decoder end of input")
+        value = 0
+        for _ in range(nbits):
+            value = (value << 1) | (self.acc & 1)
+            self.acc >>= 1
+        self.bits -= nbits
+        return value
+
+    def decode_symbol(self, table):
+        self.fill()
+        entry = table.lookup[self.acc & table.lookup_mask]
+        if entry < 0:
+            entry = table.decode_slow(self.acc, self.bits)
+        length = entry & 31
+        if length > self.bits:
+            raise InvalidPatch("Secondary decoder end of input")
+        self.acc >>= length
+        self.bits -= length
+        return entry >> 5
+
+    def consumed(self):
+        """Number of input bytes touched, partially used last byte included"""
+        return (self.pos * 8 - self.bits + 7) // 8
+
+
+class HuffmanTable:
+    """Canonical Huffman decoder built from code lengths, as djw_build_decoder does
+
+    Codes up to LOOKUP_BITS long resolve with one lookup indexed by the next input bits,
+    entries are symbol << 5 | code length. Longer codes walk the limit table bit by bit.
+    """
+    __slots__ = ('lookup', 'lookup_mask', 'limit', 'base', 'inorder', 'min_clen', 'max_clen')
+
+    def __init__(self, clen, abs_max):
+        nr_clen = [0] * (abs_max + 1)
+        for length in clen:
+            if length > abs_max:
+                raise InvalidPatch("Secondary decoder invalid code length")
+            nr_clen[length] += 1
+
+        lengths = [length for length in range(1, abs_max + 1) if nr_clen[length]]
+        self.min_clen = lengths[0] if lengths else abs_max + 1
+        self.max_clen = lengths[-1] if lengths else 0
+
+        self.limit = [0] * (abs_max + 2)
+        self.base = [0] * (abs_max + 2)
+        tmp_base = [0] * (abs_max + 2)
+        if lengths:
+            self.limit[self.min_clen] = nr_clen[self.min_clen] - 1
+            for i in range(self.min_clen + 1, self.max_clen + 1):
+                last_limit = (self.limit[i - 1] + 1) << 1
+                tmp_base[i] = tmp_base[i - 1] + nr_clen[i - 1]
+                self.limit[i] = last_limit + nr_clen[i] - 1
+                self.base[i] = last_limit - tmp_base[i]
+
+        self.inorder = [0] * len(clen)
+        for symbol, length in enumerate(clen):
+            if length:
+                self.inorder[tmp_base[length]] = symbol
+                tmp_base[length] += 1
+
+        lookup_bits = min(self.max_clen, LOOKUP_BITS)
+        self.lookup_mask = (1 << lookup_bits) - 1
+        self.lookup = [-1] * (1 << lookup_bits)
+        for length in range(self.min_clen, lookup_bits + 1):
+            first = self.limit[length] - nr_clen[length] + 1
+            for code in range(first, self.limit[length] + 1):
+                # Input order is the code read from its most significant bit
+                index = int(format(code, f'0{length}b')[::-1], 2)
+                entry = self.inorder[code - self.base[length]] << 5 | length
+                for high in range(1 << (lookup_bits - length)):
+                    self.lookup[index | (high << length)] = entry
+
+    def decode_slow(self, acc, available):
+        code = 0
+        for bits in range(1, self.max_clen + 1):
+            if bits > available:
+                raise InvalidPatch("Secondary decoder end of input")
+            code = (code << 1) | (acc & 1)
+            acc >>= 1
+            if bits >= self.min_clen and code <= self.limit[bits]:
+                offset = code - self.base[bits]
+                if offset < 0:
+                    break
+                return self.inorder[offset] << 5 | bits
+        raise InvalidPatch("Secondary decoder invalid code")
+
+
+def decode_1_2(reader, table, mtf_values, elements, skip_offset=0):
+    """Decodes move to front values with RUN_0/RUN_1 coded repeats, see djw_decode_1_2"""
+    values = [0] * elements
+    n = rep = mtf = s = 0
+    while n < elements:
+        if skip_offset and n >= skip_offset and values[n - skip_offset] == 0:
+            # Symbols unused by the first group are unused by the rest
+            n += 1
+            continue
+        if rep:
+            values[n] = mtf_values[0]
+            n += 1
+            rep -= 1
+            continue
+        if mtf:
+            symbol = mtf_values.pop(mtf)
+            mtf_values.insert(0, symbol)
+            values[n] = symbol
+            n += 1
+            mtf = 0
+            continue
+
+        mtf = reader.decode_symbol(table)
+        if mtf <= RUN_1:
+            rep = (mtf + 1) << s
+            mtf = 0
+            s += 1
+        else:
+            mtf -= 1
+            s = 0
+
+    if rep:
+        raise InvalidPatch("Secondary decoder invalid repeat code")
+    return values
+
+
+class DjwDecoder:
+    """Semi-static Huffman coding with up to 8 code tables selected per sector"""
+
+    def decode(self, data, size):
+        reader = BitReader(data)
+        groups = reader.read_bits(DJW_GROUP_BITS) + 1
+        if groups > 1:
+            sector_size = (reader.read_bits(DJW_SECTORSZ_BITS) + 1) * DJW_SECTORSZ_MULT
+        else:
+            sector_size = size
+        sectors = 1 + (size - 1) // sector_size
+
+        # Code length decoder
+        num_codes = reader.read_bits(DJW_EXTRA_CODE_BITS) + DJW_EXTRA_12OFFSET
+        cl_clen = [reader.read_bits(DJW_CLCLEN_BITS) for _ in range(num_codes)]
+        cl_clen += [0] * (DJW_TOTAL_CODES - num_codes)
+        cl_table = HuffmanTable(cl_clen, DJW_MAX_CLCLEN)
+
+        clen = decode_1_2(reader, cl_table, list(DJW_CLEN_MTF), ALPHABET_SIZE * groups, ALPHABET_SIZE)
+        tables = [HuffmanTable(clen[gp * ALPHABET_SIZE:(gp + 1) * ALPHABET_SIZE], DJW_MAX_CODELEN)
+                  for gp in range(groups)]
+
+        if groups > 1:
+            sel_clen = [reader.read_bits(DJW_GBCLEN_BITS) for _ in range(groups + 1)]
+            sel_table = HuffmanTable(sel_clen, DJW_MAX_GBCLEN)
+            sel_group = decode_1_2(reader, sel_table, list(range(groups + 1)), sectors)
+        else:
+            sel_group = [0] * sectors
+
+        output = bytearray(size)
+        # Main loop keeps the bit reader state in locals
+        data_len = len(data)
+        pos, acc, bits = reader.pos, reader.acc, reader.bits
+        out_pos = 0
+        for sector in range(sectors):
+            gp = sel_group[sector]
+            if gp >= groups:
+                raise InvalidPatch("Secondary decoder invalid group")
+            table = tables[gp]
+            lookup = table.lookup
+            mask = table.lookup_mask
+            end = min(out_pos + sector_size, size)
+            while out_pos < end:
+                if bits < DJW_MAX_CODELEN:
+                    if pos + 4 <= data_len:
+                        acc |= int.from_bytes(data[pos:pos + 4], 'little') << bits
+                        pos += 4
+                        bits += 32
+                    else:
+                        while bits <= 32 and pos < data_len:
+                            acc |= data[pos] << bits
+                            pos += 1
+                            bits += 8
+                entry = lookup[acc & mask]
+                if entry < 0:
+                    entry = table.decode_slow(acc, bits)
+                length = entry & 31
+                if length > bits:
+                    raise InvalidPatch("Secondary decoder end of input")
+                acc >>= length
+                bits -= length
+                output[out_pos] = entry >> 5
+                out_pos += 1
+        reader.pos, reader.acc, reader.bits = pos, acc, bits
+
+        if reader.consumed() != data_len:
+            raise InvalidPatch("Secondary decoder finished with unused input")
+        return output
+
+
+class FgkNode:
+    __slots__ = ('index', 'weight', 'parent', 'left_child', 'right_child', 'left', 'right', 'my_block')
+
+    def __init__(self, index):
+        self.index = index
+        self.weight = 0
+        self.parent = None
+        self.left_child = None
+        self.right_child = None
+        self.left = None
+        self.right = None
+        self.my_block = None
+
+
+class FgkBlock:
+    __slots__ = ('block_leader', 'block_freeptr')
+
+    def __init__(self):
+        self.block_leader = None
+        self.block_freeptr = None
+
+
+class FgkDecoder:
+    """Adaptive Huffman coding, the tree carries over from one window to the next"""
+
+    def __init__(self):
+        total_nodes = 2 * ALPHABET_SIZE - 1
+        self.alphabet = [FgkNode(i) for i in range(total_nodes)]
+        self.blocks = [FgkBlock() for _ in range(2 * total_nodes)]
+        for block, next_block in zip(self.blocks, self.blocks[1:]):
+            block.block_freeptr = next_block
+        self.free_block = self.blocks[0]
+
+        self.root_node = self.alphabet[0]
+        self.decode_ptr = self.root_node
+        self.free_node = ALPHABET_SIZE
+        self.remaining_zeros = self.alphabet[0]
+        self.coded_bits = []
+
+        self.zero_freq_count = ALPHABET_SIZE + 2
+        self.zero_freq_exp = 0
+        self.zero_freq_rem = 0
+        self.factor_remaining()
+        self.factor_remaining()
+
+        # Zero frequency nodes form a list linked through children pointers
+        for i in range(ALPHABET_SIZE):
+            node = self.alphabet[i]
+            node.right_child = self.alphabet[i + 1] if i < ALPHABET_SIZE - 1 else None
+            node.left_child = self.alphabet[i - 1] if i >= 1 else None
+
+    def decode(self, data, size):
+        output = bytearray()
+        last = len(data) - 1
+        for i, byte in enumerate(data):
+            for bit in range(8):
+                if not self.decode_bit((byte >> bit) & 1):
+                    continue
+                output.append(self.decode_data())
+                if len(output) == size:
+                    if i != last:
+                        raise InvalidPatch("Secondary decoder finished with unused input")
+                    return output
+        raise InvalidPatch("Secondary decoder end of input")
+
+    def decode_bit(self, bit):
+        if self.decode_ptr.weight == 0:
+            bits_required = self.zero_freq_exp + (1 if self.zero_freq_rem else 0)
+            self.coded_bits.append(bit)
+            return len(self.coded_bits) >= bits_required
+
+        self.decode_ptr = self.decode_ptr.right_child if bit else self.decode_ptr.left_child
+        if self.decode_ptr.left_child is None:
+            # Leaf, zero weight one is complete only if it's the last zero left
+            return self.decode_ptr.weight != 0 or self.zero_freq_count == 1
+        return False
+
+    def decode_data(self):
+        element = self.decode_ptr.index
+        if self.decode_ptr.weight == 0:
+            n = 0
+            for bit in self.coded_bits:
+                n = (n << 1) | bit
+            element = self.nth_zero(n)
+        self.coded_bits.clear()
+        self.update_tree(element)
+        self.decode_ptr = self.root_node
+        return element
+
+    def nth_zero(self, n):
+        node = self.remaining_zeros
+        while n and node.right_child is not None:
+            node = node.right_child
+            n -= 1
+        return node.index
+
+    def factor_remaining(self):
+        self.zero_freq_count -= 1
+        i = self.zero_freq_count
+        self.zero_freq_exp = 0
+        while i > 1:
+            self.zero_freq_exp += 1
+            i >>= 1
+        self.zero_freq_rem = self.zero_freq_count - (1 << self.zero_freq_exp)
+
+    def make_block(self, lead):
+        block = self.free_block
+        if block is None:
+            raise InvalidPatch("Secondary decoder ran out of blocks")
+        self.free_block = block.block_freeptr
+        block.block_leader = lead
+        return block
+
+    def free(self, block):
+        block.block_freeptr = self.free_block
+        self.free_block = block
+
+    def update_tree(self, n):
+        node = self.alphabet[n]
+        if node.weight == 0:
+            node = self.increase_zero_weight(n)
+        while node is not self.root_node:
+            self.move_right(node)
+            self.promote(node)
+            node.weight += 1
+            node = node.parent
+        self.root_node.weight += 1
+
+    def move_right(self, move_fwd):
+        move_back = move_fwd.my_block.block_leader
+        if move_fwd is move_back or move_fwd.parent is move_back or move_fwd.weight == 0:
+            return
+
+        move_back.right.left = move_fwd
+        if move_fwd.left:
+            move_fwd.left.right = move_back
+
+        tmp = move_fwd.right
+        move_fwd.right = move_back.right
+        if tmp is move_back:
+            move_back.right = move_fwd
+        else:
+            tmp.left = move_back
+            move_back.right = tmp
+
+        tmp = move_back.left
+        move_back.left = move_fwd.left
+        if tmp is move_fwd:
+            move_fwd.left = move_back
+        else:
+            tmp.right = move_fwd
+            move_fwd.left = tmp
+
+        # Swap places in parents, which may be the same node
+        fwd_parent = move_fwd.parent
+        fwd_side = 'right_child' if fwd_parent.right_child is move_fwd else 'left_child'
+        back_parent = move_back.parent
+        back_side = 'right_child' if back_parent.right_child is move_back else 'left_child'
+        move_fwd.parent, move_back.parent = back_parent, fwd_parent
+        fwd_child = getattr(fwd_parent, fwd_side)
+        setattr(fwd_parent, fwd_side, getattr(back_parent, back_side))
+        setattr(back_parent, back_side, fwd_child)
+
+        move_fwd.my_block.block_leader = move_fwd
+
+    def promote(self, node):
+        my_right = node.right
+        my_left = node.left
+        cur_block = node.my_block
+        if node.weight == 0:
+            return
+
+        if my_left is node.right_child and node.left_child and node.left_child.weight == 0:
+            # Parent of the remaining zeros, right child weight was already incremented
+            if node.weight == my_right.weight - 1 and my_right is not self.root_node:
+                self.free(cur_block)
+                node.my_block = my_right.my_block
+                my_left.my_block = my_right.my_block
+            return
+
+        if my_left is self.remaining_zeros:
+            return
+
+        if my_left.my_block is cur_block:
+            my_left.my_block.block_leader = my_left
+        else:
+            self.free(cur_block)
+
+        if node.weight == my_right.weight - 1 and my_right is not self.root_node:
+            node.my_block = my_right.my_block
+        else:
+            node.my_block = self.make_block(node)
+
+    def increase_zero_weight(self, n):
+        this_zero = self.alphabet[n]
+        if self.zero_freq_count == 1:
+            # Last zero left
+            this_zero.right_child = None
+            if this_zero.right.weight == 1:
+                this_zero.my_block = this_zero.right.my_block
+            else:
+                this_zero.my_block = self.make_block(this_zero)
+            self.remaining_zeros = None
+            return this_zero
+
+        zero_ptr = self.remaining_zeros
+        new_internal = self.alphabet[self.free_node]
+        self.free_node += 1
+        new_internal.parent = zero_ptr.parent
+        new_internal.right = zero_ptr.right
+        new_internal.weight = 0
+        new_internal.right_child = this_zero
+        new_internal.left = this_zero
+
+        if self.remaining_zeros is self.root_node:
+            # First element coded
+            self.root_node = new_internal
+            this_zero.my_block = self.make_block(this_zero)
+            new_internal.my_block = self.make_block(new_internal)
+        else:
+            new_internal.right.left = new_internal
+            if zero_ptr.parent.right_child is zero_ptr:
+                zero_ptr.parent.right_child = new_internal
+            else:
+                zero_ptr.parent.left_child = new_internal
+            if new_internal.right.weight == 1:
+                new_internal.my_block = new_internal.right.my_block
+            else:
+                new_internal.my_block = self.make_block(new_internal)
+            this_zero.my_block = new_internal.my_block
+
+        self.eliminate_zero(this_zero)
+
+        new_internal.left_child = self.remaining_zeros
+        this_zero.right = new_internal
+        this_zero.left = self.remaining_zeros
+        this_zero.parent = new_internal
+        this_zero.left_child = None
+        this_zero.right_child = None
+
+        self.remaining_zeros.parent = new_internal
+        self.remaining_zeros.right = this_zero
+        return this_zero
+
+    def eliminate_zero(self, node):
+        if self.zero_freq_count == 1:
+            return
+        self.factor_remaining()
+        if node.left_child is None:
+            self.remaining_zeros = self.remaining_zeros.right_child
+            self.remaining_zeros.left_child = None
+        elif node.right_child is None:
+            node.left_child.right_child = None
+        else:
+            node.right_child.left_child = node.left_child
+            node.left_child.right_child = node.right_child
+
+
+class LzmaDecoder:
+    """Sections are flushed parts of a single xz stream"""
+
+    def __init__(self):
+        self.decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+    def decode(self, data, size):
+        try:
+            output = self.decompressor.decompress(data)
+        except lzma.LZMAError as e:
+            raise InvalidPatch(f"Secondary decoder error {e}") from e
+        if len(output) != size:
+            raise InvalidPatch("Secondary decoder short output")
+        return output
+
+
+DECODERS = {
+    DJW_ID: DjwDecoder,
+    LZMA_ID: LzmaDecoder,
+    FGK_ID: FgkDecoder,
+}
+
+
+def get_decoder(compressor_id):
+    decoder = DECODERS.get(compressor_id)
+    if decoder is None:
+        raise InvalidPatch(f"Unsupported secondary compressor {compressor_id}")
+    return decoder()
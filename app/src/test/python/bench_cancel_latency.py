@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Cancel-to-idle latency test of ExecutingManager.
+
+Runs a v2 download against a local HTTP server that sends the first bytes of every
+chunk and then stalls, so all download workers end up blocked in a socket read.
+The download is then cancelled the way the Android bridge does it, with
+cancellation.cancel(game_id), and the time until run() returns is measured. run()
+has to return within the bound, with every worker thread finished and the temp
+directory removed. Runs alternate between keep-alive (HTTP/1.1) responses and ones
+the server closes after the body (HTTP/1.0), their sockets are reached differently.
+
+Usage: python bench_cancel_latency.py [runs, default 5] [bound in seconds, default 1.0]
+"""
+
+import hashlib
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "main" / "python"))
+
+from gogdl.dl import cancellation
+from gogdl.dl.managers.task_executor import ExecutingManager
+from gogdl.dl.objects import v2
+
+CHUNK_SIZE = 1024 * 1024
+WORKERS = 6
+
+
+class StallingHandler(BaseHTTPRequestHandler):
+    """Sends headers and 64 KiB of a chunk, then holds the connection until server stops"""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(CHUNK_SIZE))
+        self.end_headers()
+        try:
+            self.wfile.write(bytes(64 * 1024))
+            self.wfile.flush()
+        except OSError:
+            return
+        self.server.requests.release()
+        self.server.stopped.wait()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_diff(count):
+    diff = v2.ManifestDiff()
+    for i in range(count):
+        md5 = hashlib.md5(str(i).encode()).hexdigest()
+        diff.new.append(v2.DepotFile({"path": f"game\\file{i}.dat", "flags": [], "md5": md5,
+                                      "chunks": [{"md5": md5, "compressedMd5": hashlib.md5(md5.encode()).hexdigest(),
+                                                  "size": CHUNK_SIZE, "compressedSize": CHUNK_SIZE}]}, "1"))
+    return diff
+
+
+def cancel_once(server, secure_links):
+    """Returns seconds from cancel to run() returning"""
+    path = tempfile.mkdtemp(prefix="bench_cancel_")
+    try:
+        manager = ExecutingManager(None, WORKERS, path, None, make_diff(WORKERS * 4), secure_links, game_id="bench")
+        assert manager.setup()
+        result = list()
+        runner = threading.Thread(target=lambda: result.append(manager.run()))
+        runner.start()
+
+        # Every worker is blocked reading a chunk
+        workers = manager.concurrency.limit
+        for _ in range(workers):
+            assert server.requests.acquire(timeout=10), "download didn't start"
+        time.sleep(0.1)
+
+        started = time.perf_counter()
+        assert cancellation.cancel("bench")
+        runner.join(timeout=30)
+        elapsed = time.perf_counter() - started
+
+        assert not runner.is_alive(), "run() didn't return"
+        assert result == [True], result
+        alive = [t for t in manager.threads + manager.download_workers + manager.writer_workers if t.is_alive()]
+        assert not alive, f"threads still running after run() returned: {alive}"
+        assert not Path(manager.temp_dir).exists(), "temp directory left behind"
+        return elapsed, workers
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    bound = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StallingHandler)
+    server.daemon_threads = True
+    server.requests = threading.Semaphore(0)
+    server.stopped = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    secure_links = {"1": [{"url_format": f"http://127.0.0.1:{server.server_port}{{path}}",
+                           "parameters": {"path": "/content"}}]}
+    try:
+        samples = list()
+        for run in range(runs):
+            StallingHandler.protocol_version = "HTTP/1.1" if run % 2 else "HTTP/1.0"
+            elapsed, workers = cancel_once(server, secure_links)
+            samples.append(elapsed)
+        print(f"cancel to idle with {workers} blocked reads: median {statistics.median(samples) * 1000:.1f} ms, "
+              f"max {max(samples) * 1000:.1f} ms over {runs} runs")
+        assert max(samples) < bound, f"cancel took {max(samples):.2f}s, bound is {bound}s"
+    finally:
+        server.stopped.set()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
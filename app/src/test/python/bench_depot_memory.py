@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark of the v2 depot file model.
+
+Builds two synthetic manifests (the old and new side of an update) and measures with
+tracemalloc how much memory their files hold once parsed: first as the JSON chunk dicts
+DepotFile used to keep, then as the current DepotFile with its ChunkTable. Also times
+parsing and ManifestDiff.compare of the current model.
+
+Usage: python bench_depot_memory.py [files per manifest, default 30000] [chunks per file, default 10]
+"""
+
+import gc
+import hashlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "main" / "python"))
+
+from gogdl import constants
+from gogdl.dl.objects import v2
+
+
+class DictDepotFile:
+    """DepotFile before the columnar model, keeps chunks as parsed from JSON"""
+
+    def __init__(self, item_data, product_id):
+        self.flags = item_data.get("flags") or list()
+        self.path = item_data["path"].replace(constants.NON_NATIVE_SEP, os.sep).lstrip(os.sep)
+        if "support" in self.flags:
+            self.path = os.path.join(product_id, self.path)
+        self.chunks = item_data["chunks"]
+        self.md5 = item_data.get("md5")
+        self.sha256 = item_data.get("sha256")
+        self.product_id = product_id
+
+
+def digest(*values):
+    return hashlib.md5(repr(values).encode()).hexdigest()
+
+
+def manifest_items(tag, file_count, chunk_count, changed_from=None):
+    items = list()
+    for i in range(file_count):
+        file_tag = tag if changed_from is None or i < changed_from else tag + "-changed"
+        items.append({"type": "DepotFile", "path": f"data\\dir{i % 300}\\file{i}.pak",
+                      "flags": ["executable"] if i % 50 == 0 else [], "md5": digest(file_tag, i),
+                      "chunks": [{"md5": digest(file_tag, i, c), "compressedMd5": digest(file_tag, "c", i, c),
+                                  "size": 1024 * 1024, "compressedSize": 700000} for c in range(chunk_count)]})
+    return json.dumps(items)
+
+
+def measure(cls, texts):
+    """Returns (files, MiB held by them, seconds spent parsing)"""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    # Parsed JSON is dropped once files are built, only what files keep is counted
+    manifests = [[cls(item, "1") for item in json.loads(text)] for text in texts]
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return manifests, held / 1024 / 1024, elapsed
+
+
+def main():
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    chunk_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    texts = (manifest_items("build", file_count, chunk_count),
+             manifest_items("build", file_count, chunk_count, changed_from=file_count // 2))
+    print(f"2 manifests of {file_count} files / {file_count * chunk_count} chunks each")
+
+    before, before_mib, before_time = measure(DictDepotFile, texts)
+    del before
+    after, after_mib, after_time = measure(v2.DepotFile, texts)
+    print(f"before (JSON chunk dicts): {before_mib:.1f} MiB held, parsed in {before_time:.2f}s")
+    print(f"after (ChunkTable):        {after_mib:.1f} MiB held, parsed in {after_time:.2f}s")
+
+    new, old = after
+    started = time.perf_counter()
+    diff = v2.ManifestDiff.compare(SimpleNamespace(files=new), SimpleNamespace(files=old))
+    print(f"diff {time.perf_counter() - started:.2f}s, {len(diff.changed)} changed files")
+    assert len(diff.changed) == file_count - file_count // 2
+    assert after_mib < before_mib
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Benchmark of v2.FileDiff.compare on a synthetic file with many chunks.
+
+Compares the md5 index used by FileDiff.compare against the nested loop it replaced
+and checks both find the same old_offset for every chunk that is unique in the old file.
+
+Usage: python bench_file_diff.py [chunk count, default 10000]
+"""
+
+import hashlib
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "main" / "python"))
+
+from gogdl.dl.objects import v2
+
+
+def make_chunk(seed, size):
+    md5 = hashlib.md5(seed.encode()).hexdigest()
+    return {"md5": md5, "compressedMd5": hashlib.md5(md5.encode()).hexdigest(), "size": size, "compressedSize": size}
+
+
+def make_file(chunks):
+    return v2.DepotFile({"path": "data\\archive.pak", "flags": [], "chunks": chunks}, "1")
+
+
+def nested_loop_offsets(new_chunks, old_chunks):
+    """FileDiff.compare before the md5 index, keeps the last matching offset"""
+    offsets = dict()
+    for i, new_chunk in enumerate(new_chunks):
+        old_offset = 0
+        for old_chunk in old_chunks:
+            if old_chunk["md5"] == new_chunk["md5"]:
+                offsets[i] = old_offset
+            old_offset += old_chunk["size"]
+    return offsets
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rnd = random.Random(18)
+    old_chunks = [make_chunk(f"old-{i}", rnd.choice((1024 * 1024, 10 * 1024 * 1024))) for i in range(count)]
+    # A few chunks repeat inside the old file, offsets of those may differ but point at the same data
+    for i in range(0, count, 997):
+        old_chunks[i] = dict(old_chunks[(i + 1) % count])
+    # A third of the chunks change, the rest are reordered
+    new_chunks = [make_chunk(f"new-{i}", chunk["size"]) if rnd.random() < 1 / 3 else dict(chunk)
+                  for i, chunk in enumerate(old_chunks)]
+    rnd.shuffle(new_chunks)
+    old_file, new_file = make_file(old_chunks), make_file(new_chunks)
+
+    started = time.perf_counter()
+    diff = v2.FileDiff.compare(new_file, old_file)
+    index_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    expected = nested_loop_offsets(new_chunks, old_chunks)
+    loop_time = time.perf_counter() - started
+
+    old_starts = dict()
+    offset = 0
+    for chunk in old_chunks:
+        old_starts.setdefault(offset, chunk["md5"])
+        offset += chunk["size"]
+    occurrences = dict()
+    for chunk in old_chunks:
+        occurrences[chunk["md5"]] = occurrences.get(chunk["md5"], 0) + 1
+
+    assert diff.old_offsets.keys() == expected.keys()
+    unique = 0
+    for i, old_offset in diff.old_offsets.items():
+        assert old_starts[old_offset] == new_chunks[i]["md5"]
+        if occurrences[new_chunks[i]["md5"]] == 1:
+            assert old_offset == expected[i], i
+            unique += 1
+
+    print(f"{count} chunks, {len(diff.old_offsets)} reused ({unique} unique in old file, identical offsets)")
+    print(f"nested loop {loop_time:.3f}s, md5 index {index_time:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+End-to-end test of Linux installer downloads through ExecutingManager.
+
+Serves a synthetic installer (shell prefix + ZIP archive) from a local HTTP server
+that answers every range request after a fixed latency, behind a redirect like the
+content-system link. InstallerHandler reads the central directory, the executor
+groups entries with InstallerHandler.coalesce_ranges and its download workers fetch
+the groups, each in a single ranged request, concurrently through the shared pool.
+
+The download runs twice, with a single download worker, i.e. ranges fetched one after
+another, and with 8. Checks installed files against the archive and that with more
+workers ranges were in flight at the same time.
+
+Usage: python bench_installer_ranges.py [entries, default 2000] [request latency ms, default 200]
+"""
+
+import io
+import os
+import random
+import re
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "main" / "python"))
+
+from gogdl.dl import connection_pool
+from gogdl.dl.managers.task_executor import ExecutingManager
+from gogdl.dl.objects import generic, linux
+
+
+def make_installer(count):
+    """Returns (installer bytes, {name: content})"""
+    rng = random.Random(12)
+    archive = io.BytesIO()
+    contents = dict()
+    with zipfile.ZipFile(archive, "w") as z:
+        for i in range(count):
+            kind = i % 4
+            if kind == 0:
+                data = rng.randbytes(rng.randint(1, 16 * 1024))
+            elif kind == 1:
+                data = (b"line %d of a text file\n" % i) * rng.randint(1, 2000)
+            elif kind == 2:
+                data = b""
+            else:
+                data = rng.randbytes(rng.randint(64 * 1024, 256 * 1024))
+            info = zipfile.ZipInfo(f"data/dir{i % 13}/file{i}")
+            info.compress_type = zipfile.ZIP_DEFLATED if i % 3 else zipfile.ZIP_STORED
+            info.external_attr = (0o100755 if i % 17 == 0 else 0o100644) << 16
+            z.writestr(info, data)
+            contents[info.filename] = data
+    return b"#!/bin/sh\n" + bytes(rng.randrange(256) for _ in range(20000)) + archive.getvalue(), contents
+
+
+class InstallerServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, installer, latency):
+        super().__init__(("127.0.0.1", 0), RangeHandler)
+        self.installer = installer
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = list()  # (start, end)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/link":
+            self.send_response(302)
+            self.send_header("Location", "/installer.sh")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        server = self.server
+        start, end = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers["Range"]).groups()
+        size = len(server.installer)
+        if not start:
+            start, end = size - int(end), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+        with server.lock:
+            server.in_flight += 1
+            server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency)
+            body = server.installer[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+                server.requests.append((start, end))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.2
+
+    installer, contents = make_installer(count)
+    server = InstallerServer(installer, latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        started = time.perf_counter()
+        handler = linux.InstallerHandler(f"http://127.0.0.1:{server.server_port}/link", "1", connection_pool.create_session())
+        handler.setup()
+        setup_time = time.perf_counter() - started
+        files = [linux.LinuxFile("1", cd_file.file_name, cd_file.compression_method,
+                                 handler.start_of_archive_index + cd_file.file_data_offset, cd_file.compressed_size,
+                                 cd_file.uncompressed_size, cd_file.crc32, bool((cd_file.ext_file_attrs >> 16) & stat.S_IXUSR))
+                 for cd_file in handler.central_directory.files]
+        non_empty = sum(1 for content in contents.values() if content)
+        print(f"installer {len(installer) / 1024 / 1024:.1f} MiB, {count} entries ({non_empty} non-empty)")
+        print(f"setup: {len(server.requests)} request(s), {setup_time * 1000:.0f} ms")
+
+        for workers in (1, 8):
+            server.requests.clear()
+            server.peak_in_flight = 0
+            download_time = download(files, handler.url, workers, contents)
+            print(f"{workers} download workers: {len(server.requests)} range requests in {download_time:.2f}s, "
+                  f"{server.peak_in_flight} in flight at peak")
+            assert len(server.requests) < non_empty
+        assert len(server.requests) == 1 or server.peak_in_flight > 1, "ranges were fetched one at a time"
+    finally:
+        server.shutdown()
+
+
+def download(files, url, workers, contents):
+    """Installs files with ExecutingManager, returns seconds it took"""
+    path = tempfile.mkdtemp(prefix="bench_installer_")
+    try:
+        diff = generic.BaseDiff()
+        diff.new = files
+        manager = ExecutingManager(None, workers, path, None, diff, {"1": url}, game_id="bench")
+        started = time.perf_counter()
+        assert manager.setup()
+        assert not manager.run(), "download failed"
+        elapsed = time.perf_counter() - started
+        for name, content in contents.items():
+            with open(os.path.join(path, name), "rb") as handle:
+                assert handle.read() == content, name
+        return elapsed
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
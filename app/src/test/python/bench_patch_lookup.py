@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Regression check and benchmark of patch lookup in v2.ManifestDiff.compare.
+
+Checks that files sharing the same old content (md5_source) but patched into different
+targets get their own patch entries, that file without an entry for its path is updated
+with its chunks instead of another file's patch, that entries held by Patch aren't mutated, and
+times the indexed lookup against the scan over patch.files it replaced.
+
+Usage: python bench_patch_lookup.py [changed files, default 30000] [patch entries, default 5000]
+"""
+
+import hashlib
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "main" / "python"))
+
+from gogdl.dl.objects import v2
+
+
+def md5(value):
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+def make_file(path, content):
+    chunk = {"md5": md5(content), "compressedMd5": md5("c" + content), "size": 1024, "compressedSize": 512}
+    return v2.DepotFile({"path": path, "flags": [], "md5": md5(content), "chunks": [chunk]}, "1")
+
+
+def make_patch(entries):
+    patch = v2.Patch()
+    patch.files = [v2.FilePatchDiff({"md5_source": md5(source), "md5_target": md5(target), "path_source": path,
+                                     "path_target": path, "md5": md5(path + "delta"), "chunks": []})
+                   for path, source, target in entries]
+    patch.build_index()
+    return patch
+
+
+def manifest(files):
+    return SimpleNamespace(files=files)
+
+
+def check_shared_source():
+    # Both files had identical content, each is patched into different new content
+    old = [make_file("bin\\a.dat", "same"), make_file("bin\\b.dat", "same"), make_file("bin\\c.dat", "same")]
+    new = [make_file("bin\\a.dat", "new a"), make_file("bin\\b.dat", "new b"), make_file("bin\\c.dat", "new c")]
+    patch = make_patch([("bin\\a.dat", "same", "new a"), ("bin\\b.dat", "same", "new b")])
+
+    diff = v2.ManifestDiff.compare(manifest(new), manifest(old), patch)
+    patched = {p.new_file.path: p for p in diff.changed if isinstance(p, v2.FilePatchDiff)}
+    assert sorted(patched) == ["bin/a.dat", "bin/b.dat"]
+    assert patched["bin/a.dat"].target == "bin/a.dat" and patched["bin/a.dat"].md5_target == md5("new a")
+    assert patched["bin/b.dat"].target == "bin/b.dat" and patched["bin/b.dat"].md5_target == md5("new b")
+    assert patched["bin/a.dat"].old_file is old[0] and patched["bin/b.dat"].old_file is old[1]
+    # No entry for c.dat's path, entries of other files would write their own targets,
+    # so it's updated with its chunks like any other changed file
+    updated = [f for f in diff.changed if not isinstance(f, v2.FilePatchDiff)]
+    assert len(updated) == 1
+    updated = updated[0].file if isinstance(updated[0], v2.FileDiff) else updated[0]
+    assert updated is new[2]
+    for entry in patch.files:
+        assert not hasattr(entry, "old_file") and not hasattr(entry, "new_file"), entry.target
+    print("shared md5_source: each target got its own patch, file without one got chunk update, Patch.files untouched")
+
+
+def scan_lookup(patch, old_file):
+    """Patch lookup before the index, last entry with matching source wins"""
+    patch_file = None
+    old_final_sum = old_file.md5 or old_file.chunks[0].md5
+    for p_file in patch.files:
+        if p_file.md5_source == old_final_sum:
+            patch_file = p_file
+    return patch_file
+
+
+def benchmark(file_count, entry_count):
+    old = [make_file(f"data\\file{i}.bin", f"old {i}") for i in range(file_count)]
+    new = [make_file(f"data\\file{i}.bin", f"new {i}") for i in range(file_count)]
+    patch = make_patch([(f"data\\file{i}.bin", f"old {i}", f"new {i}") for i in range(0, file_count, max(file_count // entry_count, 1))][:entry_count])
+
+    started = time.perf_counter()
+    diff = v2.ManifestDiff.compare(manifest(new), manifest(old), patch)
+    index_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    scanned = [scan_lookup(patch, old_file) for old_file in old]
+    scan_time = time.perf_counter() - started
+
+    patched = sorted(p.target for p in diff.changed if isinstance(p, v2.FilePatchDiff))
+    assert patched == sorted(p.target for p in scanned if p)
+    print(f"{file_count} changed files, {len(patch.files)} patch entries, {len(patched)} patched")
+    print(f"scan over patch.files {scan_time:.3f}s, indexed compare {index_time:.3f}s")
+
+
+def main():
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    entry_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    check_shared_source()
+    benchmark(file_count, entry_count)
+
+
+if __name__ == "__main__":
+    main()
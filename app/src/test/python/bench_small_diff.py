@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+End-to-end timing of a tiny update through ExecutingManager.
+
+Installs 10 small files, then applies a 10-file diff to them: five files changed
+reusing chunks of their old versions, five new ones. Download workers are replaced
+by one serving chunks from memory, so what's measured is the executor itself, setup
+to run() returning. With the main loop, workers and scheduler woken up by events
+instead of polling, a run like that has to end well under the second the sleep(1)
+loop used to cost.
+
+Usage: python bench_small_diff.py [runs, default 10] [bound in seconds, default 0.5]
+"""
+
+import hashlib
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "main" / "python"))
+
+from gogdl.dl import dl_utils
+from gogdl.dl.managers.task_executor import ExecutingManager
+from gogdl.dl.objects import generic, v2
+from gogdl.dl.workers import task_executor
+
+# Chunk data by compressed md5, chunks are served "compressed" as is
+CHUNKS = dict()
+
+
+def memory_download_worker(download_queue, results_queue, speed_counter, secure_links, temp_dir, cancel_token):
+    """task_executor.download_worker serving chunks from CHUNKS"""
+    while True:
+        task = download_queue.get()
+        if isinstance(task, generic.TerminateWorker) or cancel_token.is_cancelled():
+            break
+        data = CHUNKS[task.compressed_sum]
+        with task_executor.open_chunk_output(task) as handle:
+            handle.write(data)
+        speed_counter.add(len(data), len(data))
+        results_queue.put(task_executor.DownloadTaskResult(True, None, task, task.temp_file, len(data), len(data)))
+
+
+def make_file(path, parts):
+    for data in parts:
+        CHUNKS[hashlib.md5(b"compressed" + data).hexdigest()] = data
+    content = b"".join(parts)
+    return v2.DepotFile({"path": path, "flags": [], "md5": hashlib.md5(content).hexdigest(),
+                         "chunks": [{"md5": hashlib.md5(data).hexdigest(),
+                                     "compressedMd5": hashlib.md5(b"compressed" + data).hexdigest(),
+                                     "size": len(data), "compressedSize": len(data)} for data in parts]}, "1"), content
+
+
+def execute(path, diff):
+    manager = ExecutingManager(None, 4, path, None, diff, None, game_id="bench")
+    started = time.perf_counter()
+    assert manager.setup()
+    assert not manager.run(), "download failed"
+    return time.perf_counter() - started
+
+
+def check(path, contents):
+    for file_path, content in contents.items():
+        with open(dl_utils.get_case_insensitive_name(os.path.join(path, file_path)), "rb") as handle:
+            assert handle.read() == content, file_path
+
+
+def run_once(rng):
+    """Returns (install time, update time)"""
+    path = tempfile.mkdtemp(prefix="bench_small_diff_")
+    try:
+        old_parts = dict()
+        contents = dict()
+        diff = v2.ManifestDiff()
+        for i in range(10):
+            parts = [rng.randbytes(rng.randint(1, 64 * 1024)) for _ in range(rng.randint(1, 3))]
+            depot_file, content = make_file(f"game\\file{i}.dat", parts)
+            contents[depot_file.path] = content
+            old_parts[depot_file.path] = (depot_file, parts)
+            diff.new.append(depot_file)
+        install_time = execute(path, diff)
+        check(path, contents)
+
+        diff = v2.ManifestDiff()
+        for old_file, parts in list(old_parts.values())[:5]:
+            new_file, contents[old_file.path] = make_file(old_file.path.replace(os.sep, "\\"), parts[::-1] + [rng.randbytes(1000)])
+            diff.changed.append(v2.FileDiff.compare(new_file, old_file))
+        for i in range(10, 15):
+            depot_file, content = make_file(f"game\\file{i}.dat", [rng.randbytes(rng.randint(1, 64 * 1024))])
+            contents[depot_file.path] = content
+            diff.new.append(depot_file)
+        update_time = execute(path, diff)
+        check(path, contents)
+        return install_time, update_time
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    bound = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    task_executor.download_worker = memory_download_worker
+
+    rng = random.Random(4)
+    times = [run_once(rng) for _ in range(runs)]
+    for name, samples in zip(["10 file install", "10 file diff"], zip(*times)):
+        print(f"{name}: median {statistics.median(samples) * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms over {runs} runs")
+        assert max(samples) < bound, f"{name} took {max(samples):.2f}s, bound is {bound}s"
+
+
+if __name__ == "__main__":
+    main()
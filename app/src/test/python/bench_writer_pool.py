@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark of the writer pool of ExecutingManager.
+
+Installs a synthetic v2 manifest of thousands of small files, part of their chunks
+shared between files so they go through the chunk cache, once per writer pool size.
+Download workers are replaced by one serving chunks from memory, so the run is bound
+by planning and writing. Installed files are checked against the manifest.
+
+Runs are repeated with every writer task delayed, like writes to slow storage (SD
+card, FUSE) are. On page cache alone writers are rarely the bottleneck, behind slow
+storage they are, and that's where the pool pays off.
+
+Usage: python bench_writer_pool.py [files, default 3000] [writer pool sizes, default 1,4] [write latencies ms, default 0,0.5]
+"""
+
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "main" / "python"))
+
+from gogdl.dl import dl_utils
+from gogdl.dl.managers.task_executor import ExecutingManager
+from gogdl.dl.objects import generic, v2
+from gogdl.dl.workers import task_executor
+
+# Chunk data by compressed md5, chunks are served "compressed" as is
+CHUNKS = dict()
+
+
+def memory_download_worker(download_queue, results_queue, speed_counter, secure_links, temp_dir, cancel_token):
+    """task_executor.download_worker serving chunks from CHUNKS"""
+    while True:
+        task = download_queue.get()
+        if isinstance(task, generic.TerminateWorker) or cancel_token.is_cancelled():
+            break
+        data = CHUNKS[task.compressed_sum]
+        with task_executor.open_chunk_output(task) as handle:
+            handle.write(data)
+        speed_counter.add(len(data), len(data))
+        results_queue.put(task_executor.DownloadTaskResult(True, None, task, task.temp_file, len(data), len(data)))
+
+
+class DelayedQueue:
+    """Writer queue handing out every task after latency seconds"""
+
+    def __init__(self, queue, latency):
+        self.queue = queue
+        self.latency = latency
+
+    def get(self, *args, **kwargs):
+        task = self.queue.get(*args, **kwargs)
+        if not isinstance(task, generic.TerminateWorker):
+            time.sleep(self.latency)
+        return task
+
+
+def delayed_writer_worker(latency):
+    writer_worker = task_executor.writer_worker
+
+    def worker(writer_queue, *args):
+        writer_worker(DelayedQueue(writer_queue, latency) if latency else writer_queue, *args)
+    return worker
+
+
+def make_chunk(data):
+    compressed_md5 = hashlib.md5(b"compressed" + data).hexdigest()
+    CHUNKS[compressed_md5] = data
+    return {"md5": hashlib.md5(data).hexdigest(), "compressedMd5": compressed_md5,
+            "size": len(data), "compressedSize": len(data)}
+
+
+def make_manifest(count):
+    """Returns (ManifestDiff installing count files, {path: content})"""
+    rng = random.Random(3)
+    shared = [rng.randbytes(rng.randint(512, 4096)) for _ in range(64)]
+    files = list()
+    contents = dict()
+    for i in range(count):
+        parts = [rng.choice(shared) if rng.random() < 0.3 else rng.randbytes(rng.randint(1, 8192))
+                 for _ in range(rng.randint(1, 3))]
+        content = b"".join(parts)
+        depot_file = v2.DepotFile({"path": f"data\\dir{i % 40}\\file{i}.dat", "flags": [],
+                                   "md5": hashlib.md5(content).hexdigest(),
+                                   "chunks": [make_chunk(part) for part in parts]}, "1")
+        files.append(depot_file)
+        contents[depot_file.path] = content
+    diff = v2.ManifestDiff()
+    diff.new = files
+    return diff, contents
+
+
+def install(diff, writers):
+    path = tempfile.mkdtemp(prefix="bench_writer_pool_")
+    try:
+        manager = ExecutingManager(None, 8, path, None, diff, None, game_id="bench", writers_count=writers)
+        started = time.perf_counter()
+        assert manager.setup()
+        assert not manager.run(), "install failed"
+        elapsed = time.perf_counter() - started
+        return elapsed, path
+    except BaseException:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    pools = [int(n) for n in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, 4]
+    latencies = [float(n) for n in sys.argv[3].split(",")] if len(sys.argv) > 3 else [0, 0.5]
+    task_executor.download_worker = memory_download_worker
+    writer_worker = task_executor.writer_worker
+
+    diff, contents = make_manifest(count)
+    size = sum(len(content) for content in contents.values())
+    print(f"{count} files, {size / 1024 / 1024:.1f} MiB")
+    for latency in latencies:
+        task_executor.writer_worker = delayed_writer_worker(latency / 1000)
+        for writers in pools:
+            elapsed, path = install(diff, writers)
+            try:
+                for file_path, content in contents.items():
+                    with open(dl_utils.get_case_insensitive_name(os.path.join(path, file_path)), "rb") as handle:
+                        assert handle.read() == content, file_path
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+            print(f"write latency {latency}ms, {writers} writers: {elapsed:.2f}s, {count / elapsed:.0f} files/s, "
+                  f"{size / 1024 / 1024 / elapsed:.1f} MiB/s")
+    task_executor.writer_worker = writer_worker
+
+
+if __name__ == "__main__":
+    main()
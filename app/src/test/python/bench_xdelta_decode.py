@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the pure Python xdelta3 (VCDIFF) decoder.
+
+Generates deterministic source/target pairs, encodes them with the xdelta3 tool
+(no secondary compression, like the patches GOG serves), then applies the patches
+with gogdl.xdelta.patcher.patch, with the decoder it replaced (one HalfInstruction
+object and one BytesIO read per step, kept inline below) and with xdelta3 -d.
+Outputs have to be byte identical to the target, speeds are reported in MB/s of
+target written.
+
+Fixtures:
+  dense   - an edit every ~64 bytes, hundreds of thousands of instructions
+  sparse  - a few hundred edits, mostly long copies from the source
+
+Requires xdelta3 on PATH (or XDELTA3 environment variable pointing at it).
+
+Usage: python bench_xdelta_decode.py [dense size MiB, default 16] [sparse size MiB, default 12]
+"""
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+from zlib import adler32
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "main" / "python"))
+
+from gogdl.xdelta import objects, patcher
+
+
+class SpeedCounter:
+    def __init__(self):
+        self.written = 0
+        self.read = 0
+
+    def add(self, written, read):
+        self.written += written
+        self.read += read
+
+
+def old_parse_halfinst(context, halfinst):
+    if halfinst.size == 0:
+        halfinst.size = patcher.read_integer_stream(context.inst_sec)
+    if halfinst.type >= objects.XD3_CPY:
+        mode = halfinst.type - objects.XD3_CPY
+        same_start = 2 + context.acache.s_near
+        if mode < same_start:
+            halfinst.addr = patcher.read_integer_stream(context.addr_sec)
+            if mode == 1:
+                halfinst.addr = context.dec_pos - halfinst.addr
+                if halfinst.addr < 0:
+                    halfinst.addr = context.cpy_len + halfinst.addr
+            elif mode > 1:
+                halfinst.addr += context.acache.near_array[mode - 2]
+        else:
+            mode -= same_start
+            addr = context.addr_sec.read(1)[0]
+            halfinst.addr = context.acache.same_array[(mode * 256) + addr]
+        context.acache.update(halfinst.addr)
+    context.dec_pos += halfinst.size
+
+
+def old_decode_halfinst(context, halfinst, speed_counter):
+    take = halfinst.size
+    if halfinst.type == objects.XD3_RUN:
+        byte = context.data_sec.read(1)
+        for _ in range(take):
+            context.target_buffer.extend(byte)
+    elif halfinst.type == objects.XD3_ADD:
+        context.target_buffer.extend(context.data_sec.read(take))
+    else:
+        if halfinst.addr >= (context.cpy_len or 0):
+            raise Exception("OVERLAP")
+        context.source.seek(context.cpy_off + halfinst.addr)
+        left = take
+        while left > 0:
+            buffer = context.source.read(min(1024 * 1024, left))
+            speed_counter.add(0, len(buffer))
+            context.target_buffer.extend(buffer)
+            left -= len(buffer)
+    halfinst.type = objects.XD3_NOOP
+
+
+def old_patch(source, patch, out, speed_counter):
+    """patcher.patch before window decoding was flattened, no app header/secondary compression support"""
+    with open(source, "rb") as src_handle, open(patch, "rb") as patch_handle, open(out, "wb") as dst_handle:
+        headers = patch_handle.read(5)
+        assert headers[:3] == b"\xd6\xc3\xc4" and not headers[4] & 0b11
+        if headers[4] & 0b100:
+            patch_handle.read(patcher.read_integer_stream(patch_handle))
+        context = objects.Context(src_handle, dst_handle, BytesIO(), BytesIO(), BytesIO(), objects.AddressCache())
+        indicator = patch_handle.read(1)
+        while indicator:
+            win_indicator = indicator[0]
+            context.acache = objects.AddressCache()
+            context.cpy_len = context.cpy_off = 0
+            if win_indicator & 1:
+                context.cpy_len = patcher.read_integer_stream(patch_handle)
+                context.cpy_off = patcher.read_integer_stream(patch_handle)
+            context.dec_pos = 0
+            patcher.read_integer_stream(patch_handle)  # Delta encoding length
+            patcher.read_integer_stream(patch_handle)  # Window length
+            context.target_buffer = bytearray()
+            patch_handle.read(1)  # Delta indicator
+            data_length = patcher.read_integer_stream(patch_handle)
+            inst_length = patcher.read_integer_stream(patch_handle)
+            addr_length = patcher.read_integer_stream(patch_handle)
+            checksum = int.from_bytes(patch_handle.read(4), "big") if win_indicator & 0b100 else None
+            context.data_sec = BytesIO(patch_handle.read(data_length))
+            context.inst_sec = BytesIO(patch_handle.read(inst_length))
+            context.addr_sec = BytesIO(patch_handle.read(addr_length))
+
+            current1 = objects.HalfInstruction()
+            current2 = objects.HalfInstruction()
+            while context.inst_sec.tell() < inst_length or current1.type != objects.XD3_NOOP or current2.type != objects.XD3_NOOP:
+                if current1.type == objects.XD3_NOOP and current2.type == objects.XD3_NOOP:
+                    ins = objects.CODE_TABLE[context.inst_sec.read(1)[0]]
+                    current1.type, current2.type = ins.type1, ins.type2
+                    current1.size, current2.size = ins.size1, ins.size2
+                    if current1.type != objects.XD3_NOOP:
+                        old_parse_halfinst(context, current1)
+                    if current2.type != objects.XD3_NOOP:
+                        old_parse_halfinst(context, current2)
+                while current1.type != objects.XD3_NOOP:
+                    old_decode_halfinst(context, current1, speed_counter)
+                while current2.type != objects.XD3_NOOP:
+                    old_decode_halfinst(context, current2, speed_counter)
+
+            if checksum is not None and checksum != adler32(context.target_buffer):
+                raise objects.ChecksumMissmatch
+            dst_handle.write(context.target_buffer)
+            speed_counter.add(len(context.target_buffer), 0)
+            indicator = patch_handle.read(1)
+
+
+def make_dense(rng, size):
+    source = rng.randbytes(size)
+    target = bytearray(source)
+    for pos in range(0, size - 8, 64):
+        offset = pos + rng.randrange(56)
+        target[offset:offset + 4] = rng.randbytes(4)
+    return source, bytes(target)
+
+
+def make_sparse(rng, size):
+    source = rng.randbytes(size)
+    target = bytearray(source)
+    for _ in range(300):
+        offset = rng.randrange(size - 4096)
+        target[offset:offset + rng.randrange(16, 4096)] = rng.randbytes(256)
+    # Moved blocks and a tail of new data
+    block = size // 8
+    target[:block], target[block:2 * block] = target[block:2 * block], target[:block]
+    target += rng.randbytes(1024 * 1024)
+    return source, bytes(target)
+
+
+def run(xdelta3, workdir, name, source, target):
+    source_path = os.path.join(workdir, f"{name}.src")
+    target_path = os.path.join(workdir, f"{name}.tgt")
+    patch_path = os.path.join(workdir, f"{name}.vcdiff")
+    out_path = os.path.join(workdir, f"{name}.out")
+    native_path = os.path.join(workdir, f"{name}.native")
+    Path(source_path).write_bytes(source)
+    Path(target_path).write_bytes(target)
+    subprocess.run([xdelta3, "-e", "-f", "-S", "none", "-s", source_path, target_path, patch_path], check=True)
+
+    counter = SpeedCounter()
+    started = time.perf_counter()
+    patcher.patch(source_path, patch_path, out_path, counter)
+    python_time = time.perf_counter() - started
+    assert Path(out_path).read_bytes() == target, f"{name}: patched output differs from target"
+    assert counter.written == len(target)
+
+    # Old decoder misread HERE-mode addresses, some patches fail on it
+    started = time.perf_counter()
+    try:
+        old_patch(source_path, patch_path, out_path, SpeedCounter())
+        old_time = time.perf_counter() - started
+        assert Path(out_path).read_bytes() == target, f"{name}: old decoder output differs from target"
+        old_result = f"{old_time:.2f}s {len(target) / 1000 / 1000 / old_time:.1f} MB/s"
+    except Exception as e:
+        old_result = f"failed ({e!r})"
+
+    started = time.perf_counter()
+    subprocess.run([xdelta3, "-d", "-f", "-s", source_path, patch_path, native_path], check=True)
+    native_time = time.perf_counter() - started
+    assert Path(native_path).read_bytes() == target
+
+    mb = len(target) / 1000 / 1000
+    print(f"{name}: target {len(target) / 1024 / 1024:.1f} MiB, patch {os.path.getsize(patch_path) / 1024:.0f} KiB")
+    print(f"  old decoder {old_result}, "
+          f"patcher.patch {python_time:.2f}s {mb / python_time:.1f} MB/s, "
+          f"xdelta3 -d {native_time:.2f}s {mb / native_time:.1f} MB/s")
+
+
+def main():
+    dense_size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 16 * 1024 * 1024
+    sparse_size = int(float(sys.argv[2]) * 1024 * 1024) if len(sys.argv) > 2 else 12 * 1024 * 1024
+    xdelta3 = os.environ.get("XDELTA3") or shutil.which("xdelta3")
+    if not xdelta3:
+        sys.exit("xdelta3 not found, install it or set XDELTA3")
+
+    rng = random.Random(14)
+    with tempfile.TemporaryDirectory() as workdir:
+        run(xdelta3, workdir, "dense", *make_dense(rng, dense_size))
+        run(xdelta3, workdir, "sparse", *make_sparse(rng, sparse_size))
+
+
+if __name__ == "__main__":
+    main()
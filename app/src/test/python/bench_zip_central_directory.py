@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the Linux installer ZIP central directory parser.
+
+Builds a synthetic ZIP64 central directory, every record carrying sizes and offset in
+its zip64 extra field, and parses it with linux.CentralDirectory.from_bytes. The parser
+it replaced, which sliced the remaining directory after every record, runs on a prefix
+of it, both have to produce the same entries. A small archive written by zipfile is
+also checked against zipfile's own infolist.
+
+Usage: python bench_zip_central_directory.py [entries, default 100000] [entries for old parser, default 10000]
+"""
+
+import io
+import struct
+import sys
+import time
+import zipfile
+from io import BytesIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "main" / "python"))
+
+from gogdl.dl.objects import linux
+
+RECORD = struct.Struct("<4s6H3I5H2I")
+ZIP64_FIELD = struct.Struct("<2H3Q")
+
+
+def build_central_directory(count):
+    """Returns (central directory bytes, list of expected (name, crc32, compressed size, size, offset))"""
+    records = bytearray()
+    expected = list()
+    offset = 0
+    for i in range(count):
+        name = f"game/data/dir{i % 500}/file{i}.bin".encode()
+        size = 5 * 1024 * 1024 * 1024 + i  # Doesn't fit 32 bits
+        compressed_size = size // 2
+        crc = (i * 2654435761) & 0xFFFFFFFF
+        extra = ZIP64_FIELD.pack(0x01, 24, size, compressed_size, offset)
+        records += RECORD.pack(linux.CENTRAL_DIRECTORY, 0x031E, 45, 0, 8, 0, 0, crc, 0xFFFFFFFF, 0xFFFFFFFF,
+                               len(name), len(extra), 0, 0, 0, 0o100644 << 16, 0xFFFFFFFF)
+        records += name + extra
+        expected.append((name.decode(), crc, compressed_size, size, offset))
+        offset += 30 + len(name) + compressed_size
+    return bytes(records), expected
+
+
+class SlicingCentralDirectoryFile:
+    """CentralDirectoryFile.from_bytes before the single pass parser, fields read by slicing"""
+
+    @classmethod
+    def from_bytes(cls, data):
+        cd_file = cls()
+        cd_file.crc32 = int.from_bytes(data[16:20], "little")
+        cd_file.compressed_size = int.from_bytes(data[20:24], "little")
+        cd_file.uncompressed_size = int.from_bytes(data[24:28], "little")
+        file_name_length = int.from_bytes(data[28:30], "little")
+        extra_field_length = int.from_bytes(data[30:32], "little")
+        file_comment_length = int.from_bytes(data[32:34], "little")
+        cd_file.relative_local_file_offset = int.from_bytes(data[42:46], "little")
+
+        extra_field_start = 46 + file_name_length
+        cd_file.file_name = bytes(data[46:extra_field_start]).decode()
+        extra_field = BytesIO(data[extra_field_start: extra_field_start + extra_field_length])
+        field = None
+        while True:
+            field_id = int.from_bytes(extra_field.read(2), "little")
+            size = int.from_bytes(extra_field.read(2), "little")
+            if field_id == 0x01:
+                if extra_field_length - extra_field.tell() >= size:
+                    field = BytesIO(extra_field.read(size))
+                break
+            extra_field.seek(size, 1)
+            if extra_field_length - extra_field.tell() == 0:
+                break
+        if field:
+            if cd_file.uncompressed_size == 0xFFFFFFFF:
+                cd_file.uncompressed_size = int.from_bytes(field.read(8), "little")
+            if cd_file.compressed_size == 0xFFFFFFFF:
+                cd_file.compressed_size = int.from_bytes(field.read(8), "little")
+            if cd_file.relative_local_file_offset == 0xFFFFFFFF:
+                cd_file.relative_local_file_offset = int.from_bytes(field.read(8), "little")
+        return cd_file, extra_field_start + extra_field_length + file_comment_length
+
+
+def slicing_parse(data, count):
+    files = list()
+    for _ in range(count):
+        cd_file, next_offset = SlicingCentralDirectoryFile.from_bytes(data)
+        files.append(cd_file)
+        data = data[next_offset:]
+    return files
+
+
+def fields(cd_file):
+    return cd_file.file_name, cd_file.crc32, cd_file.compressed_size, cd_file.uncompressed_size, cd_file.relative_local_file_offset
+
+
+def check_zipfile():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for i in range(200):
+            archive.writestr(f"dir{i % 7}/file{i}", bytes(i % 251 for _ in range(i * 37)),
+                             compress_type=zipfile.ZIP_DEFLATED if i % 2 else zipfile.ZIP_STORED)
+    with zipfile.ZipFile(buffer) as archive:
+        infolist = archive.infolist()
+        start = archive.start_dir
+    data = buffer.getvalue()
+    end = data.rfind(linux.END_OF_CENTRAL_DIRECTORY)
+    central_directory = linux.CentralDirectory.from_bytes(data[start:end], len(infolist), "1")
+    assert [fields(f) for f in central_directory.files] == \
+        [(i.filename, i.CRC, i.compress_size, i.file_size, i.header_offset) for i in infolist]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    before_count = min(int(sys.argv[2]) if len(sys.argv) > 2 else 10000, count)
+    check_zipfile()
+    print("zipfile archive: entries match infolist")
+
+    data, expected = build_central_directory(count)
+    print(f"{count} ZIP64 entries, central directory {len(data) / 1024 / 1024:.1f} MiB")
+
+    started = time.perf_counter()
+    central_directory = linux.CentralDirectory.from_bytes(data, count, "1")
+    after_time = time.perf_counter() - started
+    assert [fields(f) for f in central_directory.files] == expected
+    for prev, cd_file in zip(central_directory.files, central_directory.files[1:]):
+        assert prev.file_data_offset == cd_file.relative_local_file_offset - prev.compressed_size
+
+    started = time.perf_counter()
+    before = slicing_parse(data, before_count)
+    before_time = time.perf_counter() - started
+    assert [fields(f) for f in before] == expected[:before_count]
+
+    print(f"single pass: {count} entries in {after_time:.2f}s")
+    print(f"slicing parser: {before_count} entries in {before_time:.2f}s, single pass needs "
+          f"{after_time * before_count / count:.2f}s for as many (slicing is quadratic, grows faster with count)")
+
+
+if __name__ == "__main__":
+    main()